@@ -26,17 +26,29 @@ from matplotlib import pyplot as plt
 import pdb
 import os
 import numpy as np
+import pandas as pd
 
 IS_TEST = False
 
 BUILD_HISTORICAL = False
 RUN_NEW_SIMULATIONS = False
 
+#### Stream the new simulations in blocks of hours straight to the csv files 
+####  instead of holding every site's full year in memory 
+STREAM_SIMULATIONS = False
+STREAM_BLOCK_HOURS = 24 * 7
+
+#### Root seed of the synthesis (see SolarSynthesis.main()), None for a new 
+####  random run each time.  With a seed the streamed and the whole-year 
+####  simulations give the same csv files. 
+SEED = None
+
 REPO_NAME = 'pv_fluctuation_sim'
 PV_PROD_DIR = os.path.join(os.pardir, REPO_NAME + '_data', 
                            'pv_production', '%s' )
 SITE_DIR = os.path.join(os.pardir, REPO_NAME + '_data', 
                            'site_config', '%s' )
+CSV_DIR = PV_PROD_DIR % 'csv'
 
 
 WIND_SPEED = 2 # m/s from Marcos et al 2011 paper with PV plants in Spain
@@ -90,16 +102,23 @@ def main(year):
 
     #### Using all sites synthesize correlated 1-min clearsky index timeseres 
     ####  for each site 
-    if RUN_NEW_SIMULATIONS:
+    if RUN_NEW_SIMULATIONS and STREAM_SIMULATIONS:
+        print "\n.... Streaming 1-min clearsky index and PV production to csv " +\
+            "files ...\n"
+        stream_simulations(ssites, year, STREAM_BLOCK_HOURS, seed = SEED)
+
+    elif RUN_NEW_SIMULATIONS:
         print "\n.... Synthesizing correlated 1-min clearsky index data ...\n"
+        #### The sites are in the order of their ids, the same as 
+        ####  stream_simulations(), since the synthesis depends on the order
         ss_list = []
-        for id in ssites:
+        for id in sorted(ssites):
             s = synth.SolarSite(ssites[id].id, ssites[id].lat, 
                                 ssites[id].lon, ssites[id].clr_idx_hr)
             ss_list.append(s)
 
         ## Call the main function
-        ss_list = synth.main(ss_list)
+        ss_list = synth.main(ss_list, seed = SEED)
     
         ## Store the 1-min clearsky index with the relevant SolarSite object
         print ".... Attaching the 1-min clearsky index data to the SolarSite " +\
@@ -111,10 +130,19 @@ def main(year):
         ####  PV plant output 
         print "\n.... Filtering clearsky index and convering to 1-min " +\
             "PV production...\n"
-        for id in ssites:    
-            pv_prod_min = filt.main(ssites[id].clr_idx_min, ssites[id].clr_prod_min, 
-                                    ssites[id].cap_ac, WIND_SPEED, ssites[id].config)
-            ssites[id].pv_prod_min = pv_prod_min
+        ids = sorted(ssites.keys())
+        clr_idx_min = pd.concat([ssites[id].clr_idx_min for id in ids], 
+                                axis = 1, keys = ids)
+        clr_prod_min = pd.concat([ssites[id].clr_prod_min for id in ids], 
+                                 axis = 1, keys = ids)
+        pv_prod_min = filt.batch_main(clr_idx_min, clr_prod_min, 
+                                      [ssites[id].cap_ac for id in ids], 
+                                      WIND_SPEED, 
+                                      [ssites[id].config for id in ids])
+        del clr_idx_min, clr_prod_min
+
+        for id in ids:    
+            ssites[id].pv_prod_min = pv_prod_min[id]
             ssites[id].has_synth = True
 
             #### Save the site data to a file
@@ -149,6 +177,69 @@ def test(year):
     solar_sites = main(year)
     return solar_sites
 
+def test_stream_simulations(n_sites = 4, n_hours = 50, block_hours = 24):
+    """
+    Check that stream_simulations() writes the same csv files, byte for byte, as
+     synthesizing the whole year with the same seed, filtering it in one pass 
+     and saving it with SolarSite.save() and save_aggregate(), for a small 
+     random site set in blocks that do not divide the hours evenly 
+    """
+    import shutil
+    import tempfile
+
+    year, seed = '2004', 5
+    rs = np.random.RandomState(0)
+    ss_random = synth.random_sites(n_sites, n_hours)
+    ssites = {}
+    for j, s in enumerate(ss_random):
+        site = SolarSite(s.id, year, s.lat, s.lon, '722784', 'test', 'AZ', 
+                         rs.uniform(1, 20), ['res', 'comm', 'usf'][j % 3])
+        site.clr_idx_hr = s.clr_idx_hr
+        minutes = synth.minute_index(s.clr_idx_hr.index)
+        site.clr_prod_min = pd.Series(site.cap_ac * rs.uniform(0, 1, len(minutes)),
+                                      index = minutes)
+        ssites[site.id] = site
+
+    tmp_dir = tempfile.mkdtemp(prefix = 'stream_csv_')
+    try:
+        whole_dir = os.path.join(tmp_dir, 'whole')
+        stream_dir = os.path.join(tmp_dir, 'stream')
+        os.mkdir(whole_dir)
+        os.mkdir(stream_dir)
+
+        #### Whole year, as in main() with the 'year' engine
+        ids = sorted(ssites)
+        ss_list = synth.main([synth.SolarSite(id, ssites[id].lat, ssites[id].lon,
+                                              ssites[id].clr_idx_hr) 
+                              for id in ids], engine = 'year', seed = seed)
+        clr_idx_min = pd.concat([s.clr_idx_min for s in ss_list], axis = 1, 
+                                keys = ids)
+        clr_prod_min = pd.concat([ssites[id].clr_prod_min for id in ids], 
+                                 axis = 1, keys = ids)
+        pv_prod_min = filt.batch_main(clr_idx_min, clr_prod_min, 
+                                      [ssites[id].cap_ac for id in ids], 
+                                      WIND_SPEED, 
+                                      [ssites[id].config for id in ids])
+        for id in ids:
+            ssites[id].pv_prod_min = pv_prod_min[id]
+            ssites[id].save(whole_dir)
+        save_aggregate(ssites, 'aggregate', whole_dir)
+
+        stream_simulations(ssites, year, block_hours, seed = seed, 
+                           csv_dir = stream_dir)
+
+        names = sorted(os.listdir(whole_dir))
+        assert len(names) == 2 * (n_sites + 1)
+        assert names == sorted(os.listdir(stream_dir))
+        for name in names:
+            whole = open(os.path.join(whole_dir, name), 'rb').read()
+            stream = open(os.path.join(stream_dir, name), 'rb').read()
+            assert whole == stream, name
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    return names
+
 
 class SolarSite:
     """
@@ -227,7 +318,7 @@ class SolarSite:
         
         return describe
 
-    def save(self):
+    def save(self, csv_dir = CSV_DIR):
         """ Create a csv file for the 1-min clearsky output and the pv production 
 
         Purpose:
@@ -238,14 +329,15 @@ class SolarSite:
         Saves two csv files with a header of 1 row (Date time (LST), PV output (MW))
 
         """
-        save_csv(self.id, self.year, self.clr_prod_min, self.pv_prod_min)
+        save_csv(self.id, self.year, self.clr_prod_min, self.pv_prod_min, 
+                 csv_dir)
 
-def save_aggregate(ss, name):
+def save_aggregate(ss, name, csv_dir = CSV_DIR):
     clr = sum_sites(ss, 'clr_prod_min')
     pv = sum_sites(ss, 'pv_prod_min')
-    save_csv(name, ss[ss.keys()[0]].year, clr, pv)
+    save_csv(name, ss[ss.keys()[0]].year, clr, pv, csv_dir)
     
-def save_csv(file_prefix, year, clr_ts, pv_ts):
+def save_csv(file_prefix, year, clr_ts, pv_ts, csv_dir = CSV_DIR):
 
     #### Get the datetime marker into a string
     dt = np.array(['Datetime (LST)'] + [str(t) for t in pv_ts.index])
@@ -256,14 +348,111 @@ def save_csv(file_prefix, year, clr_ts, pv_ts):
     pv = np.array(['PV Output (MW)'] + ['%.2f' % v for v in pv_ts.values])
     pv = np.column_stack([dt, pv])
 
-    f_name = PV_PROD_DIR % os.path.join('csv', 
-                                        file_prefix + '_' + year + '_%s.csv')   
+    f_name = os.path.join(csv_dir, file_prefix + '_' + year + '_%s.csv')   
     col_fmt = ['%s', '%s']
     
     np.savetxt(f_name % 'clr', clr, fmt = col_fmt, delimiter = ',')
     np.savetxt(f_name % 'pv', pv, fmt = col_fmt, delimiter = ',')
 
 
+def stream_simulations(ssites, year, block_hours = STREAM_BLOCK_HOURS, 
+                       aggregate_name = 'aggregate', seed = None, 
+                       csv_dir = CSV_DIR):
+    """
+    Purpose:
+    Streaming version of the synthesis, filter and save steps of main(): the 
+     correlated 1-min clearsky index is synthesized in blocks of hours, each 
+     block is filtered to PV production at each site (carrying the filter state 
+     between blocks), appended to the csv files of each site and to the 
+     aggregate csv files, and then dropped.  The memory used by the 1-min data 
+     depends on the block size rather than on the length of the year times the 
+     number of sites.  The 1-min series are not attached to the SolarSite 
+     objects.
+
+    Input:
+    ssites - dictionary of SolarSites with the historical data loaded 
+    year - year of the simulation as a string 
+    block_hours - number of hours in each block 
+    aggregate_name - file prefix for the csv files with the sum of all sites
+    seed - root seed of the synthesis, see SolarSynthesis.main()
+    csv_dir - directory of the csv files 
+
+    Output:
+    csv files for each site and the aggregate.  With a seed they are the same,
+     byte for byte, as synthesizing the whole year with the 'year' engine, 
+     filtering it with PVPlantFilter.batch_main() and saving it with 
+     SolarSite.save() and save_aggregate() (see test_stream_simulations())
+    """
+    ids = sorted(ssites.keys())
+    ss_list = [synth.SolarSite(ssites[id].id, ssites[id].lat, ssites[id].lon, 
+                               ssites[id].clr_idx_hr) for id in ids]
+
+    #### Plant filter of every site, which carries the filter state between 
+    ####  blocks 
+    alpha = filt.batch_filter_param([ssites[id].cap_ac for id in ids], 
+                                    WIND_SPEED, 
+                                    [ssites[id].config for id in ids], ids)
+    plant_filter = filt.PlantFilter(alpha, ids)
+
+    #### Open the csv writers for each site and the aggregate
+    writers = dict((id, CSVStreamWriter(id, year, csv_dir)) for id in ids)
+    aggregate = CSVStreamWriter(aggregate_name, year, csv_dir)
+
+    try:
+        for TS_block in synth.synthesize_stream(ss_list, block_hours, 
+                                                seed = seed):
+            clr_block = pd.concat([ssites[id].clr_prod_min.reindex(TS_block.index)
+                                   for id in ids], axis = 1, keys = ids)
+            pv_block = plant_filter.update(TS_block, clr_block)
+
+            #### Add up the sites in the same order as sum_sites() 
+            clr_sum = 0
+            pv_sum = 0
+            for id in ssites:
+                clr_prod = clr_block[id]
+                pv_prod = pv_block[id]
+                writers[id].write(clr_prod, pv_prod)
+
+                clr_sum = clr_prod + clr_sum
+                pv_sum = pv_prod + pv_sum
+
+            aggregate.write(clr_sum, pv_sum)
+    finally:
+        for writer in writers.values() + [aggregate]:
+            writer.close()
+
+class CSVStreamWriter:
+    """
+    Purpose:
+     Append blocks of the 1-min clearsky and PV production to the same two csv 
+     files that save_csv() writes in one go 
+
+    Input:
+    file_prefix - site id or name of the aggregate 
+    year - year of the simulation as a string 
+    csv_dir - directory of the csv files 
+
+    Methods:
+    write(clr_ts, pv_ts) - append a block of clearsky and PV production 
+    close() - close the files 
+    """
+    def __init__(self, file_prefix, year, csv_dir = CSV_DIR):
+        f_name = os.path.join(csv_dir, file_prefix + '_' + year + '_%s.csv')
+        self.clr_file = open(f_name % 'clr', 'w')
+        self.pv_file = open(f_name % 'pv', 'w')
+        self.clr_file.write('Datetime (LST),Clearsky Output (MW)\n')
+        self.pv_file.write('Datetime (LST),PV Output (MW)\n')
+
+    def write(self, clr_ts, pv_ts):
+        self.clr_file.writelines(['%s,%.2f\n' % (t, v) for t, v in 
+                                  zip(clr_ts.index, clr_ts.values)])
+        self.pv_file.writelines(['%s,%.2f\n' % (t, v) for t, v in 
+                                 zip(pv_ts.index, pv_ts.values)])
+
+    def close(self):
+        self.clr_file.close()
+        self.pv_file.close()
+
 def build_solar_sites(year):
     from xlrd import open_workbook,cellname
     from xlwt import Workbook
@@ -16,7 +16,31 @@ Outputs:
 """
 import pandas as pd
 import numpy as np
+from scipy.signal import lfilter
+import cPickle
+import hashlib
+import os
 import pdb
+import tempfile
+
+#### Number of minutes in each chunk of the scan of the filter for a time-varying
+####  alpha (see first_order_scan())
+SCAN_CHUNK = 4096
+
+#### Number of sites transformed at once by fft_smooth(), which limits the size
+####  of the (frequencies X sites) arrays for a full year
+FFT_SITES = 64
+
+#### Time step of the 1-min data in seconds
+DT = 60.
+
+#### Number of sites filtered at once by group_totals()
+TOTAL_SITES = 256
+
+#### Minutes of the 1-min data that may lie before the first or after the last
+####  time of the wind speed (e.g. hourly wind labelled at the half hour), see
+####  minute_alpha()
+ALPHA_EDGE_MINUTES = 60
 
 ##################################################
 #
@@ -25,7 +49,8 @@ import pdb
 ##################################################
 
 
-def main(clr_idx_min, clr_prod_min, cap_ac, wind_speed, config):
+def main(clr_idx_min, clr_prod_min, cap_ac, wind_speed, config, 
+         method = 'recursive'):
     """
     Status:
     TESTS LOOK GOOD, HAVE NOT TRIED HOURLY WIND SPEED
@@ -44,6 +69,9 @@ def main(clr_idx_min, clr_prod_min, cap_ac, wind_speed, config):
                  an anual average value (scalar)
     config - string of 'res', 'comm', or other  to determine if capacity or region
               should be used to set area
+    method - 'recursive' to run the filter minute by minute, or 'fft' to apply 
+              the transfer function of the plant in the frequency domain (see 
+              fft_smooth(), needs a scalar wind_speed)
     Output:
     pv_prod_min - TimeSeries of 1-min PV plant output in MW accounting for the 
                    within plant smoothing
@@ -52,27 +80,389 @@ def main(clr_idx_min, clr_prod_min, cap_ac, wind_speed, config):
     ####  or the area of the region
     alpha = filter_param(cap_ac, wind_speed, config)
 
-    if type(alpha) == float or type(alpha) == int:
-        alpha = pd.Series(alpha, index = clr_idx_min.index)
+    #### Apply an exponential filter to the 1-min TimeSeries 
+    if method == 'fft':
+        clr_idx_min_smooth, clr_idx_prev = fft_smooth(clr_idx_min, alpha)
+    else:
+        clr_idx_min_smooth, clr_idx_prev = smooth(clr_idx_min, alpha)
 
- 
-    #### Initialize the filter with  the first minute clearsky index
-    clr_idx_prev = clr_idx_min.ix[0]
+    #### Convert the smooted clearsky index into PV plant output, in the 
+    ####  precision of the clearsky index 
+    pv_prod_min = clr_idx_min_smooth * \
+        clr_prod_min.astype(clr_idx_min_smooth.dtype)
 
-    #### Initialize the smoothed output timeseries 
-    clr_idx_min_smooth = pd.Series(index = clr_idx_min.index, dtype = float)
+    return pv_prod_min
 
-    #### Apply an exponential filter to the 1-min TimeSeries 
-    for dt in clr_idx_min.index:
-        smooth_clr_idx = alpha[dt] * clr_idx_min[dt] + (1- alpha[dt]) * clr_idx_prev
-        clr_idx_min_smooth[dt] = smooth_clr_idx 
-        clr_idx_prev = smooth_clr_idx 
+def filter_block(clr_idx_min, clr_prod_min, alpha, clr_idx_prev = None):
+    """
+    Purpose:
+    Streaming version of main() for one block (e.g. a day or a week) of the 1-min
+     data.  The filter state is carried from one block to the next, so filtering 
+     the blocks in order gives the same output as main() on the full year.
 
-    #### Convert the smooted clearsky index into PV plant output
-    pv_prod_min = clr_idx_min_smooth * clr_prod_min
+    Input:
+    clr_idx_min - Timeseries of 1-min clearsky index for the block
+    clr_prod_min - Timeseries of 1-min clear sky production for the block
+    alpha - smoothing parameter from filter_param(), either a scalar or a 
+             TimeSeries that covers the block
+    clr_idx_prev - smoothed clearsky index of the minute before the block, 
+                    returned for the previous block (None for the first block)
+
+    Output:
+    pv_prod_min - TimeSeries of 1-min PV plant output for the block in MW
+    clr_idx_prev - smoothed clearsky index of the last minute of the block, to 
+                    pass with the next block
+    """
+    clr_idx_min_smooth, clr_idx_prev = smooth(clr_idx_min, alpha, clr_idx_prev)
+    pv_prod_min = clr_idx_min_smooth * \
+        clr_prod_min.reindex(clr_idx_min.index).astype(clr_idx_min_smooth.dtype)
+
+    return pv_prod_min, clr_idx_prev
+
+def batch_main(clr_idx_min, clr_prod_min, cap_ac, wind_speed, config, 
+               method = 'recursive'):
+    """
+    Purpose:
+    Batch version of main() for many plants at once: the 1-min data of every 
+     plant is one (minutes X sites) block and the filter runs over the sites 
+     axis as array operations, giving the same output as calling main() for 
+     each plant
+
+    Input:
+    clr_idx_min - DataFrame of the 1-min clearsky index (minutes X sites)
+    clr_prod_min - DataFrame of the 1-min clear sky production with the same 
+                    sites as columns
+    cap_ac - Plant AC nameplate in MW of each site (sequence in the order of the
+              columns of clr_idx_min, or a scalar for every site)
+    wind_speed - wind speed at the cloud height in m/s, a scalar, an hourly 
+                  TimeSeries shared by every site, or a DataFrame of the hourly 
+                  wind speed with a column for each site
+    config - configuration of each site ('res', 'comm' or other), sequence or 
+              a single string for every site
+    method - 'recursive' or 'fft', see main()
+
+    Output:
+    pv_prod_min - DataFrame of the 1-min PV plant output in MW (minutes X sites)
+    """
+    alpha = batch_filter_param(cap_ac, wind_speed, config, clr_idx_min.columns)
+    if method == 'fft':
+        clr_idx_min_smooth, clr_idx_prev = fft_smooth(clr_idx_min, alpha)
+        clr_prod_min = clr_prod_min.reindex(index = clr_idx_min.index, 
+                                            columns = clr_idx_min.columns)
+        return clr_idx_min_smooth * \
+            clr_prod_min.astype(clr_idx_min_smooth.values.dtype)
+
+    pv_prod_min, clr_idx_prev = batch_filter_block(clr_idx_min, clr_prod_min, 
+                                                   alpha)
 
     return pv_prod_min
 
+def batch_filter_block(clr_idx_min, clr_prod_min, alpha, clr_idx_prev = None):
+    """
+    Purpose:
+    Batch version of filter_block() for a block of the 1-min data of many plants
+
+    Input:
+    clr_idx_min - DataFrame of the 1-min clearsky index for the block 
+                   (minutes X sites)
+    clr_prod_min - DataFrame of the 1-min clear sky production with the same 
+                    sites as columns, covering the block
+    alpha - smoothing parameter from batch_filter_param()
+    clr_idx_prev - array of the smoothed clearsky index of each site for the 
+                    minute before the block (None for the first block)
+
+    Output:
+    pv_prod_min - DataFrame of the 1-min PV plant output for the block in MW
+    clr_idx_prev - array of the smoothed clearsky index of each site for the 
+                    last minute of the block, to pass with the next block
+    """
+    clr_idx_min_smooth, clr_idx_prev = batch_smooth(clr_idx_min, alpha, 
+                                                    clr_idx_prev)
+    clr_prod_min = clr_prod_min.reindex(index = clr_idx_min.index, 
+                                        columns = clr_idx_min.columns)
+    pv_prod_min = clr_idx_min_smooth * \
+        clr_prod_min.astype(clr_idx_min_smooth.values.dtype)
+
+    return pv_prod_min, clr_idx_prev
+
+def group_totals(clr_idx_min, clr_prod_min, cap_ac, wind_speed, config, 
+                 groups = None, method = 'recursive', 
+                 block_sites = TOTAL_SITES):
+    """
+    Purpose:
+    Total 1-min PV plant output of each group of sites (e.g. all 'res' sites), 
+     for when only the group totals are needed.  The sites are filtered 
+     block_sites at a time and added to the totals of their groups, so the 
+     output of every site is never held at once.
+
+    Input:
+    clr_idx_min, clr_prod_min, cap_ac, wind_speed, config, method - see 
+     batch_main()
+    groups - group label of each site (sequence in the order of the columns of 
+              clr_idx_min), by default the config of each site
+    block_sites - number of sites filtered at once (default TOTAL_SITES)
+
+    Output:
+    totals - DataFrame of the total 1-min PV plant output in MW of each group 
+              (minutes X group labels)
+    """
+    columns = clr_idx_min.columns
+    n_sites = len(columns)
+    if groups is None:
+        groups = config
+    groups = np.broadcast_to(np.asarray(groups), (n_sites,))
+
+    alpha = batch_filter_param(cap_ac, wind_speed, config, columns)
+
+    totals = pd.DataFrame(0., index = clr_idx_min.index, 
+                          columns = np.unique(groups))
+    for start in range(0, n_sites, block_sites):
+        cols = columns[start:start + block_sites]
+        if isinstance(alpha, GroupAlpha):
+            #### batch_smooth() picks the groups of the sites in the block
+            block_alpha = alpha
+        elif isinstance(alpha, pd.DataFrame):
+            block_alpha = alpha[cols]
+        else:
+            block_alpha = alpha[start:start + block_sites]
+
+        if method == 'fft':
+            smoothed, clr_idx_prev = fft_smooth(clr_idx_min[cols], block_alpha)
+        else:
+            smoothed, clr_idx_prev = batch_smooth(clr_idx_min[cols], block_alpha)
+        prod = clr_prod_min.reindex(index = clr_idx_min.index, columns = cols)
+        pv = smoothed.values * prod.values.astype(smoothed.values.dtype)
+
+        block_groups = groups[start:start + block_sites]
+        for label in np.unique(block_groups):
+            totals[label] += pv[:, block_groups == label].sum(axis = 1)
+
+    return totals
+
+class PlantFilter:
+    """
+    Purpose:
+     Stateful plant filter for data that arrives in blocks of any length (e.g.
+     the blocks of a streaming synthesis, or live data an hour or a few minutes 
+     at a time).  The filter holds the last smoothed clearsky index and alpha of
+     each site, so each block is filtered with constant memory, and filtering 
+     the blocks in order gives exactly the output of one pass over the full 
+     series (see batch_smooth()).  The state can be saved and restored, e.g. to
+     continue after a restart. 
+
+    Input:
+    alpha - smoothing parameter from batch_filter_param(): a scalar, an array 
+             with the constant alpha of each site, a GroupAlpha, or a DataFrame
+             of the 1-min alpha (minutes X sites) or a TimeSeries shared by 
+             every site.  
+             Minutes of a block after the last time of a time-varying alpha 
+             keep the last alpha of the site, and minutes before its first time
+             (e.g. the first 30 minutes of hourly wind labelled at the half 
+             hour) take the first alpha of the site (see minute_alpha()). 
+    columns - optional site ids; blocks are filtered in the order of these 
+               columns
+    clr_idx_prev - optional smoothed clearsky index of each site before the 
+                    first block, otherwise the filter starts from the first 
+                    minute of the first block
+
+    Data:
+    clr_idx_prev - array of the smoothed clearsky index of each site for the 
+                    last minute filtered 
+    alpha_last - array of the alpha of each site for the last minute filtered
+    last_time - time of the last minute filtered; the next block must start 
+                 one minute later 
+
+    Methods:
+    update(clr_idx_min, clr_prod_min) - filter the next block, returning the
+                                         1-min PV plant output (or the smoothed
+                                         clearsky index without clr_prod_min)
+    get_state() - dictionary of the state of the filter 
+    set_state(state) - restore a state from get_state()
+    save(file_name) - save the state to a file, see load_filter() 
+    """
+    def __init__(self, alpha, columns = None, clr_idx_prev = None):
+        self.alpha = alpha
+        self.columns = columns
+        self.clr_idx_prev = None
+        self.alpha_last = None
+        self.last_time = None
+        if clr_idx_prev is not None:
+            self.clr_idx_prev = np.atleast_1d(np.asarray(clr_idx_prev, 
+                                                         dtype = float))
+
+    def update(self, clr_idx_min, clr_prod_min = None):
+        """
+        Purpose:
+        Filter the next block of the 1-min clearsky index 
+
+        Input:
+        clr_idx_min - DataFrame of the 1-min clearsky index for the block 
+                       (minutes X sites), or a TimeSeries for a single site
+        clr_prod_min - optional clear sky production (DataFrame with the same 
+                        sites, or TimeSeries) covering the block 
+
+        Output:
+        pv_prod_min - 1-min PV plant output for the block in MW, or the smoothed
+                       clearsky index if clr_prod_min is not given, with the 
+                       same type as clr_idx_min 
+
+        Raises ValueError if the block does not start one minute after the last
+         minute filtered (a block repeated, overlapping or skipped)
+        """
+        is_series = isinstance(clr_idx_min, pd.Series)
+        if is_series:
+            clr_idx_min = pd.DataFrame(clr_idx_min)
+            if clr_prod_min is not None:
+                clr_prod_min = pd.DataFrame(clr_prod_min)
+                clr_prod_min.columns = clr_idx_min.columns
+        elif self.columns is not None:
+            clr_idx_min = clr_idx_min[self.columns]
+
+        if len(clr_idx_min) == 0:
+            out = clr_idx_min
+        else:
+            #### The smoothed clearsky index carried over is that of the minute
+            ####  before the block only if the blocks follow each other 
+            if self.last_time is not None and clr_idx_min.index[0] != \
+                    self.last_time + pd.Timedelta(minutes = 1):
+                raise ValueError("The block starts at %s, not one minute after "
+                                 "the last minute filtered (%s)" % 
+                                 (clr_idx_min.index[0], self.last_time))
+            alpha = self.block_alpha(clr_idx_min)
+            out, self.clr_idx_prev = batch_smooth(clr_idx_min, alpha, 
+                                                  self.clr_idx_prev)
+            self.last_time = clr_idx_min.index[-1]
+
+            if clr_prod_min is not None:
+                clr_prod_min = clr_prod_min.reindex(index = clr_idx_min.index,
+                                                    columns = clr_idx_min.columns)
+                out = out * clr_prod_min.astype(out.values.dtype)
+
+        if is_series:
+            out = out.iloc[:, 0]
+
+        return out
+
+    def block_alpha(self, clr_idx_min):
+        """
+        Purpose:
+        Alpha of each site for the minutes of a block, and keep the alpha of the
+         last minute 
+        """
+        n_sites = clr_idx_min.shape[1]
+        if isinstance(self.alpha, (pd.Series, pd.DataFrame, GroupAlpha)):
+            #### Blocks may lie anywhere relative to the alpha, e.g. live data 
+            ####  past the last wind speed
+            if isinstance(self.alpha, GroupAlpha):
+                alpha = self.alpha.sites(clr_idx_min.index, clr_idx_min.columns,
+                                         max_gap = None)
+            else:
+                alpha = minute_alpha(self.alpha, clr_idx_min.index, 
+                                     max_gap = None)
+            if isinstance(self.alpha, pd.Series):
+                alpha = pd.DataFrame(dict((id, alpha) for id in 
+                                          clr_idx_min.columns), 
+                                     columns = clr_idx_min.columns)
+            else:
+                alpha = alpha.reindex(columns = clr_idx_min.columns)
+            if self.alpha_last is not None:
+                alpha = alpha.fillna(pd.Series(self.alpha_last, 
+                                               index = alpha.columns))
+            self.alpha_last = alpha.values[-1].astype(float)
+        else:
+            alpha = np.broadcast_to(np.asarray(self.alpha, dtype = float), 
+                                    (n_sites,))
+            self.alpha_last = alpha.copy()
+
+        return alpha
+
+    def get_state(self):
+        return {'columns': None if self.columns is None else list(self.columns),
+                'clr_idx_prev': self.clr_idx_prev, 
+                'alpha_last': self.alpha_last,
+                'last_time': self.last_time}
+
+    def set_state(self, state):
+        if state['columns'] is not None:
+            self.columns = state['columns']
+        self.clr_idx_prev = state['clr_idx_prev']
+        self.alpha_last = state['alpha_last']
+        self.last_time = state['last_time']
+
+    def save(self, file_name):
+        #### Write to a temporary file first so that the file is always complete
+        tmp_file = file_name + '.%s.tmp' % os.getpid()
+        save_file = open(tmp_file, 'wb')
+        cPickle.dump(self.get_state(), save_file, cPickle.HIGHEST_PROTOCOL)
+        save_file.close()
+        os.rename(tmp_file, file_name)
+
+def load_filter(file_name, alpha):
+    """
+    Purpose:
+    Restore a PlantFilter saved with PlantFilter.save() 
+
+    Input:
+    file_name - file written by PlantFilter.save()
+    alpha - smoothing parameter for the filter, see PlantFilter 
+
+    Output:
+    plant_filter - PlantFilter that continues after the last block filtered 
+                    before it was saved 
+    """
+    plant_filter = PlantFilter(alpha)
+    plant_filter.set_state(cPickle.load(open(file_name, 'rb')))
+
+    return plant_filter
+
+class GroupAlpha:
+    """
+    Purpose:
+     Time-varying smoothing parameter of many sites, stored once for each group
+     of sites with the same alpha (see batch_filter_param()) instead of as a 
+     (minutes X sites) DataFrame.  For a year of many sites with a few wind 
+     speed series the groups are a small fraction of the sites, and the alpha of
+     the sites is only expanded for a block at a time.
+
+    Input:
+    alpha - DataFrame of the 1-min alpha of each group (minutes X groups)
+    site_group - array with the column of alpha (group) of each site 
+    columns - site ids in the order of site_group
+
+    Data:
+    alpha, site_group, columns, index (the minutes of alpha)
+
+    Methods:
+    groups(columns) - array of the group of each site in columns
+    minutes(index, max_gap) - array (minutes X groups) of the alpha of each 
+                               group for the minutes of index (see 
+                               minute_alpha())
+    sites(index, columns, max_gap) - DataFrame (minutes X sites) of the alpha of
+                                      each site in columns for the minutes of 
+                                      index
+    """
+    def __init__(self, alpha, site_group, columns):
+        self.alpha = alpha
+        self.site_group = np.asarray(site_group, dtype = int)
+        self.columns = pd.Index(columns)
+        self.index = alpha.index
+
+    def groups(self, columns):
+        pos = self.columns.get_indexer(columns)
+        if (pos < 0).any():
+            raise KeyError("No alpha for sites %s" % 
+                           list(np.asarray(columns)[pos < 0]))
+
+        return self.site_group[pos]
+
+    def minutes(self, index, max_gap = ALPHA_EDGE_MINUTES):
+        return minute_alpha(self.alpha, index, max_gap).values.astype(float)
+
+    def sites(self, index, columns, max_gap = ALPHA_EDGE_MINUTES):
+        alpha = self.minutes(index, max_gap)[:, self.groups(columns)]
+
+        return pd.DataFrame(alpha, index = index, columns = columns)
+
 
 ##################################################
 #
@@ -137,6 +527,402 @@ def filter_param(cap_ac, u, config):
 
     return alpha
 
+def batch_filter_param(cap_ac, u, config, columns = None):
+    """
+    Purpose:
+    Array version of filter_param() for many plants at once 
+
+    Input:
+    cap_ac - PV plant capacity of each site in MW (sequence or scalar)
+    u - wind speed in m/s: a scalar, an hourly TimeSeries shared by every site, 
+         or a DataFrame of the hourly wind speed with a column for each site
+    config - configuration of each site (sequence or a single string)
+    columns - optional site ids, used to label the sites of the alpha and to 
+               pick the columns of a wind speed DataFrame 
+
+    Output:
+    alpha - array with the constant alpha of each site for a scalar wind speed,
+             otherwise a GroupAlpha with the 1-min alpha of each group of sites,
+             the same values as filter_param() for each site
+
+    Sites with the same smoothing area and the same wind speed (e.g. every 'res'
+     and 'comm' site, which share one fixed area) have the same alpha, so the 
+     hourly alpha is calculated and upscaled to minutes once for each group, and
+     the alpha of the sites is only expanded from the groups for the minutes 
+     being filtered (see batch_smooth()).
+    """
+    if isinstance(u, pd.DataFrame) and columns is None:
+        columns = u.columns
+
+    cap_ac = np.asarray(cap_ac, dtype = float)
+    config = np.asarray(config)
+    n_sites = max(cap_ac.size, config.size, 
+                  0 if columns is None else len(columns))
+    cap_ac = np.broadcast_to(cap_ac, (n_sites,))
+    config = np.broadcast_to(config, (n_sites,))
+
+    #### Plant or region area (m^2) of each site, see filter_param()
+    area = np.where((config == 'res') | (config == 'comm'), 123. * 10**6, 
+                    cap_ac * 69897.)
+    l = area ** 0.5
+
+    if np.isscalar(u):
+        Tc = l/u / 60. # min
+        return 1./(Tc/(2*np.pi) + 1.)
+
+    #### Group the sites by their area and wind speed series 
+    if isinstance(u, pd.DataFrame):
+        u_hr = u[columns].values.astype(float)
+        wind_keys = [hashlib.sha1(np.ascontiguousarray(u_hr[:, j]).tostring()
+                                  ).hexdigest() for j in range(n_sites)]
+    else:
+        u_hr = np.asarray(u, dtype = float)[:, np.newaxis]
+        wind_keys = [None] * n_sites
+    group_index = {}
+    first = []
+    site_group = np.empty(n_sites, dtype = int)
+    for j, key in enumerate(zip(l, wind_keys)):
+        if key not in group_index:
+            group_index[key] = len(first)
+            first.append(j)
+        site_group[j] = group_index[key]
+
+    #### Hourly cut-off period of each group
+    if u_hr.shape[1] > 1:
+        u_hr = u_hr[:, first]
+    Tc = l[first]/u_hr / 60. # min
+    alpha = pd.DataFrame(1./(Tc/(2*np.pi) + 1.), index = u.index)
+
+    #### Upscale from hourly values to minute values for every group at once
+    alpha = alpha.resample('1Min')
+    alpha = alpha.interpolate(method = 'time')
+    if columns is None:
+        columns = np.arange(n_sites)
+
+    return GroupAlpha(alpha, site_group, columns)
+
+def smooth(clr_idx_min, alpha, clr_idx_prev = None):
+    """
+    Purpose:
+    Exponential filter of the 1-min clearsky index 
+
+    Input:
+    clr_idx_min - Timeseries of 1-min clearsky index 
+    alpha - smoothing parameter, either a scalar or a TimeSeries covering the 
+             index of clr_idx_min to within ALPHA_EDGE_MINUTES (see 
+             minute_alpha())
+    clr_idx_prev - smoothed value before the first minute, or None to start the 
+                    filter from the first minute of clearsky index
+
+    Output:
+    clr_idx_min_smooth - TimeSeries of the smoothed 1-min clearsky index, in the
+                          precision of clr_idx_min (float32 or float64)
+    clr_idx_prev - smoothed value of the last minute 
+
+    The filter is y[t] = alpha[t] * x[t] + (1 - alpha[t]) * y[t-1], calculated in
+     double precision.  A constant alpha is run through scipy's lfilter, which 
+     does the same operations in the same order as the recursion, so the result
+     is identical to stepping through each minute.  A time-varying alpha uses 
+     first_order_scan(), which agrees with the recursion to rounding error.
+    """
+    x = clr_idx_min.values.astype(float)
+
+    #### Initialize the filter with  the first minute clearsky index
+    if clr_idx_prev is None:
+        clr_idx_prev = x[0]
+
+    if np.isscalar(alpha):
+        alpha = float(alpha)
+        y, zf = lfilter([alpha], [1., -(1. - alpha)], x,
+                        zi = [(1. - alpha) * clr_idx_prev])
+    else:
+        alpha = minute_alpha(alpha, clr_idx_min.index).values.astype(float)
+        y = first_order_scan(alpha, x, clr_idx_prev)
+
+    if len(y) > 0:
+        clr_idx_prev = y[-1]
+
+    #### The smoothed output timeseries 
+    clr_idx_min_smooth = pd.Series(y.astype(clr_idx_min.dtype), 
+                                   index = clr_idx_min.index)
+
+    return clr_idx_min_smooth, clr_idx_prev
+
+def batch_smooth(clr_idx_min, alpha, clr_idx_prev = None):
+    """
+    Purpose:
+    Exponential filter of the 1-min clearsky index of many sites at once, the
+     same as smooth() for each site
+
+    Input:
+    clr_idx_min - DataFrame of the 1-min clearsky index (minutes X sites)
+    alpha - from batch_filter_param(): a scalar or array with a constant alpha 
+             for each site, or a GroupAlpha or a DataFrame of the 1-min alpha 
+             (minutes X sites) with each site of clr_idx_min, covering its index
+             to within ALPHA_EDGE_MINUTES (see minute_alpha())
+    clr_idx_prev - array of the smoothed value of each site before the first 
+                    minute, or None to start from the first minute 
+
+    Output:
+    clr_idx_min_smooth - DataFrame of the smoothed 1-min clearsky index, in the
+                          precision of clr_idx_min
+    clr_idx_prev - array of the smoothed value of each site for the last minute
+
+    A constant alpha runs through lfilter for all of the sites with the same 
+     alpha, and a time-varying alpha steps through the minutes with each step 
+     done for all of the sites at once (site_recursion()).  Both do the exact 
+     operations of the recursion, so the result does not depend on how the 
+     minutes are split into blocks. 
+    """
+    x = clr_idx_min.values.astype(float)
+    n_sites = x.shape[1]
+
+    #### Initialize the filter with  the first minute clearsky index
+    if clr_idx_prev is None:
+        clr_idx_prev = x[0]
+    clr_idx_prev = np.array(np.broadcast_to(clr_idx_prev, (n_sites,)), 
+                            dtype = float)
+
+    if isinstance(alpha, GroupAlpha):
+        y = site_recursion(alpha.minutes(clr_idx_min.index), x, clr_idx_prev,
+                           alpha.groups(clr_idx_min.columns))
+    elif isinstance(alpha, pd.DataFrame):
+        alpha = minute_alpha(alpha, clr_idx_min.index)[clr_idx_min.columns]
+        y = site_recursion(alpha.values.astype(float), x, clr_idx_prev)
+    else:
+        #### Run lfilter (see smooth()) once for all of the sites with the same 
+        ####  alpha 
+        alpha = np.broadcast_to(np.asarray(alpha, dtype = float), (n_sites,))
+        y = np.empty(x.shape)
+        for a in np.unique(alpha):
+            cols = np.flatnonzero(alpha == a)
+            y[:, cols], zf = lfilter([a], [1., -(1. - a)], x[:, cols], axis = 0,
+                                     zi = [(1. - a) * clr_idx_prev[cols]])
+
+    if len(y) > 0:
+        clr_idx_prev = y[-1]
+
+    clr_idx_min_smooth = pd.DataFrame(y.astype(clr_idx_min.values.dtype), 
+                                      index = clr_idx_min.index, 
+                                      columns = clr_idx_min.columns)
+
+    return clr_idx_min_smooth, clr_idx_prev
+
+def fft_smooth(clr_idx_min, alpha, clr_idx_prev = None):
+    """
+    Purpose:
+    Frequency-domain version of smooth() and batch_smooth() for a constant 
+     alpha, where the plant is a linear time-invariant low-pass filter.  The 
+     full series of each site is transformed with one FFT and multiplied by the
+     transfer function of the plant (transfer_function()).  The inverse 
+     transform is the periodic solution of the filter, y_circ, which has its 
+     own starting value y_circ[-1] = y_circ[n-1].  The difference from the 
+     output with the actual starting value decays by (1 - alpha) each minute, 
+     so the start-up transient is added exactly:
+         y[t] = y_circ[t] + (1 - alpha)**(t+1) * (y[-1] - y_circ[n-1])
+     The result agrees with the recursion to rounding error of the FFT. 
+
+    Input:
+    clr_idx_min - TimeSeries, or DataFrame (minutes X sites), of the 1-min 
+                   clearsky index
+    alpha - constant smoothing parameter, a scalar or an array with one value 
+             for each site
+    clr_idx_prev - smoothed value (of each site) before the first minute, or 
+                    None to start from the first minute 
+
+    Output:
+    clr_idx_min_smooth - smoothed 1-min clearsky index, the same type and 
+                          precision as clr_idx_min 
+    clr_idx_prev - smoothed value (of each site) for the last minute 
+    """
+    if isinstance(alpha, (pd.Series, pd.DataFrame, GroupAlpha)) or \
+            not np.isscalar(alpha) and np.ndim(alpha) > 1:
+        raise ValueError("fft_smooth() needs a constant alpha for each site, "
+                         "use smooth() for a time-varying alpha")
+
+    x = clr_idx_min.values.astype(float)
+    is_series = x.ndim == 1
+    if is_series:
+        x = x[:, np.newaxis]
+    n, n_sites = x.shape
+
+    if clr_idx_prev is None:
+        clr_idx_prev = x[0]
+    clr_idx_prev = np.broadcast_to(np.asarray(clr_idx_prev, dtype = float), 
+                                   (n_sites,))
+    alpha = np.broadcast_to(np.asarray(alpha, dtype = float), (n_sites,))
+
+    freqs = np.fft.rfftfreq(n, DT)
+    t = np.arange(1, n + 1)[:, np.newaxis]
+    y = np.empty(x.shape)
+    for start in range(0, n_sites, FFT_SITES):
+        cols = slice(start, start + FFT_SITES)
+        H = transfer_function(alpha[cols], freqs)
+        y_circ = np.fft.irfft(np.fft.rfft(x[:, cols], axis = 0) * H, n, axis = 0)
+
+        #### Start-up transient from the actual starting value 
+        y[:, cols] = y_circ + (1. - alpha[cols]) ** t * \
+            (clr_idx_prev[cols] - y_circ[-1])
+
+    if n > 0:
+        clr_idx_prev = y[-1]
+
+    if is_series:
+        clr_idx_min_smooth = pd.Series(y[:, 0].astype(clr_idx_min.dtype), 
+                                       index = clr_idx_min.index)
+        clr_idx_prev = clr_idx_prev[0]
+    else:
+        clr_idx_min_smooth = pd.DataFrame(y.astype(clr_idx_min.values.dtype), 
+                                          index = clr_idx_min.index, 
+                                          columns = clr_idx_min.columns)
+
+    return clr_idx_min_smooth, clr_idx_prev
+
+def minute_alpha(alpha, index, max_gap = ALPHA_EDGE_MINUTES):
+    """
+    Purpose:
+    Alpha for each minute of the 1-min data from the alpha of filter_param() or 
+     batch_filter_param(), which only spans the first to the last time of the 
+     wind speed: e.g. hourly wind labelled at the half hour leaves the first 30 
+     and the last 29 minutes of the 1-min data uncovered.  Minutes between the 
+     times of alpha take the alpha of the minute before, minutes after its last
+     time take the last alpha and minutes before its first time the first alpha.
+
+    Input:
+    alpha - TimeSeries, or DataFrame (minutes X sites), of the 1-min alpha 
+    index - DatetimeIndex of the 1-min data
+    max_gap - most minutes the index may extend beyond the first or last time of
+               alpha, or None for no limit 
+
+    Output:
+    alpha - alpha reindexed to index, without any missing minutes 
+
+    Raises ValueError if the index extends more than max_gap minutes beyond 
+     alpha, e.g. wind speed for another year than the clearsky index 
+    """
+    if max_gap is not None and len(index) > 0:
+        gap = pd.Timedelta(minutes = max_gap)
+        if len(alpha) == 0 or index[0] < alpha.index[0] - gap or \
+                index[-1] > alpha.index[-1] + gap:
+            raise ValueError("The wind speed (%s to %s) does not cover the "
+                             "1-min data (%s to %s)" % 
+                             (alpha.index[0] if len(alpha) else None,
+                              alpha.index[-1] if len(alpha) else None,
+                              index[0], index[-1]))
+
+    #### Only the minutes before the first time of alpha are left missing by the
+    ####  forward fill, which may be the whole of a short block
+    minute = alpha.reindex(index, method = 'ffill')
+    if len(alpha) > 0:
+        minute = minute.fillna(alpha.iloc[0])
+
+    return minute
+
+def transfer_function(alpha, freqs):
+    """
+    Purpose:
+    Frequency response of the plant filter with a constant alpha, 
+     y[t] = alpha * x[t] + (1 - alpha) * y[t-1] with 1-min steps: 
+         H(f) = alpha / (1 - (1 - alpha) * exp(-2*pi*i*f*DT))
+     The PSD of the plant output is abs(H)**2 times the PSD of the clearsky 
+     index at the point (and the spectral amplitudes scale by abs(H)), which is
+     the gain to fold the plant smoothing into the site PSD of a synthesis.
+
+    Input:
+    alpha - constant smoothing parameter, a scalar or an array of sites 
+    freqs - array of frequencies in Hz (up to the Nyquist frequency 1/120 Hz)
+
+    Output:
+    H - complex gain, array (freqs) for a scalar alpha or (freqs X sites)
+    """
+    alpha = np.asarray(alpha, dtype = float)
+    z = np.exp(-2j * np.pi * np.asarray(freqs, dtype = float) * DT)
+    if alpha.ndim > 0:
+        z = z[:, np.newaxis]
+
+    return alpha / (1. - (1. - alpha) * z)
+
+def site_recursion(alpha, x, y_prev, site_group = None):
+    """
+    Purpose:
+    Run the filter y[t] = alpha[t] * x[t] + (1 - alpha[t]) * y[t-1] one minute 
+     at a time with each minute done for all of the sites as one array 
+     operation, so the loop overhead is that of one site however many sites 
+     there are, and the result is exactly that of the recursion
+
+    Input:
+    alpha - array of the smoothing parameter (minutes X sites), or (minutes X 
+             groups) with site_group
+    x - array of the input (minutes X sites)
+    y_prev - array of the filter output of each site before the first minute 
+    site_group - optional array with the column of alpha of each site, which is
+                  picked for each minute so the alpha of the sites is never 
+                  held for every minute
+
+    Output:
+    y - array of the filter output (minutes X sites)
+    """
+    y = np.empty(x.shape)
+    step = np.empty(x.shape[1:])
+    if site_group is None:
+        c = alpha * x
+        m = 1. - alpha
+        for t in range(len(x)):
+            np.multiply(m[t], y_prev, out = step)
+            np.add(c[t], step, out = y[t])
+            y_prev = y[t]
+    else:
+        a = np.empty(x.shape[1:])
+        c = np.empty(x.shape[1:])
+        for t in range(len(x)):
+            np.take(alpha[t], site_group, out = a)
+            np.multiply(a, x[t], out = c)
+            np.subtract(1., a, out = a)
+            np.multiply(a, y_prev, out = step)
+            np.add(c, step, out = y[t])
+            y_prev = y[t]
+
+    return y
+
+def first_order_scan(alpha, x, y_prev):
+    """
+    Purpose:
+    Run the filter y[t] = alpha[t] * x[t] + (1 - alpha[t]) * y[t-1] with a 
+     time-varying alpha as array operations.  Each minute is the linear map 
+     y -> m * y + c with m = 1 - alpha and c = alpha * x.  Within each chunk of 
+     SCAN_CHUNK minutes the maps are combined with a prefix scan (log2 of the 
+     chunk length array steps, without any division so it stays stable for 
+     alpha close to 1), and the value at the end of each chunk starts the next.
+
+    Input:
+    alpha - array of the smoothing parameter for each minute (minutes, or 
+             minutes X sites)
+    x - array of the input for each minute (minutes, or minutes X sites)
+    y_prev - filter output before the first minute (scalar, or one per site)
+
+    Output:
+    y - array of the filter output for each minute (and site)
+    """
+    n = len(x)
+    y = np.empty(x.shape)
+    for start in range(0, n, SCAN_CHUNK):
+        stop = min(start + SCAN_CHUNK, n)
+        m = 1. - alpha[start:stop]
+        c = alpha[start:stop] * x[start:stop]
+
+        #### Inclusive scan: after the step with shift k each minute holds the 
+        ####  map of the last 2k minutes up to and including it
+        k = 1
+        while k < stop - start:
+            c[k:] = m[k:] * c[:-k] + c[k:]
+            m[k:] = m[k:] * m[:-k]
+            k *= 2
+
+        y[start:stop] = m * y_prev + c
+        y_prev = y[stop - 1]
+
+    return y
+
 def test():
     """
     Run a test with the inputs, call the main function,
@@ -198,6 +984,268 @@ def test():
     
     return pv_prod_min
 
+def recursive_smooth(x, alpha, y_prev):
+    """
+    Purpose:
+    Reference filter stepping through each minute in a python loop, for the 
+     checks of the array versions
+    """
+    alpha = np.broadcast_to(np.asarray(alpha, dtype = float), np.shape(x))
+    y = np.empty(np.shape(x))
+    for t in range(len(x)):
+        y_prev = alpha[t] * x[t] + (1. - alpha[t]) * y_prev
+        y[t] = y_prev
+
+    return y
+
+def test_hourly_wind():
+    """
+    Check the filter with hourly wind labelled at the half hour, which does not
+     cover the first 30 and the last 29 minutes of the 1-min data: the output 
+     has no NaN and matches the loop over each minute with the first and last 
+     alpha carried to the edges, and wind speed for another year raises
+    """
+    rs = np.random.RandomState(0)
+    index = pd.date_range('1/1/2004', periods = 2*1440, freq = 'min')
+    clr_idx_min = pd.Series(rs.uniform(0.2, 1.2, len(index)), index = index)
+    clr_prod_min = pd.Series(100., index = index)
+    wind_speed = pd.Series(rs.uniform(1, 8, 48), 
+                           index = pd.date_range('1/1/2004 00:30', periods = 48,
+                                                 freq = 'H'))
+    cap_ac = 20.
+
+    pv_prod_min = main(clr_idx_min, clr_prod_min, cap_ac, wind_speed, 'utility')
+    assert not pv_prod_min.isnull().any()
+
+    alpha = filter_param(cap_ac, wind_speed, 'utility')
+    edge_alpha = [alpha[min(max(t, alpha.index[0]), alpha.index[-1])] 
+                  for t in index]
+    y = recursive_smooth(clr_idx_min.values, edge_alpha, clr_idx_min.values[0])
+    err = np.abs(pv_prod_min.values - y * clr_prod_min.values).max()
+    assert err < 1e-10, err
+
+    wind_speed.index = wind_speed.index + pd.DateOffset(years = 1)
+    try:
+        main(clr_idx_min, clr_prod_min, cap_ac, wind_speed, 'utility')
+        assert False, "wind speed for another year was used"
+    except ValueError:
+        pass
+
+    return err
+
+def test_batch_hourly_wind():
+    """
+    Check batch_main() with a DataFrame of hourly wind labelled at the half 
+     hour against main() for each site, and that wind speed for another year 
+     raises
+    """
+    rs = np.random.RandomState(1)
+    index = pd.date_range('1/1/2004', periods = 2*1440, freq = 'min')
+    ids = ['a', 'b', 'c', 'd']
+    clr_idx_min = pd.DataFrame(rs.uniform(0.2, 1.2, (len(index), 4)), 
+                               index = index, columns = ids)
+    clr_prod_min = pd.DataFrame(100., index = index, columns = ids)
+    hour_index = pd.date_range('1/1/2004 00:30', periods = 48, freq = 'H')
+    wind_speed = pd.DataFrame(rs.uniform(1, 8, (48, 4)), index = hour_index,
+                              columns = ids)
+    wind_speed['c'] = wind_speed['a']
+    cap_ac = [20., 5., 20., 1.]
+    config = ['utility', 'utility', 'utility', 'res']
+
+    pv_prod_min = batch_main(clr_idx_min, clr_prod_min, cap_ac, wind_speed, 
+                             config)
+    assert not pv_prod_min.isnull().values.any()
+    err = 0.
+    for j, id in enumerate(ids):
+        pv_site = main(clr_idx_min[id], clr_prod_min[id], cap_ac[j], 
+                       wind_speed[id], config[j])
+        err = max(err, np.abs(pv_prod_min[id].values - pv_site.values).max())
+    assert err < 1e-10, err
+
+    wind_speed.index = wind_speed.index + pd.DateOffset(years = 1)
+    try:
+        batch_main(clr_idx_min, clr_prod_min, cap_ac, wind_speed, config)
+        assert False, "wind speed for another year was used"
+    except ValueError:
+        pass
+
+    return err
+
+def test_fft_smooth():
+    """
+    Check fft_smooth() against the loop over each minute for a scalar alpha and
+     for a different alpha at each site, starting from the first minute and 
+     from a given smoothed value, and that the 'fft' method of main() and 
+     batch_main() gives the output of the 'recursive' one.  A time-varying 
+     alpha raises.
+    """
+    rs = np.random.RandomState(3)
+    index = pd.date_range('1/1/2004', periods = 1440, freq = 'min')
+    ids = ['a', 'b', 'c']
+    clr_idx_min = pd.DataFrame(rs.uniform(0.2, 1.2, (len(index), 3)), 
+                               index = index, columns = ids)
+    x = clr_idx_min.values
+
+    err = 0.
+    for alpha in [0.3, np.array([0.05, 0.5, 0.99])]:
+        for clr_idx_prev in [None, np.array([0., 1., 2.])]:
+            smoothed, y_last = fft_smooth(clr_idx_min, alpha, clr_idx_prev)
+            y_prev = x[0] if clr_idx_prev is None else clr_idx_prev
+            site_alpha = np.broadcast_to(alpha, (3,))
+            y = np.column_stack([recursive_smooth(x[:, j], site_alpha[j], 
+                                                  y_prev[j]) for j in range(3)])
+            err = max(err, np.abs(smoothed.values - y).max(), 
+                      np.abs(y_last - y[-1]).max())
+
+    smoothed, y_last = fft_smooth(clr_idx_min['a'], 0.3, 0.5)
+    y = recursive_smooth(x[:, 0], 0.3, 0.5)
+    err = max(err, np.abs(smoothed.values - y).max(), abs(y_last - y[-1]))
+    assert err < 1e-10, err
+
+    clr_prod_min = pd.DataFrame(100., index = index, columns = ids)
+    cap_ac = [20., 5., 1.]
+    config = ['utility', 'utility', 'res']
+    pv = {}
+    for method in ['recursive', 'fft']:
+        pv[method] = batch_main(clr_idx_min, clr_prod_min, cap_ac, 3., config,
+                                method = method)
+    err = max(err, np.abs(pv['fft'].values - pv['recursive'].values).max())
+    pv_site = main(clr_idx_min['b'], clr_prod_min['b'], cap_ac[1], 3., 
+                   config[1], method = 'fft')
+    err = max(err, np.abs(pv_site.values - pv['recursive']['b'].values).max())
+    assert err < 1e-8, err
+
+    try:
+        fft_smooth(clr_idx_min, pd.DataFrame(0.3, index = index, columns = ids))
+        assert False, "a time-varying alpha was used"
+    except ValueError:
+        pass
+
+    return err
+
+def test_plant_filter():
+    """
+    Check that PlantFilter gives the output of one pass of batch_main() when 
+     the 1-min data arrives in uneven blocks, the first of which ends before 
+     the first time of the hourly wind (labelled at the half hour), and when the
+     filter is saved and restored between blocks.  filter_block() over the same
+     blocks of one site gives the output of main().
+    """
+    rs = np.random.RandomState(2)
+    index = pd.date_range('1/1/2004', periods = 2*1440, freq = 'min')
+    ids = ['a', 'b', 'c']
+    clr_idx_min = pd.DataFrame(rs.uniform(0.2, 1.2, (len(index), 3)), 
+                               index = index, columns = ids)
+    clr_prod_min = pd.DataFrame(100., index = index, columns = ids)
+    wind_speed = pd.DataFrame(rs.uniform(1, 8, (48, 3)), columns = ids,
+                              index = pd.date_range('1/1/2004 00:30', 
+                                                    periods = 48, freq = 'H'))
+    cap_ac = [20., 5., 1.]
+    config = ['utility', 'utility', 'res']
+
+    pv_prod_min = batch_main(clr_idx_min, clr_prod_min, cap_ac, wind_speed, 
+                             config)
+
+    alpha = batch_filter_param(cap_ac, wind_speed, config, ids)
+    plant_filter = PlantFilter(alpha, ids)
+    state_file = os.path.join(tempfile.gettempdir(), 
+                              'plant_filter_%s.pkl' % os.getpid())
+    blocks = []
+    edges = [0, 17, 17, 700, 1441, len(index)]
+    for start, stop in zip(edges[:-1], edges[1:]):
+        blocks.append(plant_filter.update(clr_idx_min.iloc[start:stop], 
+                                          clr_prod_min.iloc[start:stop]))
+        plant_filter.save(state_file)
+        plant_filter = load_filter(state_file, alpha)
+    os.remove(state_file)
+    pv_blocks = pd.concat(blocks)
+
+    assert not pv_blocks.isnull().values.any()
+    err = np.abs(pv_blocks.values - pv_prod_min.values).max()
+    assert err < 1e-10, err
+
+    #### A block that repeats, overlaps or skips minutes is refused, and the 
+    ####  state is left as it was 
+    plant_filter = PlantFilter(alpha, ids)
+    plant_filter.update(clr_idx_min.iloc[:60])
+    for start, stop in [(0, 60), (30, 90), (61, 120)]:
+        try:
+            plant_filter.update(clr_idx_min.iloc[start:stop])
+            assert False, (start, stop)
+        except ValueError:
+            pass
+    assert plant_filter.last_time == index[59]
+    plant_filter.update(clr_idx_min.iloc[60:120])
+
+    site_alpha = filter_param(cap_ac[0], wind_speed['a'], config[0])
+    blocks = []
+    clr_idx_prev = None
+    for start, stop in zip(edges[:-1], edges[1:]):
+        if stop > start:
+            pv_block, clr_idx_prev = filter_block(
+                clr_idx_min['a'].iloc[start:stop], clr_prod_min['a'], 
+                site_alpha, clr_idx_prev)
+            blocks.append(pv_block)
+    pv_site = main(clr_idx_min['a'], clr_prod_min['a'], cap_ac[0], 
+                   wind_speed['a'], config[0])
+    err = max(err, np.abs(pd.concat(blocks).values - pv_site.values).max())
+    assert err < 1e-10, err
+
+    return err
+
+def test_group_alpha():
+    """
+    Check that batch_filter_param() keeps one alpha for each group of sites with
+     the same area and wind speed, that the alpha of each site is that of 
+     filter_param(), that filtering with the groups is exactly filtering with 
+     the alpha of each site, and that group_totals() (over several blocks of 
+     sites) is the sum of batch_main() over the sites of each group
+    """
+    rs = np.random.RandomState(4)
+    index = pd.date_range('1/1/2004', periods = 1440, freq = 'min')
+    ids = ['a', 'b', 'c', 'd', 'e', 'f']
+    clr_idx_min = pd.DataFrame(rs.uniform(0.2, 1.2, (len(index), 6)), 
+                               index = index, columns = ids)
+    clr_prod_min = pd.DataFrame(rs.uniform(50, 100, (len(index), 6)), 
+                                index = index, columns = ids)
+    wind_speed = pd.DataFrame(rs.uniform(1, 8, (24, 6)), columns = ids,
+                              index = pd.date_range('1/1/2004 00:30', 
+                                                    periods = 24, freq = 'H'))
+    for id in ['b', 'c', 'e']:
+        wind_speed[id] = wind_speed['a']
+    cap_ac = [20., 20., 5., 1., 1., 3.]
+    config = ['utility', 'utility', 'utility', 'res', 'comm', 'res']
+
+    #### a-b share the area and wind, d has its own wind, e shares the wind of 
+    ####  a and the fixed area of the 'res' and 'comm' sites
+    alpha = batch_filter_param(cap_ac, wind_speed, config, ids)
+    assert alpha.alpha.shape[1] == 5
+    assert alpha.site_group[0] == alpha.site_group[1]
+    site_alpha = alpha.sites(alpha.index, ids)
+    err = 0.
+    for j, id in enumerate(ids):
+        alpha_site = filter_param(cap_ac[j], wind_speed[id], config[j])
+        err = max(err, np.abs(site_alpha[id].values - alpha_site.values).max())
+    assert err < 1e-12, err
+
+    smoothed, clr_idx_prev = batch_smooth(clr_idx_min, alpha)
+    smoothed_sites, clr_idx_prev_sites = batch_smooth(
+        clr_idx_min, alpha.sites(alpha.index, ids))
+    assert np.array_equal(smoothed.values, smoothed_sites.values)
+
+    pv_prod_min = batch_main(clr_idx_min, clr_prod_min, cap_ac, wind_speed, 
+                             config)
+    groups = ['x', 'y', 'x', 'z', 'y', 'x']
+    totals = group_totals(clr_idx_min, clr_prod_min, cap_ac, wind_speed, 
+                          config, groups, block_sites = 4)
+    for label in ['x', 'y', 'z']:
+        cols = [id for id, group in zip(ids, groups) if group == label]
+        total = pv_prod_min[cols].sum(axis = 1)
+        err = max(err, np.abs(totals[label].values - total.values).max())
+    assert err < 1e-9, err
+
+    return err
+
 
 if __name__ == '__main__':
     """
@@ -24,17 +24,82 @@ Outputs:
 import pandas as pd 
 import pdb
 from scipy.stats import norm
+from scipy import sparse
+from scipy.sparse import csgraph
+from scipy.spatial import cKDTree
 import math
 import numpy as np
 import cPickle
 import datetime
+import hashlib
+from collections import OrderedDict
 from datetime import timedelta as tdelta
 from multiprocessing import Pool
 from joblib import Parallel, delayed
 import os
+import shutil
+import tempfile
+import warnings
+from SynthesisMetrics import METRICS
+import SynthesisTables as synth_tables
 
 ROOT_DIR = os.path.join(os.curdir, '%s')
 
+#### Stored parameters for the coherence function, these are derived from an
+#### analysis of insolation data from the DOE ARM network
+COH_A1 = 84.64; COH_A2 = 0.33361; COH_B = 0.9011
+
+#### WGS-84 ellipsoid, semi-major axis in km and flattening
+WGS84_A = 6378.137; WGS84_F = 1 / 298.257223563
+
+#### Mean earth radius (km) for the haversine distance, and the largest 
+####  fractional difference between the haversine and WGS-84 distances
+EARTH_RADIUS = 6371.0088; HAVERSINE_REL_ERR = 0.0056
+
+#### Number of pairs of points in each block of vdist_array() 
+VDIST_BLOCK = 32768
+
+#### Binary store of the PSD and CDF lookup tables (see SynthesisTables.py), the
+####  pickled tables are used if it is not there
+TABLES_FILE = ROOT_DIR % 'clearsky_index_tables.bin'
+
+#### Coherence below which two sites are treated as independent when the 
+####  coherence factor is split into blocks of sites 
+COHERENCE_TOL = 1e-3
+
+#### Largest number of sites in a block of the block factorization, which keeps
+####  the work for each frequency proportional to the number of sites (at the 
+####  lowest frequencies the coherence links every site of the region)
+BLOCK_MAX_SITES = 256
+
+#### Frequencies below about 1 cycle per hour are left (almost) out of the spectrum
+LOW_FREQ_CUTOFF = 1/3900. # Hz
+LOW_FREQ_PSD = 10e-6 
+
+#### Regularization added to the diagonal of the coherence matrices so that they
+####  can always be factored (the coherence at the lowest frequency is ~1 for
+####  every pair of sites)
+COHERENCE_REG = 10e-6 
+
+#### High bit of the keys of the random streams of the overlap-add frames of 
+####  synthesize_overlap(), which keeps them apart from the streams of the hours
+FRAME_KEY = np.uint64(1 << 63)
+
+#### Optional directory for a cache of the factored coherence of each site set 
+####  (e.g. ROOT_DIR % 'geometry_cache'), off by default, and the largest total 
+####  size of the cache files; the least recently used files are removed first
+GEOMETRY_CACHE_DIR = None
+GEOMETRY_CACHE_MB = 4096
+
+#### Precision of the synthesis data path: 'double' (float64/complex128) or 
+####  'single' (float32/complex64, half the memory for the tables and the 1-min 
+####  output).  The coherence is always factored in double precision.
+PRECISION = 'double'
+
+#### Size limits for the cache of spectral factors kept by each process
+FACTOR_CACHE_ENTRIES = 512
+FACTOR_CACHE_MB = 1024
+
 ##################################################
 #
 # MAIN FUNCTIONS
@@ -42,7 +107,10 @@ ROOT_DIR = os.path.join(os.curdir, '%s')
 ##################################################
 
 
-def main(solar_sites):
+def main(solar_sites, n_jobs = -2, engine = 'hourly', seed = None, 
+         cdf_interp = False, factorization = 'dense', 
+         coherence_tol = COHERENCE_TOL, cluster_km = None, neighbor_km = None,
+         overlap = False, precision = None, metrics_file = None):
     """
     Status:
     TESTS LOOK OKAY
@@ -54,79 +122,403 @@ def main(solar_sites):
     Inputs:
     solar_sites - a list  of SolarSite objects that will be used for the 
                   syntheseis of the clearsky index data
+    n_jobs - number of processes for joblib (1 runs every hour in this process)
+    engine - 'hourly' to synthesize each hour as a separate task with 
+              synthesize_hour(), or 'year' to synthesize blocks of hours as arrays
+              with synthesize_year()
+    seed - root seed (integer) for the random phases.  Each hour and site gets its
+            own random stream derived from the seed (see random_uniform()), so the
+            output does not depend on n_jobs or on how the hours are split up.
+            If None the global numpy random state is used. 
+    cdf_interp - if True interpolate linearly between the probability levels of 
+                  the CDF lookup table instead of rounding to the nearest 0.001
+    factorization - 'dense' to factor the full N X N coherence matrix of each 
+                     frequency, or 'block' to split the sites of each frequency 
+                     into clusters that are coherent with each other and factor 
+                     each cluster separately (see block_coherence_factor()), 
+                     with at most BLOCK_MAX_SITES sites in each cluster 
+    coherence_tol - for 'block', coherence below which sites are independent
+    cluster_km - for 'block', optional largest distance (km) between neighbouring
+                  sites in a cluster, which limits the size of the clusters at 
+                  the lowest frequencies 
+    neighbor_km - if given only the distances between sites within neighbor_km 
+                   of each other are calculated (see neighbor_distance_matrix()),
+                   and sites further apart are treated as having zero coherence
+    overlap - if True synthesize the hours as one continuous series without 
+               seams between them (see synthesize_overlap(), uses the 'year'
+               engine)
+    precision - 'double' or 'single' precision of the tables and the 1-min 
+                 output (default PRECISION)
+    metrics_file - optional file for the timers and counters of the run (see 
+                    SynthesisMetrics.py), in the Prometheus text format for .prom
+                    or .txt files and as JSON otherwise.  The metrics of the 
+                    worker processes are merged into SynthesisMetrics.METRICS.
 
     Outpus:
     solar_sites - the same list of SolarSite objects now containing the additional 
                    1-min clearsky index data attached to each SolarSite object
     """
-    #### Calculate a distance matrix between each of the sites 
-    dist_mtx = distance_matrix(solar_sites)
-    
-    #### Preload the Spectral amplitude with different frequencies as a function of
-    ####  the hourly clearsky index
+    #### The metrics of this process only cover this run
+    METRICS.clear()
+
+    #### Build the tables and parameters shared by every hour
+    synth_hr_args = synthesis_parameters(solar_sites, seed, cdf_interp, 
+                                         factorization, coherence_tol, 
+                                         cluster_km, neighbor_km, precision)
+    site_index = synth_hr_args[1]
+    dtype = synth_hr_args[3].dtype
+
+    #### For each hour synthesize the 1-min timeseries:
+    ## Get the index and initialize the final timeseries 
+    hour_index = solar_sites[0].clr_idx_hr.index
+    year_rng = minute_index(hour_index)
+
+    #### The 1-min output of every hour is written straight into its rows of one
+    ####  (minutes X sites) array 
+    shape = (len(year_rng), len(site_index))
+
+    if engine == 'year' or overlap:
+        #### Synthesize the full year in blocks of hours with array operations
+        TS_year = synthesize_year(hour_index, synth_hr_args, overlap = overlap)
+
+    elif n_jobs == 1:
+#***** Single core version ******
+        TS_year = year_output(shape, dtype = dtype)
+        for i, dt in enumerate(hour_index):
+            #### Synthesize the 1-min time series for each hour
+            TS = synthesize_hour(dt, synth_hr_args)
+            with METRICS.timer('stitch'):
+                TS_year[i*60:(i+1)*60] = TS.values
+
+        info = FACTOR_CACHE.info()
+        print "Spectral factor cache: %s hits, %s misses" % \
+            (info['hits'], info['misses'])
+#---------------------------------------------------
+    else:
+#****** Parallel version *********
+        #### Publish the read-only tables once to memory-mapped files, so each
+        ####  task only sends the hour and the clearsky index of each site.  The
+        ####  workers write their hour into a memory-mapped year array.
+        tables_name = publish_tables(synth_hr_args[1:])
+        TS_year = year_output(shape, tables_name, dtype = dtype)
+        kbar_mtx = kbar_matrix(solar_sites, hour_index)
+
+        #### Set aside the metrics so far, so that workers started as copies of 
+        ####  this process (or tasks run in this process) only send back the 
+        ####  metrics of their tasks
+        run_metrics = METRICS.snapshot(reset = True)
+        try:
+            #### Each hour is sent as a plain datetime: a Timestamp carries the 
+            ####  freq of the index, which loky cannot pickle 
+            snapshots = Parallel(n_jobs = n_jobs, verbose = 5)(
+                delayed(synthesize_hour_shared)(dt.to_pydatetime(), kbar_mtx[i],
+                                                tables_name, i, shape, dtype)
+                for i, dt in enumerate(hour_index))
+        finally:
+            #### Copy the year array into memory, which drops the last reference
+            ####  to the memory map and closes TS_year.dat, before the directory
+            ####  is removed (Windows cannot remove a file that is mapped)
+            TS_year = np.array(TS_year, order = 'F')
+            release_tables(tables_name)
+
+        #### Add up the metrics sent back by the workers
+        METRICS.merge(run_metrics)
+        for snapshot in snapshots:
+            METRICS.merge(snapshot)
+#----------------------------------------
+
+    ## Check to make sure there are not Nan values in the timeseries 
+    ##  (indicates a potential error earlier in the code
+    if np.isnan(TS_year).any():
+        print "Final TS has Nan!!!"
+        METRICS.count('final_nan')
+
+    #### Attach the 1-min clearsky timeseries to each solar site, as a view of 
+    ####  the site's column of the year array 
+    for j, site in enumerate(solar_sites):
+        site.clr_idx_min = pd.Series(TS_year[:, j], index = year_rng, 
+                                     name = site.id)
+
+    if metrics_file is not None:
+        METRICS.save(metrics_file)
+
+    return solar_sites 
+
+def synthesis_parameters(solar_sites, seed = None, cdf_interp = False, 
+                         factorization = 'dense', coherence_tol = COHERENCE_TOL,
+                         cluster_km = None, neighbor_km = None, precision = None):
+    """
+    Purpose:
+    Build the distance matrix, the coherence factor and the PSD and CDF lookup 
+     tables that are shared by every hour, and collect them into the list of 
+     parameters used by synthesize_hour() and synthesize_year()
+
+    Input:
+    solar_sites - a list of SolarSite objects 
+    seed, cdf_interp, factorization, coherence_tol, cluster_km, neighbor_km, 
+     precision - see main()
+
+    Output:
+    synth_hr_args - [solar_sites, site_index, coh_factor, cdf, sqrt_psd, freqs, 
+                     factor_key, seed, site_keys, cdf_interp]
+    """
+    #### Preload the Spectral amplitude with different frequencies and the 
+    ####  within-hour distribution of clearsky index as a function of the hourly
+    ####  clearsky index
+    freqs, sqrt_psd, cdf_arr = lookup_tables()
+
+    #### The distances and the factored coherence only depend on the locations of
+    ####  the sites, so they are read from the cache when the site set is the same
+    with METRICS.timer('geometry'):
+        site_index, coh_factor = site_geometry(solar_sites, freqs, factorization,
+                                               coherence_tol, cluster_km, 
+                                               neighbor_km, GEOMETRY_CACHE_DIR)
+
+    #### Hours with the same rounded clearsky index at every site reuse the same
+    ####  spectral factor from the cache, keyed with the site set so that cached
+    ####  factors from a different run (or factorization) are never used 
+    factor_key = site_key(solar_sites)
+    if factorization == 'block' or neighbor_km is not None:
+        factor_key = (factor_key, factorization, coherence_tol, cluster_km, 
+                      neighbor_km, BLOCK_MAX_SITES)
+
+    #### Keys for the random stream of each site
+    site_keys = site_hashes(site_index)
+
+    #### Store the tables in the precision of the run, the precision of the 
+    ####  synthesis follows the CDF table 
+    if (precision or PRECISION) == 'single':
+        coh_factor = coh_factor.astype(np.complex64)
+        sqrt_psd = sqrt_psd.astype(np.complex64)
+        cdf_arr = cdf_arr.astype(np.float32)
+        factor_key = (factor_key, 'single')
+
+    synth_hr_args = [solar_sites, site_index, coh_factor, cdf_arr, sqrt_psd,
+                     freqs, factor_key, seed, site_keys, cdf_interp]
+
+    return synth_hr_args
+
+def lookup_tables(tables_file = None):
+    """
+    Purpose:
+    Load the PSD and CDF lookup tables: memory mapped from the binary store 
+     (TABLES_FILE), or else from the pickled tables, or else rebuilt from the 
+     synth database.  A binary store that is missing falls back silently, one 
+     that is corrupt or of another format version falls back with a warning
+
+    Input:
+    tables_file - optional binary store to use instead of TABLES_FILE
+
+    Output:
+    freqs - array (F,) of the frequencies (Hz)
+    sqrt_psd - complex array (K, F) from psd_table()
+    cdf_arr - float array (K, 1001) from cdf_table()
+    """
+    try:
+        tables = synth_tables.read_tables(tables_file or TABLES_FILE)
+        freqs = np.array(tables['freq'])
+        sqrt_psd = spectral_amplitude(freqs, tables['psd'])
+        cdf_arr = cdf_levels(tables['cdf_prob'], tables['cdf'])
+        return freqs, sqrt_psd, cdf_arr
+    except IOError:
+        pass
+    except synth_tables.TableFormatError as e:
+        warnings.warn("%s, loading the pickled tables instead" % e)
+
     try:
         #### Load from stored file 
-        psd = cPickle.load(open(ROOT_DIR % 'clearsky_index_psd.pkl', 'rb'))
+        psd = pd.read_pickle(ROOT_DIR % 'clearsky_index_psd.pkl')
     except IOError:
         psd = power_spectral_density()
 
-    #### Calculate the correlation matrix based on the distance between the sites 
-    freqs = psd['1.00']['freq']
-    cohere = coherence_matrix(dist_mtx, freqs)
-
-    #### Preload the within-hour distribution of clearsky index lookup table
     try:
         #### Load from stored file 
-        cdf = cPickle.load(open(ROOT_DIR % 'clearsky_index_cdf.pkl', 'rb'))
+        cdf = pd.read_pickle(ROOT_DIR % 'clearsky_index_cdf.pkl')
     except IOError:
         cdf = clearsky_index_distribution(psd.items.values)
 
-    #### For each hour synthesize the 1-min timeseries:
-    ## Get the index and initialize the final timeseries 
-    hour_index = solar_sites[0].clr_idx_hr.index
-    year_start = hour_index[0] - tdelta(seconds = hour_index[0].minute * 60)
-    year_end = hour_index[-1] - tdelta(seconds = hour_index[-1].minute * 60) + \
-        tdelta(seconds = 59*60)
-    year_rng = pd.date_range(year_start, year_end, freq = 'min')
-
-    synth_hr_args = [solar_sites, dist_mtx.index, cohere, cdf, psd, freqs]
-
-#***** Single core version ****** NOT CURRENTLY USED
-#    TS_list = []
-#    for dt in hour_index:
-#        #### Synthesize the 1-min time series for each hour
-#        TS = synthesize_hour(dt, synth_hr_args)
-#        TS_list.append(TS)
-#---------------------------------------------------
+    freqs = np.real(psd['1.00']['freq'].values.astype(complex))
 
-#****** Parallel version ********* ACTIVE
-#    
-    TS_list = Parallel(n_jobs= -2, verbose = 5)(
-        delayed(synthesize_hour)(dt, synth_hr_args) for dt in hour_index)
-#----------------------------------------
+    return freqs, psd_table(psd), cdf_table(cdf)
 
-    #### Stich all of the hours together and ensure that there are no
-    ####  hour-to-hour seams issues 
-    
-    print "Inserting all of the 1-min data from " +\
-        "%s hours into the TS_year dataframe" % len(TS_list)
-
-    for TS in TS_list:  
-        ## Check to make sure there are not Nan values in the timeseries (indicates 
-        ##  a potential error earlier in the code
-        for id in TS.columns:
-            if pd.isnull(TS[id]).sum() >0:
-                print "Final TS has Nan!!!"
+def site_geometry(solar_sites, freqs, factorization = 'dense', 
+                  coherence_tol = COHERENCE_TOL, cluster_km = None, 
+                  neighbor_km = None, cache_dir = None):
+    """
+    Purpose:
+    Calculate the distance between the sites and the factored coherence matrix 
+     of each frequency.  With a cache directory the result is saved under a hash
+     of the site locations, the frequencies and the model parameters, and loaded
+     again on later runs with the same sites instead of being recalculated.  
+     The cache is kept within GEOMETRY_CACHE_MB (see prune_cache()).
+
+    Input:
+    solar_sites - a list of SolarSite objects 
+    freqs - array of the frequencies (Hz)
+    factorization, coherence_tol, cluster_km, neighbor_km - see main()
+    cache_dir - directory of the cache, or None to always calculate 
+
+    Output:
+    site_index - Index of the site ids, the order of the sites in coh_factor
+    coh_factor - array (F, N, N) from coherence_factor() or a BlockFactor from
+                  block_coherence_factor()
+    """
+    if cache_dir is not None:
+        desc = repr([[(str(s.id), s.lat, s.lon) for s in solar_sites], 
+                     np.asarray(freqs, dtype = float).tolist(), 
+                     (COH_A1, COH_A2, COH_B, COHERENCE_REG), 
+                     (factorization, coherence_tol, cluster_km, neighbor_km, 
+                      BLOCK_MAX_SITES)])
+        cache_file = os.path.join(cache_dir, 'geometry_%s.pkl' % 
+                                  hashlib.sha1(desc).hexdigest())
+        try:
+            geometry = cPickle.load(open(cache_file, 'rb'))
+            METRICS.count('geometry_cache_hits')
+            #### Mark the file as recently used for prune_cache()
+            os.utime(cache_file, None)
+            return geometry
+        except (IOError, EOFError, cPickle.UnpicklingError):
+            METRICS.count('geometry_cache_misses')
+
+    #### Calculate a distance matrix between each of the sites, or only between 
+    ####  the neighbouring sites for large numbers of sites
+    if neighbor_km is None:
+        dist_mtx = distance_matrix(solar_sites)
+        dist, site_index = dist_mtx.values, dist_mtx.index
+    else:
+        dist, site_index = neighbor_distance_matrix(solar_sites, neighbor_km)
+
+    #### The coherence does not change from hour to hour, so factor it once for 
+    ####  every frequency.  Each hour then only scales the rows of the factor by 
+    ####  the square root of each site's PSD 
+    if factorization == 'block':
+        coh_factor = block_coherence_factor(dist, freqs, coherence_tol, 
+                                            cluster_km)
+    else:
+        if sparse.issparse(dist):
+            dist = dense_distances(dist)
+        dist_mtx = pd.DataFrame(dist, index = site_index, columns = site_index)
+        cohere, site_index = coherence_matrix(dist_mtx, freqs)
+        coh_factor = coherence_factor(cohere)
+
+    if cache_dir is not None and coh_factor.nbytes <= GEOMETRY_CACHE_MB * 2**20:
+        #### Write to a temporary file first so that a cache file is always 
+        ####  complete
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_file = cache_file + '.%s.tmp' % os.getpid()
+        save_file = open(tmp_file, 'wb')
+        cPickle.dump((site_index, coh_factor), save_file, cPickle.HIGHEST_PROTOCOL)
+        save_file.close()
+        os.rename(tmp_file, cache_file)
+        prune_cache(cache_dir, GEOMETRY_CACHE_MB)
+
+    return site_index, coh_factor
+
+def prune_cache(cache_dir, max_mb):
+    """
+    Purpose:
+    Remove the least recently used files of the geometry cache until the cache 
+     files take at most max_mb 
+    """
+    files = []
+    for name in os.listdir(cache_dir):
+        if name.startswith('geometry_') and name.endswith('.pkl'):
+            cache_file = os.path.join(cache_dir, name)
+            try:
+                files.append((os.path.getmtime(cache_file), 
+                              os.path.getsize(cache_file), cache_file))
+            except OSError:
+                pass
+
+    total = sum([size for mtime, size, cache_file in files])
+    for mtime, size, cache_file in sorted(files):
+        if total <= max_mb * 2**20:
+            break
         try:
-            TS_year = pd.concat([TS_year, TS])
-        except NameError: # If TS_year doesn't exist, then initialize it first
-            TS_year = TS
+            os.remove(cache_file)
+        except OSError:
+            pass
+        total -= size
+
+def synthesize_stream(solar_sites, block_hours = 24, seed = None, 
+                      cdf_interp = False, factorization = 'dense', 
+                      coherence_tol = COHERENCE_TOL, cluster_km = None, 
+                      neighbor_km = None, overlap = False, precision = None):
+    """
+    Purpose:
+    Generator version of main() for long runs with many sites: synthesize the 
+     1-min clearsky index in blocks of hours (e.g. a day or a week) with 
+     synthesize_year() and yield each block as it is finished, so that only one
+     block of (minutes X sites) is held in memory at a time.  With a seed the 
+     blocks are the same as the matching rows of main().
 
-    #### Attach the 1-min clearsky timeseries to each solar site 
-    for site in solar_sites:
-        site.clr_idx_min = TS_year[site.id]
+    Input:
+    solar_sites - a list of SolarSite objects 
+    block_hours - number of hours in each block 
+    seed, cdf_interp, factorization, coherence_tol, cluster_km, neighbor_km, 
+     overlap, precision - see main()
 
-    return solar_sites 
+    Output:
+    yields TS_block - DataFrame (minutes X sites) of the 1-min clearsky index of 
+                       each block, indexed by minute with a column for each site
+    """
+    synth_hr_args = synthesis_parameters(solar_sites, seed, cdf_interp, 
+                                         factorization, coherence_tol, 
+                                         cluster_km, neighbor_km, precision)
+    site_index = synth_hr_args[1]
+    hour_index = solar_sites[0].clr_idx_hr.index
+
+    for b_start in range(0, len(hour_index), block_hours):
+        b_hours = hour_index[b_start:b_start + block_hours]
+        TS = synthesize_year(b_hours, synth_hr_args, block_hours, overlap)
+
+        yield pd.DataFrame(TS, index = minute_index(b_hours), 
+                           columns = site_index)
+
+def precision_report(solar_sites, seed = 0, **kwargs):
+    """
+    Purpose:
+    Validate the single precision mode: synthesize the same sites with the same 
+     seed in double and in single precision and compare the distribution of the
+     1-min clearsky index and of the 1-min ramps (changes between minutes)
+
+    Input:
+    solar_sites - a list of SolarSite objects 
+    seed - seed used for both runs 
+    kwargs - other options of main() (e.g. cdf_interp, overlap)
+
+    Output:
+    report - DataFrame with a row for each statistic and columns 'double', 
+              'single' and 'difference' (single - double).  The 'max abs error'
+              row compares the two runs minute by minute.
+    """
+    TS = {}
+    for precision in ['double', 'single']:
+        sites = [SolarSite(s.id, s.lat, s.lon, s.clr_idx_hr) for s in solar_sites]
+        sites = main(sites, engine = 'year', seed = seed, precision = precision,
+                     **kwargs)
+        TS[precision] = np.column_stack([s.clr_idx_min.values for s in sites])
+
+    def statistics(TS):
+        ramps = np.abs(np.diff(TS.astype(float), axis = 0))
+        stats = [('mean', TS.mean()), ('std', TS.std())]
+        for q in [1, 5, 25, 50, 75, 95, 99]:
+            stats.append(('percentile %s' % q, np.percentile(TS, q)))
+        stats += [('mean abs ramp', ramps.mean()), ('std abs ramp', ramps.std()),
+                  ('99th pct abs ramp', np.percentile(ramps, 99)), 
+                  ('max abs ramp', ramps.max())]
+        return OrderedDict(stats)
+
+    stats_double = statistics(TS['double'])
+    report = pd.DataFrame(OrderedDict([('double', stats_double), 
+                                       ('single', statistics(TS['single']))]), 
+                          index = stats_double.keys())
+    report.loc['max abs error'] = [0., np.abs(TS['single'].astype(float) - 
+                                              TS['double']).max()]
+    report['difference'] = report['single'] - report['double']
+
+    return report
 
 def test():
     """
@@ -197,7 +589,87 @@ class SolarSite:
         self.clr_idx_hr = clr_idx_hr
 
 
-def distance_matrix(solar_sites):
+class FactorCache:
+    """
+    Purpose:
+     Least-recently-used cache of the per-hour spectral factors, keyed by the 
+     rounded clearsky index level of every site.  Long clear spells and night 
+     hours give the same levels at all sites, so those hours can skip building 
+     the factor.  The cache is limited both in the number of entries and in the 
+     total memory of the stored arrays. 
+
+    Input:
+    max_entries - maximum number of factors to keep
+    max_mb - maximum total size of the stored factors in MB
+
+    Data:
+    hits, misses - number of lookups that were found / not found in the cache
+    nbytes - total size of the stored factors in bytes
+
+    Methods:
+    get(key) - return the stored factor for key (or None) and count the lookup
+    put(key, H) - store a factor, dropping the least recently used factors to 
+                   stay within the limits
+    info() - dictionary with the hits, misses, number of entries and size
+    clear() - remove all entries and reset the counters
+    """
+    def __init__(self, max_entries = FACTOR_CACHE_ENTRIES, 
+                 max_mb = FACTOR_CACHE_MB):
+        self.max_entries = max_entries
+        self.max_bytes = max_mb * 2**20
+        self.clear()
+
+    def get(self, key):
+        try:
+            H = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        #### Move the entry to the most recently used end 
+        self._data[key] = H
+        self.hits += 1
+        return H
+
+    def put(self, key, H):
+        if key in self._data:
+            self.nbytes -= self._data.pop(key).nbytes
+        if H.nbytes > self.max_bytes or self.max_entries < 1:
+            return
+        self._data[key] = H
+        self.nbytes += H.nbytes
+        while len(self._data) > self.max_entries or self.nbytes > self.max_bytes:
+            old_key, old_H = self._data.popitem(last = False)
+            self.nbytes -= old_H.nbytes
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(self._data), 'mb': self.nbytes / 2.**20}
+
+    def clear(self):
+        self._data = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+#### Each process keeps its own cache of spectral factors
+FACTOR_CACHE = FactorCache()
+
+def site_key(solar_sites):
+    """
+    Purpose:
+    Build a short key that identifies a set of sites by their ids and locations 
+
+    Input:
+    solar_sites - list of SolarSite objects 
+
+    Output:
+    key - hex string 
+    """
+    desc = repr([(str(s.id), s.lat, s.lon) for s in solar_sites])
+
+    return hashlib.sha1(desc).hexdigest()[:16]
+
+def distance_matrix(solar_sites, tol_m = None):
     """
     Purpose:
     Based on the latitude and longitude of each site build a matrix with the 
@@ -205,6 +677,7 @@ def distance_matrix(solar_sites):
 
     Input:
     solar_sites - list of SolarSite objects 
+    tol_m - optional accuracy needed in meters, see geodesic_distance()
 
     Output:
     dm - a DataFrame indexed by the id of each solar site with columns also 
@@ -214,29 +687,112 @@ def distance_matrix(solar_sites):
 
     #### Get the list of ids of the solar sites 
     ids = [s.id for s in solar_sites]
+    lat = np.array([s.lat for s in solar_sites], dtype = float)
+    lon = np.array([s.lon for s in solar_sites], dtype = float)
+    N = len(ids)
 
-    #### Build a lookup table for the the lat and lon of each site
-    d = {'lat': [s.lat for s in solar_sites],
-         'lon': [s.lon for s in solar_sites]}
-    loc = pd.DataFrame(d, index = ids)
-    
-    #### Index the blank distance matrix by the site IDs 
-    dm = pd.DataFrame(index = ids, columns = ids, dtype = float)
-    
-    #### Go through each possible pair of sites, calculate the distance, and store
-    ####  the distance in the distance matrix
-    for i in dm.columns:
-        for j in dm.index:
-            dm[i][j] = vdist(loc['lat'][i], loc['lon'][i], 
-                             loc['lat'][j], loc['lon'][j]) # km
-            if i == j:
-                dm[i][i] = 0
-
-    #### Impose a minimum distance of 1 km
-    dm = dm.fillna(1) #km 
+    #### Calculate the distance for each pair of sites above the diagonal in one 
+    ####  pass, and mirror it below the diagonal 
+    i, j = np.triu_indices(N, 1)
+    d = geodesic_distance(lat, lon, lat, lon, tol_m, pairs = (i, j)) # km
+
+    #### Impose a minimum distance of 1 km on sites at the same location 
+    d[np.isnan(d) | (d == 0)] = 1 #km 
+
+    dist = np.zeros((N, N))
+    dist[i, j] = d
+    dist[j, i] = d
+    dm = pd.DataFrame(dist, index = ids, columns = ids)
 
     return dm
 
+def neighbor_distance_matrix(solar_sites, max_km, tol_m = None):
+    """
+    Purpose:
+    Sparse version of distance_matrix() that only calculates the distance between
+     sites within max_km of each other.  The sites are placed in a KD-tree on 
+     their earth-centered (ECEF) coordinates, and the straight-line distance 
+     through the earth is never longer than the distance along the surface, so 
+     the tree query finds every pair that is within max_km.
+
+    Input:
+    solar_sites - list of SolarSite objects 
+    max_km - largest distance (km) between a pair of sites that is kept
+    tol_m - optional accuracy needed in meters, see geodesic_distance()
+
+    Output:
+    dist - scipy.sparse csr_matrix (N X N) with the distance in km between each 
+            pair of sites within max_km.  Pairs further apart are not stored and
+            the diagonal is not stored.  Like distance_matrix() sites at the 
+            same location are 1 km apart. 
+    ids - Index with the id of each solar site 
+    """
+    ids = pd.Index([s.id for s in solar_sites])
+    lat = np.array([s.lat for s in solar_sites], dtype = float)
+    lon = np.array([s.lon for s in solar_sites], dtype = float)
+    N = len(ids)
+
+    #### Find the pairs of sites within max_km 
+    tree = cKDTree(ecef_coordinates(lat, lon))
+    pairs = tree.query_pairs(max_km, output_type = 'ndarray')
+    i, j = pairs[:, 0], pairs[:, 1]
+
+    #### Calculate the distance along the surface for each of the pairs 
+    d = geodesic_distance(lat, lon, lat, lon, tol_m, pairs = (i, j))
+
+    #### Impose a minimum distance of 1 km on sites at the same location 
+    d[np.isnan(d) | (d == 0)] = 1 #km
+    keep = d <= max_km
+    i, j, d = i[keep], j[keep], d[keep]
+
+    dist = sparse.coo_matrix((np.concatenate([d, d]), 
+                              (np.concatenate([i, j]), np.concatenate([j, i]))),
+                             shape = (N, N)).tocsr()
+
+    return dist, ids
+
+def ecef_coordinates(lat, lon):
+    """
+    Purpose:
+    Earth-centered, earth-fixed coordinates (km) of points on the surface of the 
+     WGS-84 ellipsoid
+
+    Input:
+    lat, lon - arrays of geodetic latitude and longitude (degrees)
+
+    Output:
+    xyz - array (N X 3) of x, y, z in km 
+    """
+    phi = np.radians(lat)
+    lam = np.radians(lon)
+    e2 = WGS84_F * (2 - WGS84_F)
+    n = WGS84_A / np.sqrt(1 - e2 * np.sin(phi) ** 2)
+
+    return np.column_stack([n * np.cos(phi) * np.cos(lam), 
+                            n * np.cos(phi) * np.sin(lam), 
+                            n * (1 - e2) * np.sin(phi)])
+
+def dense_distances(dist):
+    """
+    Purpose:
+    Expand a sparse distance matrix from neighbor_distance_matrix() into a full 
+     array where the pairs that are not stored are infinitely far apart (zero 
+     coherence)
+
+    Input:
+    dist - scipy.sparse matrix (N X N) 
+
+    Output:
+    dense - array (N X N) with 0 on the diagonal and inf for the missing pairs 
+    """
+    dist = dist.tocoo()
+    dense = np.empty(dist.shape)
+    dense.fill(np.inf)
+    dense[dist.row, dist.col] = dist.data
+    np.fill_diagonal(dense, 0)
+
+    return dense
+
 def coherence_matrix(dist_mtx, frequencies):
     """
     Status:
@@ -252,27 +808,92 @@ def coherence_matrix(dist_mtx, frequencies):
                    frequencies 
 
     Output:
-    cohere - a Panel data item with items being the position of the corresponding 
-              frequency in the frequencies list, indexed by the site id and columns
-              with the site id from the distance matrix
-              cohere[freq_idx][col site id][row site_id]
+    cohere - an array with shape (F, N, N) with the first axis being the position
+              of the corresponding frequency in the frequencies list and the rows
+              and columns being the position of each site in site_index
+              cohere[freq_idx, row, col]
+    site_index - Index of the site ids from the distance matrix, which maps the 
+                  site id to its row/col position (site_index.get_loc(id)) and 
+                  back (site_index[row])
     """
-    #### Stored parameters for the coherence function, these are derived from an
-    #### analysis of insolation data from the DOE ARM network
-    a1 = 84.64; a2 = 0.33361; b = 0.9011
-    
-    C = {}
-    for f, i in zip(frequencies, range(len(frequencies))):
-        #### For each frequency create a DataFrame with the coherence based on the 
-        ####  distances between sites     
-        C[i] = b * np.exp(-a1 * f * dist_mtx) + \
-            (1 - b) * np.exp(-a2 * f * dist_mtx) 
+    #### Evaluate the coherence for every frequency and pair of sites at once as
+    ####  an array organized as cohere[frequency list index, site row, site col]
+    f = np.real(np.asarray(frequencies, dtype = complex))
+    d = dist_mtx.values.astype(float)
+
+    #### When the frequencies are exact harmonics of the lowest non-zero one, 
+    ####  f[k] = k * f[1], exp(-a * f[k] * d) is the k-th power of 
+    ####  exp(-a * f[1] * d) and only two exponentials have to be evaluated.  
+    ####  The stored frequency tables are rounded, so they are not exact 
+    ####  harmonics and are evaluated directly.
+    F = len(f)
+    if F > 2 and f[0] == 0 and np.allclose(f, np.arange(F) * f[1], rtol = 0, 
+                                           atol = np.finfo(float).eps * f[-1]):
+        E1 = np.empty((F,) + d.shape)
+        E2 = np.empty((F,) + d.shape)
+        E1[0] = 1
+        E2[0] = 1
+        E1[1:] = np.exp(-COH_A1 * f[1] * d)
+        E2[1:] = np.exp(-COH_A2 * f[1] * d)
+        np.cumprod(E1, axis = 0, out = E1)
+        np.cumprod(E2, axis = 0, out = E2)
+
+        E1 *= COH_B
+        E2 *= 1 - COH_B
+        E1 += E2
+        cohere = E1
+        cohere[:, np.isinf(d)] = 0
+    else:
+        cohere = coherence_model(f[:, np.newaxis, np.newaxis], d[np.newaxis])
+
+    return cohere, dist_mtx.index
+
+def coherence_model(f, d):
+    """
+    Purpose:
+    Coherence between two sites as a function of frequency and distance, using 
+     the stored parameters COH_A1, COH_A2 and COH_B 
 
-    #### Convert it into a Panel organized as:
-    ####  cohere[frequency list index][site column][site index]
-    cohere = pd.Panel(C)
+    Input:
+    f - frequency in Hz (scalar or array)
+    d - distance in km (scalar or array, broadcast with f), inf for pairs of 
+         sites that are treated as independent 
 
-    return cohere
+    Output:
+    coherence with the broadcast shape of f and d
+    """
+    with np.errstate(invalid = 'ignore'):
+        coh = COH_B * np.exp(-COH_A1 * f * d) + (1 - COH_B) * np.exp(-COH_A2 * f * d)
+
+    return np.where(np.isinf(d), 0., coh)
+
+def coherence_distance(f, tol):
+    """
+    Purpose:
+    Distance (km) beyond which the coherence at frequency f is below tol 
+
+    Input:
+    f - frequency in Hz
+    tol - coherence threshold 
+
+    Output:
+    d - distance in km (inf for f = 0, where the coherence is always 1)
+    """
+    if f <= 0:
+        return np.inf
+
+    #### The coherence is below exp(-COH_A2 * f * d), so the distance is at most 
+    ####  hi; bisect between 0 and hi
+    lo = 0.
+    hi = np.log(1. / tol) / (COH_A2 * f)
+    for i in range(60):
+        mid = (lo + hi) / 2.
+        if coherence_model(f, mid) < tol:
+            hi = mid
+        else:
+            lo = mid
+
+    return hi
 
 def power_spectral_density():
     """
@@ -395,63 +1016,83 @@ def clearsky_index_distribution(clear_sky_index_list):
 
     return cdf
 
-def synthesize_hour(dt, parameters):
+def synthesize_hour(dt, parameters, kbars = None):
     """"
     Purpose: 
     Wrap all of the steps needed to synthesize the 1-min correlated time series at 
     each site into one function so that it can be run in parallel
 
+    Input:
+    dt - the hour to synthesize
+    parameters - list of [solar_sites, site_index, coh_factor, cdf_arr, sqrt_psd,
+                  freqs, factor_key, seed, site_keys, cdf_interp] from main()
+    kbars - optional hourly clearsky index of each site for the hour, otherwise
+             it is taken from the clr_idx_hr of each of the solar_sites
     """
     #### Unpack the parameters 
-    solar_sites, site_index, cohere, cdf, psd, freqs = parameters
+    solar_sites, site_index, coh_factor, cdf, sqrt_psd, freqs, factor_key, \
+        seed, site_keys, cdf_interp = parameters
+    watch = METRICS.stopwatch()
+    METRICS.count('hours')
 
-    #### Calculate the spectral amplitude matrix depending on the sites average
-    ####  clearsky index for the hour and the correlation between sites
+    #### Calculate the factor of the spectral amplitude matrix depending on the 
+    ####  sites average clearsky index for the hour and the correlation between 
+    ####  sites
 
     ## Build a DataFrame object that has the hourly clearsky index for each site
     ## indexed by the site id
-    kbars = [site.clr_idx_hr[dt] for site in solar_sites]
+    if kbars is None:
+        kbars = [site.clr_idx_hr[dt] for site in solar_sites]
     kbars = pd.Series(kbars, index = site_index)
-
-    ## Use this hourly average clearsky value to create a spectral magnitude mtx
-    try:
-        S = spectral_amplitude_matrix(kbars, cohere, psd)
-    except KeyError:
-        pdb.set_trace()
+    levels = kbar_levels(kbars)
+
+    ## Use this hourly average clearsky value to scale the coherence factor,
+    ##  unless the factor for the same levels is already in the cache
+    key = (factor_key, tuple(levels))
+    H = FACTOR_CACHE.get(key)
+    if H is None:
+        METRICS.count('factor_cache_misses')
+        H = spectral_factor(levels, coh_factor, sqrt_psd)
+        FACTOR_CACHE.put(key, H)
+    else:
+        METRICS.count('factor_cache_hits')
+    watch.lap('s_construction')
+
+    #### Random numbers for the phases of the white noise, from the stream of 
+    ####  each site for this hour if a seed is given 
+    if seed is None:
+        rand = None
+    else:
+        rand = random_uniform(seed, hour_keys([dt]), site_keys, len(freqs))[0]
+        watch.lap('whitenoise')
 
     #### Synthesize the 1-min time series or normalized clearksy index 
     ####  (on a uniform distribution) for each site for the hour
-    TS_norm = synthysize_norm_TS(S, freqs)
+    TS_norm = factor_norm_TS(H, freqs, site_index, rand)
+    watch = METRICS.stopwatch()
 
     for id in TS_norm.columns:
         if pd.isnull(TS_norm[id]).sum() >0:
             print "TS_norm has Nan at " + str(dt) + " !!!"
+            METRICS.count('nan_repairs', pd.isnull(TS_norm[id]).sum())
             TS_norm[id] = TS_norm[id].fillna(0)
 
-    #### For each site within the hour: 
-
-    #### Get the actual distribution of the clearsky index for the hour
-    ####  based on the hourly average clearsky index from the pre-loaded 
-    ####  lookup table  
-    kbars =  [("%3.2f") % (round(float(k)*20)/20) for k in kbars]
-    kbars = pd.Series(kbars, index = site_index)
-        
     #### De-normalize the time-series data using the distribution of the clearsky
     ####  index for the site and the hour
     ## Transform the time series into the normalized CDF
-    TS_F = TS_norm.apply(norm.cdf).apply(np.round, args = (3,))
+    TS_F = norm.cdf(TS_norm.values[:60])
        
     #### Check for any null values - indicates a potnetial error
-    for id in TS_F.columns:
-        if pd.isnull(TS_F[id]).sum() >0:
-            print "TS_F has Nan at " + str(dt) + " !!!"
-            TS_F[id] = TS_F[id].fillna(0.5)
+    if np.isnan(TS_F).any():
+        print "TS_F has Nan at " + str(dt) + " !!!"
+        METRICS.count('nan_repairs', np.isnan(TS_F).sum())
+        TS_F[np.isnan(TS_F)] = 0.5
+    watch.lap('norm_cdf')
 
     ## For each site, look up the clearsky index at that particular probability
     ## level in the CDF for the site's hourly average clearsky index 
-    d = {}
-    for id in site_index:
-        d[id] = cdf[kbars[id]][TS_F[id]].values[:60]
+    TS = cdf_lookup(cdf, levels, TS_F, cdf_interp)
+    watch.lap('cdf_lookup')
 
     #### Create a time series index that starts at the begining of the hour 
     #### (based on dt) and goes to the end of the hour
@@ -460,164 +1101,1153 @@ def synthesize_hour(dt, parameters):
         
     #### Convert the clearsky index into a timeseries that starts at the
     #### beginning of the hour and coninutes to the end of the hour
-    TS = pd.DataFrame(d, index = hour_rng)
-
-    #### Check for any null values, if they exist it may indicate an error 
-    for id in TS.columns:
-        if pd.isnull(TS[id]).sum() > 0:
-            TS[id] = TS[id].fillna(float(kbars[id]))
+    TS = pd.DataFrame(TS, index = hour_rng, columns = site_index)
 
     return TS
 
-def test_synthesize_norm_hour(dt, parameters):
-    """ Test function used only to examine a full year of normalized output 
+def synthesize_hour_shared(dt, kbars, tables_name, hour_pos, shape, 
+                           dtype = float):
+    """
     Purpose:
+    Version of synthesize_hour() for parallel tasks: the read-only tables are 
+     attached from the files published by publish_tables(), so that each task 
+     only carries the hour and the hourly clearsky index of each site.  The 1-min
+     output is written directly into the hour's rows of the year array from
+     year_output().
 
-    Replicate the function of synthesize_hour(), but direclty output the normalized 
-    timeseries so that a full year can be checked for abnormal behaviour at the hour-
-    to-hour seams.  
-
-    Intput:
-    Same as synthesize_hour()
+    Input:
+    dt - the hour to synthesize
+    kbars - array of the hourly clearsky index of each site for the hour 
+    tables_name - name returned by publish_tables() for synthesize_hour()'s 
+                   parameters (without the solar_sites)
+    hour_pos - position of the hour in the hour index 
+    shape - shape of the year array 
+    dtype - dtype of the year array 
 
     Output:
-    TS_norm - normalized time series like TS from synthesize_hour()
+    snapshot - the metrics of the task (see SynthesisMetrics.py), the hour is 
+                stored in rows hour_pos*60 to (hour_pos+1)*60 of the year array
+    """
+    parameters = [None] + attach_tables(tables_name)
+
+    TS = synthesize_hour(dt, parameters, kbars)
+
+    with METRICS.timer('stitch'):
+        TS_year = year_output(shape, tables_name, mode = 'r+', dtype = dtype)
+        TS_year[hour_pos*60:(hour_pos+1)*60] = TS.values
+
+    #### Send the metrics of the task back with the result, so that each 
+    ####  worker's metrics are only counted once 
+    return METRICS.snapshot(reset = True)
+
+def synthesize_year(hour_index, parameters, block_hours = 168, overlap = False):
+    """
+    Purpose:
+    Alternative to running synthesize_hour() for each hour: synthesize the 1-min
+     correlated time series at each site for blocks of hours at once, with the
+     data organized as (hours, freqs, sites) arrays.  Each block goes through the
+     same steps as synthesize_hour() in a few array operations: PSD lookup, 
+     scaling of the coherence factor, random phases, inverse FFT and mapping 
+     through the within-hour CDF.
+
+    Input:
+    hour_index - DatetimeIndex of the hours to synthesize
+    parameters - same list of parameters as synthesize_hour()
+    block_hours - number of hours synthesized in each block, which limits the 
+                   memory used for the (hours, freqs, sites) arrays
+    overlap - if True synthesize the hours as one continuous series without 
+               seams between them, see synthesize_overlap()
 
+    Output:
+    TS_year - array (minutes X sites) of the 1-min clearsky index with the 60 
+               minutes of each hour in order and the sites in the order of 
+               site_index, the same as the stitched output of synthesize_hour()
     """
+    if overlap:
+        return synthesize_overlap(hour_index, parameters, block_hours)
 
     #### Unpack the parameters 
-    solar_sites, site_index, cohere, cdf, psd, freqs = parameters
+    solar_sites, site_index, coh_factor, cdf, sqrt_psd, freqs, factor_key, \
+        seed, site_keys, cdf_interp = parameters
 
-    #### Calculate the spectral amplitude matrix depending on the sites average
-    ####  clearsky index for the hour and the correlation between sites
+    #### Get the rounded hourly clearsky index level of every site and hour 
+    levels = kbar_levels(kbar_matrix(solar_sites, hour_index))
+    if seed is not None:
+        h_keys = hour_keys(hour_index)
 
-    ## Build a DataFrame object that has the hourly clearsky index for each site
-    ## indexed by the site id
-    kbars = [site.clr_idx_hr[dt] for site in solar_sites]
-    kbars = pd.Series(kbars, index = site_index)
+    coh_factor = real_factor(coh_factor)
+    F, N = coh_factor.shape[0], coh_factor.shape[1]
 
-    ## Use this hourly average clearsky value to create a spectral magnitude mtx
-    try:
-        S = spectral_amplitude_matrix(kbars, cohere, psd)
-    except KeyError:
-        pdb.set_trace()
+    #### The precision of the run follows the CDF table (see PRECISION)
+    dtype = cdf.dtype
+    TS_year = year_output((len(hour_index)*60, N), dtype = dtype)
 
-    #### Synthesize the 1-min time series or normalized clearksy index 
-    ####  (on a uniform distribution) for each site for the hour
-    TS_norm = synthysize_norm_TS(S, freqs)
+    METRICS.count('hours', len(hour_index))
+    watch = METRICS.stopwatch()
 
-    for id in TS_norm.columns:
-        if pd.isnull(TS_norm[id]).sum() >0:
-            print "TS_norm has Nan at " + str(dt) + " !!!"
-            TS_norm[id] = TS_norm[id].fillna(0)
+    for b_start in range(0, len(hour_index), block_hours):
+        b_levels = levels[b_start:b_start + block_hours]
+        n_hrs = len(b_levels)
 
-    #### For each site within the hour: 
-    d = {}
-    for id in site_index:
-        d[id] = TS_norm[id].values[:60]
+        #### Square root of the PSD for each hour, frequency and site
+        D = sqrt_psd[b_levels].transpose(0, 2, 1)
+        watch.lap('s_construction')
 
-    #### Create a time series index that starts at the begining of the hour 
-    #### (based on dt) and goes to the end of the hour
-    start_dt = dt - datetime.timedelta(seconds = dt.minute * 60)
-    hour_rng = pd.date_range(start_dt, periods=60, freq='min')
-        
-    #### Convert the clearsky index into a timeseries that starts at the
-    #### beginning of the hour and coninutes to the end of the hour
-    TS_norm = pd.DataFrame(d, index = hour_rng)
+        #### Unit-magnitude white noise for each hour, frequency and site 
+        if seed is None:
+            rand = np.random.rand(n_hrs, F, N)
+        else:
+            rand = random_uniform(seed, h_keys[b_start:b_start + n_hrs], 
+                                  site_keys, F)
 
-    return TS_norm 
+        #### Inverse fourier transform of every hour and site, keeping the first 
+        ####  60 minutes of each hour 
+        TS_norm = noise_transform(coh_factor, D, rand, dtype, watch)[:, :60, :]
 
+        #### De-normalize the time-series data using the distribution of the 
+        ####  clearsky index for the site and the hour
+        TS_F = norm.cdf(TS_norm)
+        watch.lap('norm_cdf')
+        TS = cdf_lookup(cdf, b_levels[:, np.newaxis, :], TS_F, cdf_interp)
+        watch.lap('cdf_lookup')
 
+        TS_year[b_start*60:(b_start + n_hrs)*60] = TS.reshape(n_hrs*60, N)
+        watch.lap('stitch')
 
-def spectral_amplitude_matrix(kbars, cohere, psd ):
-    """
-    Status:
+    return TS_year
 
+def synthesize_overlap(hour_index, parameters, block_hours = 168):
+    """
     Purpose:
-    Calculate the spectral amplitude matrix that accounts for the average clearsky
-     index at each site and the correlation between sites
- 
+    Overlap mode of synthesize_year(): synthesize the 1-min clearsky index of 
+     each site as one continuous series instead of hour by hour, so there are 
+     no seams between hours.
+     - The normalized (Gaussian) series is a weighted overlap-add of 64-minute
+        frames that start every 32 minutes on a grid fixed in time (minutes 
+        since 1970), each the inverse FFT of the coherent white noise of every
+        site scaled by the PSD for the time of the middle of the frame.  The 
+        PSD of a frame is interpolated linearly in time between the PSDs of 
+        the hours before and after it, so the spectral weights change smoothly
+        from hour to hour.  Each frame is weighted by a sine window, and every 
+        minute is covered by two frames whose squared weights add up to 1, so 
+        the variance follows the interpolated PSD without steps.  The frames of
+        a block of hours are transformed in one batched FFT over the frames 
+        and the sites.
+     - Each minute is mapped through the CDF of the clearsky index level of 
+        its hour, and shifted by a smooth level transition: a quadratic in each
+        hour that is zero on average over the hour (so the hourly mean of the 
+        mapped values is unchanged) and that meets the midpoint of the mean 
+        levels of two hours at the boundary between them.  Values are kept at
+        0 or above.
+     The hours before and after hour_index are used for the interpolation when
+     the sites have data for them, so with a seed a run made of separate ranges
+     of hours (e.g. synthesize_stream()) is the same as one run of every hour.
+
     Input:
-    kbars - a Series object indexed by site id with each sites hourly average 
-             clearsky index for the hour
-    cohere - a Panel data item with items being the position of the corresponding 
-              frequency in the frequencies list, indexed by the site id and columns
-              with the site id from the distance matrix
-              cohere[freq_idx][col site id][row site_id]
-    psd - a Panel object with the hourly clearsky index as the items, and columns 
-           containing the spectral coefficient for each frequency 
+    hour_index - DatetimeIndex of consecutive hours to synthesize
+    parameters - same list of parameters as synthesize_hour()
+    block_hours - number of hours synthesized in each block
 
     Output:
-    S - a Panel data item with items being the position of the corresponding 
-         frequency in the frequencies list, indexed by the site id and columns
-         with the site id from the distance matrix
-         S[freq_idx][col site id][row site_id]
-
+    TS_year - array (minutes X sites) of the 1-min clearsky index, the same 
+               layout as synthesize_year()
     """
+    #### Unpack the parameters 
+    solar_sites, site_index, coh_factor, cdf, sqrt_psd, freqs, factor_key, \
+        seed, site_keys, cdf_interp = parameters
+
+    hour_index = pd.DatetimeIndex(hour_index)
+    h_keys = hour_keys(hour_index).astype(np.int64)
+    if (np.diff(h_keys) != 1).any():
+        raise ValueError("The overlap mode needs consecutive hours")
+
+    #### Levels of the hours with two hours before and after the range (the 
+    ####  hours next to each block and the hours next to those, which set the 
+    ####  PSD of the frames that cover them), which repeat the first and last 
+    ####  hour where the sites have no data for them 
+    ext_index = pd.date_range(hour_index[0] - tdelta(hours = 2), 
+                              periods = len(hour_index) + 4, freq = 'H')
+    kbars = kbar_matrix(solar_sites, ext_index)
+    for i, j in [(1, 2), (0, 1), (-2, -3), (-1, -2)]:
+        if np.isnan(kbars[i]).any():
+            kbars[i] = kbars[j]
+    levels = kbar_levels(kbars)
+
+    coh_factor = real_factor(coh_factor)
+    F, N = coh_factor.shape[0], coh_factor.shape[1]
+    n = (F-1)*2
+    hop = n // 2
+
+    #### Power of the PSD and mean clearsky index of each level, and the 
+    ####  mean level of every site and hour 
+    power = np.abs(sqrt_psd)**2
+    level_mean = np.nan_to_num(np.nanmean(cdf, axis = 1))
+    mean_hr = level_mean[levels]
+
+    #### Window of the frames (w[i]**2 + w[i + hop]**2 = 1), and the shape of 
+    ####  the level transition over the minutes of an hour 
+    window = np.sin(np.pi * (np.arange(n) + 0.5) / n)[:, np.newaxis]
+    tau = ((np.arange(60) + 0.5) / 60)[:, np.newaxis]
+    curve = tau * (1 - tau)
+
+    dtype = cdf.dtype
+    TS_year = year_output((len(hour_index)*60, N), dtype = dtype)
+    run_start = h_keys[0] * 60
+
+    METRICS.count('hours', len(hour_index))
+    watch = METRICS.stopwatch()
+
+    #### Without a seed draw a root seed from the numpy random state, so the 
+    ####  frames and hours shared by neighbouring blocks are the same 
+    if seed is None:
+        seed = np.random.randint(0, 2**62, dtype = np.int64)
+
+    for b_start in range(0, len(hour_index), block_hours):
+        n_hrs = min(block_hours, len(hour_index) - b_start)
+
+        #### Each block is synthesized with one more hour on each side (the 
+        ####  positions b_start + 1 to b_start + n_hrs + 2 of ext_index), which 
+        ####  set the level transitions at the edges of the block 
+        n_ext = n_hrs + 2
+        ext = slice(b_start + 1, b_start + 1 + n_ext)
+
+        #### Frames j (starting at minute hop*j since 1970) that cover the 
+        ####  minutes of the hours
+        t_start = run_start + (b_start - 1)*60
+        t_stop = t_start + n_ext*60
+        j_lo = t_start // hop - 1
+        j_hi = (t_stop - 1) // hop
+        frames = np.arange(j_lo, j_hi + 1)
+
+        #### PSD at the middle of each frame, interpolated between the middle of 
+        ####  the hours before and after it (positions in ext_index)
+        pos = (frames*hop + hop - 0.5 - run_start - 29.5) / 60. + 2
+        pos = np.clip(pos, 0, len(ext_index) - 1)
+        h_lo = np.minimum(np.floor(pos).astype(int), len(ext_index) - 2)
+        frac = (pos - h_lo)[:, np.newaxis, np.newaxis]
+        P = (1 - frac) * power[levels[h_lo]] + frac * power[levels[h_lo + 1]]
+        D = np.sqrt(P).astype(sqrt_psd.dtype).transpose(0, 2, 1)
+        watch.lap('s_construction')
+
+        #### White noise of each frame from its own stream 
+        rand = random_uniform(seed, frames.astype(np.uint64) | FRAME_KEY, 
+                              site_keys, F)
+
+        #### Overlap-add of the windowed frames: the first halves of the frames 
+        ####  tile the minutes from the start of the first frame, the second 
+        ####  halves the minutes from one hop later
+        TS_frames = noise_transform(coh_factor, D, rand, dtype, watch) * window
+        n_frames = len(frames)
+        TS_ola = np.zeros(((n_frames + 1)*hop, N), dtype = dtype)
+        TS_ola[:n_frames*hop] += TS_frames[:, :hop].reshape(n_frames*hop, N)
+        TS_ola[hop:] += TS_frames[:, hop:].reshape(n_frames*hop, N)
+        offset = t_start - j_lo*hop
+        TS_norm = TS_ola[offset:offset + n_ext*60].reshape(n_ext, 60, N)
+        watch.lap('invert')
+
+        #### De-normalize with the CDF of the level of each hour 
+        TS_F = norm.cdf(TS_norm)
+        watch.lap('norm_cdf')
+        TS = cdf_lookup(cdf, levels[ext][:, np.newaxis, :], TS_F, cdf_interp)
+
+        #### Level transition of each hour of the block: at each boundary the 
+        ####  midpoint of the mean levels, less the midpoint of the deviations
+        ####  of the hourly means from their levels, and on average over the 
+        ####  hour the deviation of its mean taken away 
+        level = mean_hr[ext]
+        dev = TS.mean(axis = 1) - level
+        bound = (level[:-1] + level[1:]) / 2. - (dev[:-1] + dev[1:]) / 2.
+        start = bound[:-1] - level[1:-1]
+        end = bound[1:] - level[1:-1]
+        bend = (-dev[1:-1] - (start + end) / 2.) / curve.mean()
+        shift = start[:, np.newaxis] + (end - start)[:, np.newaxis] * tau + \
+            bend[:, np.newaxis] * curve
+        TS = np.maximum(TS[1:-1] + shift.astype(dtype), 0)
+        watch.lap('cdf_lookup')
+
+        TS_year[b_start*60:(b_start + n_hrs)*60] = TS.reshape(n_hrs*60, N)
+        watch.lap('stitch')
+
+    return TS_year
+
+def real_factor(coh_factor):
+    """
+    Purpose:
+    The coherence factor is usually real (see batch_transform()), which halves 
+     the work of applying it, so drop the zero imaginary part of a dense factor
+    """
+    if not isinstance(coh_factor, BlockFactor) and not coh_factor.imag.any():
+        coh_factor = np.real(coh_factor)
 
-    #### Build matrix S in the same shape and indcies as cohere 
-    S = pd.Panel(items = cohere.items, major_axis = cohere.major_axis,
-                 minor_axis = cohere.minor_axis, dtype = complex)
+    return coh_factor
 
-    ##Diagonal = PSD for that site
-    for id in kbars.index:
-        # Round kbar to nearest 0.05
-        kbar =  ("%3.2f") % (round(float(kbars[id])*20)/20)
+def noise_transform(coh_factor, D, rand, dtype, watch):
+    """
+    Purpose:
+    Normalized 1-min series of blocks of hours (or frames) and sites from the
+     random phases: white noise made coherent between the sites with the 
+     coherence factor, scaled by the square root of the PSD and inverse 
+     transformed, see synthesize_year()
 
-        #### Load PSD into diagonial 
-        for freq_idx, freq in psd[kbar]['freq'].iteritems():
-            ###---Make the any component with a freq ~< 1 per hour 0 
-            ###   (include 1/64 min)??
-            if freq < 1/3900.:
-                S[freq_idx][id][id] = np.random.random()*10e-6
-            else:
-                S[freq_idx][id][id] = psd[kbar]['psd'][freq_idx]
-       
-    ## Off diagonal = use distance and frequency to calculate cohere, 
-    ##  use that and diagonal to calculate S[i!=j]
-    L = len(S.major_axis)
-    for freq_idx, freq in psd[kbar]['freq'].iteritems():
-        for i in range(L):
-            for j in range(L):
-                if i !=j: #off diagonal
-                    coh = cohere[freq_idx].ix[i].ix[j]
-                    ## Calculate the amplitude of the cross-spectrum from 
-                    ## the coherence and the PSD's
-                    S[freq_idx].ix[i].ix[j] = coh*(S[freq_idx].ix[i].ix[i] * \
-                                                       S[freq_idx].ix[j].ix[j])**0.5
-                    if freq_idx == 0:
-                        S[freq_idx].ix[i].ix[j] = (S[freq_idx].ix[i].ix[j] - \
-                                                       np.random.random()*10e-6)
+    Input:
+    coh_factor - dense coherence factor (F, N, N), or a BlockFactor
+    D - array (blocks, F, N) of the square root of the PSD 
+    rand - array (blocks, F, N) of the random phases on [0, 1)
+    dtype - float type of the output 
+    watch - stopwatch of the METRICS for the timers of the steps 
 
-    return S 
+    Output:
+    TS_full - array (blocks, n, N) with all n = 2*(F-1) minutes of each block
+    """
+    F = D.shape[1]
+    n = (F-1)*2
+    complex_dtype = np.result_type(dtype, np.complex64)
+
+    #### Unit-magnitude white noise for each block, frequency and site 
+    X = np.exp(1j*rand*2*np.pi).astype(complex_dtype)
+    watch.lap('whitenoise')
+
+    #### Fourier coefficients: scale the rows of the coherence factor by the 
+    ####  PSD, V[h, f] = D[h, f] * (L[f] * X[h, f])
+    if isinstance(coh_factor, BlockFactor):
+        V = coh_factor.apply(X)
+    else:
+        V = np.empty(X.shape, dtype = complex_dtype)
+        for freq_idx in range(F):
+            V[:, freq_idx, :] = np.dot(X[:, freq_idx, :], 
+                                       coh_factor[freq_idx].T)
+    watch.lap('transform')
+    V *= D
+    watch.lap('s_construction')
+
+    #### Inverse fourier transform of every block and site (see 
+    ####  factor_norm_TS() for the scaling)
+    TS_full = np.fft.irfft(V*n/2**0.5, axis = 1).astype(dtype)
+    nans = np.isnan(TS_full)
+    if nans.any():
+        METRICS.count('nan_repairs', nans.sum())
+        TS_full[nans] = 0
+    watch.lap('invert')
+
+    return TS_full
+
+def minute_index(hour_index):
+    """
+    Purpose:
+    Create a time series index made up of the 60 minutes from the beginning of 
+     each hour in hour_index
+
+    Input:
+    hour_index - DatetimeIndex of the hours 
 
-def synthysize_norm_TS(S, freqs):
+    Output:
+    year_rng - DatetimeIndex with 60 times the length of hour_index
     """
-    Status:
-    TESTS OKAY
+    hour_index = pd.DatetimeIndex(hour_index)
+    hour_start = hour_index.values - \
+        (np.asarray(hour_index.minute) * 60 * 10**9).astype('timedelta64[ns]')
+    year_rng = (hour_start[:, np.newaxis] + 
+                np.arange(60) * np.timedelta64(60, 's')).ravel()
 
-    Generate N correlated time-series, TS(j in N, output with time),
-    from a spectral matrix \em{S}
-    Where each diagonal of \em{S[fm]} is the power spectral density at average 
-    frequency of fm and each off diagonal is the cross-spectral density 
+    return pd.DatetimeIndex(year_rng)
+
+def year_output(shape, tables_name = None, mode = 'w+', dtype = float):
     """
+    Purpose:
+    Allocate the (minutes X sites) array for the 1-min clearsky index of a full
+     run, with each site's column contiguous in memory so that the series 
+     attached to each site is a view of it.  For parallel runs the array is a 
+     memory-mapped file next to the published tables that the workers write into.
 
-    def invert(V, t):
-        """
-        Do inverse fourier transform of each element of the 
-        N X 1 matrix of complex fourier coefficients (V)
-        (V) musrt be in the format of the output of np.fft.rfft(TS[])
-        """
-        n = (len(V)-1)*2. 
-        
-        #### As described in calcPSD.segPSD, you need to multiply by the number 
-        #### of points, n, to get correct inverse.  It also looks like it needs 
-        #### division by sqrt(2) (emperical - can you find the reason?)
-        TS = np.fft.irfft(V*n/2**0.5) 
+    Input:
+    shape - (minutes, sites)
+    tables_name - name returned by publish_tables(), or None for an array in memory
+    mode - 'w+' to create the memory-mapped file, 'r+' to open it from a worker
+    dtype - float type of the array (float32 for single precision)
+
+    Output:
+    TS_year - float array filled with NaN until each hour is written
+    """
+    if tables_name is None:
+        TS_year = np.empty(shape, dtype = dtype, order = 'F')
+    else:
+        TS_year = np.memmap(os.path.join(tables_name, 'TS_year.dat'), 
+                            dtype = dtype, mode = mode, shape = shape, 
+                            order = 'F')
+    if mode == 'w+':
+        TS_year[:] = np.nan
+
+    return TS_year
+
+def kbar_matrix(solar_sites, hour_index):
+    """
+    Purpose:
+    Collect the hourly average clearsky index of every site into one array 
+
+    Input:
+    solar_sites - list of SolarSite objects 
+    hour_index - DatetimeIndex of the hours 
+
+    Output:
+    kbars - float array with shape (hours, sites)
+    """
+    kbars = np.array([site.clr_idx_hr.reindex(hour_index).values 
+                      for site in solar_sites], dtype = float).T
+
+    return kbars
+
+def cdf_lookup(cdf_arr, levels, TS_F, interpolate = False):
+    """
+    Purpose:
+    Look up the clearsky index at each probability level in the CDF for the 
+     site's hourly average clearsky index level, for a whole block of minutes and
+     sites in one gather
+
+    Input:
+    cdf_arr - array (K, 1001) from cdf_table() 
+    levels - integer kbar levels, broadcastable to the shape of TS_F
+    TS_F - array of probabilities on [0, 1] 
+    interpolate - if False round each probability to the nearest 0.001 (the 
+                   levels of the table), if True interpolate linearly between the
+                   two nearest levels
+
+    Output:
+    TS - array of the clearsky index with the shape of TS_F
+    """
+    n_prob = cdf_arr.shape[1] - 1
+    prob = np.clip(np.asarray(TS_F, dtype = float) * n_prob, 0, n_prob)
+
+    if not interpolate:
+        TS = cdf_arr[levels, np.round(prob).astype(int)]
+    else:
+        prob_lo = np.minimum(np.floor(prob).astype(int), n_prob - 1)
+        weight = (prob - prob_lo).astype(cdf_arr.dtype)
+        TS = (1 - weight) * cdf_arr[levels, prob_lo] + \
+            weight * cdf_arr[levels, prob_lo + 1]
+
+    return TS
+
+def publish_tables(tables, tables_name = None):
+    """
+    Purpose:
+    Write the read-only tables for the synthesis (e.g. the coherence factor, PSD
+     and CDF lookup tables) once to a temporary directory, so that worker 
+     processes can memory map them by name with attach_tables() instead of 
+     receiving a pickled copy with every task
+
+    Input:
+    tables - list of the tables, numpy arrays are stored as .npy files and any 
+              other objects are pickled together
+    tables_name - optional directory to write the tables to (e.g. on a file 
+                   system shared with other machines) instead of a new 
+                   temporary directory
+
+    Output:
+    tables_name - name (the directory) used by attach_tables() and 
+                   release_tables()
+    """
+    if tables_name is None:
+        tables_name = tempfile.mkdtemp(prefix = 'solar_synth_')
+    elif not os.path.isdir(tables_name):
+        os.makedirs(tables_name)
+
+    objects = []
+    for i, table in enumerate(tables):
+        if isinstance(table, np.ndarray) and table.dtype != object:
+            np.save(os.path.join(tables_name, 'table_%s.npy' % i), table)
+            objects.append(None)
+        else:
+            objects.append(table)
+
+    save_file = open(os.path.join(tables_name, 'tables.pkl'), 'wb')
+    cPickle.dump(objects, save_file, cPickle.HIGHEST_PROTOCOL)
+    save_file.close()
+
+    return tables_name
+
+#### Tables attached by this process, by name
+_ATTACHED_TABLES = {}
+
+def attach_tables(tables_name):
+    """
+    Purpose:
+    Attach to the tables published by publish_tables(), with the arrays memory
+     mapped read-only.  Each process only attaches once to each name. 
+
+    Input:
+    tables_name - name returned by publish_tables()
+
+    Output:
+    tables - list of the tables in the same order they were published
+    """
+    try:
+        return list(_ATTACHED_TABLES[tables_name])
+    except KeyError:
+        pass
+
+    tables = cPickle.load(open(os.path.join(tables_name, 'tables.pkl'), 'rb'))
+    for i in range(len(tables)):
+        if tables[i] is None:
+            tables[i] = np.load(os.path.join(tables_name, 'table_%s.npy' % i),
+                                mmap_mode = 'r')
+
+    _ATTACHED_TABLES[tables_name] = tables
+
+    return list(tables)
+
+def release_tables(tables_name):
+    """
+    Purpose:
+    Remove the files written by publish_tables().  The tables attached by this 
+     process are dropped first so that their memory maps are closed; any other 
+     memory map of the files (e.g. a year array from year_output()) has to be 
+     closed by the caller.  Raises OSError if the files cannot be removed.
+    """
+    _ATTACHED_TABLES.pop(tables_name, None)
+    shutil.rmtree(tables_name)
+
+def cdf_table(cdf):
+    """
+    Purpose:
+    Compile the within-hour CDF lookup table into a dense array indexed by the 
+     integer kbar level from kbar_levels() and the integer probability level 
+     (F*1000, from 0 to 1000).  The stored table stops at F = 0.999, so the 
+     F = 1.000 level holds the 0.999 value, and any gap in the stored 
+     probabilities is filled by linear interpolation. 
+
+    Input:
+    cdf - Dataframe from clearsky_index_distribution()
+
+    Output:
+    cdf_arr - float array with shape (K, 1001)
+    """
+    items = sorted(cdf.columns, key = float)
+    values = np.array([cdf[kbar].values for kbar in items], dtype = float)
+
+    return cdf_levels(np.asarray(cdf.index, dtype = float), values)
+
+def cdf_levels(cdf_prob, values):
+    """
+    Purpose:
+    Array version of cdf_table() 
+
+    Input:
+    cdf_prob - array (P,) of the stored cumulative probabilities
+    values - array (K, P) of the clearsky index at each probability for each 
+              kbar level, NaN where there is no value
+
+    Output:
+    cdf_arr - float array with shape (K, 1001)
+    """
+    prob_idx = np.round(np.asarray(cdf_prob, dtype = float) * 1000).astype(int)
+    all_idx = np.arange(1001)
+
+    cdf_arr = np.empty((len(values), len(all_idx)))
+    for level in range(len(values)):
+        level_values = np.asarray(values[level], dtype = float)
+        good = ~np.isnan(level_values)
+        ## np.interp holds the end values outside of the stored levels
+        cdf_arr[level] = np.interp(all_idx, prob_idx[good], level_values[good])
+
+    return cdf_arr
+
+def test_synthesize_norm_hour(dt, parameters):
+    """ Test function used only to examine a full year of normalized output 
+    Purpose:
+
+    Replicate the function of synthesize_hour(), but direclty output the normalized 
+    timeseries so that a full year can be checked for abnormal behaviour at the hour-
+    to-hour seams.  
+
+    Intput:
+    Same as synthesize_hour()
+
+    Output:
+    TS_norm - normalized time series like TS from synthesize_hour()
+
+    """
+
+    #### Unpack the parameters 
+    solar_sites, site_index, coh_factor, cdf, sqrt_psd, freqs, factor_key, \
+        seed, site_keys, cdf_interp = parameters
+
+    #### Calculate the factor of the spectral amplitude matrix depending on the 
+    ####  sites average clearsky index for the hour and the correlation between 
+    ####  sites
+
+    ## Build a DataFrame object that has the hourly clearsky index for each site
+    ## indexed by the site id
+    kbars = [site.clr_idx_hr[dt] for site in solar_sites]
+    kbars = pd.Series(kbars, index = site_index)
+    levels = kbar_levels(kbars)
+
+    ## Use this hourly average clearsky value to scale the coherence factor,
+    ##  unless the factor for the same levels is already in the cache
+    key = (factor_key, tuple(levels))
+    H = FACTOR_CACHE.get(key)
+    if H is None:
+        H = spectral_factor(levels, coh_factor, sqrt_psd)
+        FACTOR_CACHE.put(key, H)
+
+    #### Random numbers for the phases of the white noise, from the stream of 
+    ####  each site for this hour if a seed is given 
+    if seed is None:
+        rand = None
+    else:
+        rand = random_uniform(seed, hour_keys([dt]), site_keys, len(freqs))[0]
+
+    #### Synthesize the 1-min time series or normalized clearksy index 
+    ####  (on a uniform distribution) for each site for the hour
+    TS_norm = factor_norm_TS(H, freqs, site_index, rand)
+
+    for id in TS_norm.columns:
+        if pd.isnull(TS_norm[id]).sum() >0:
+            print "TS_norm has Nan at " + str(dt) + " !!!"
+            TS_norm[id] = TS_norm[id].fillna(0)
+
+    #### For each site within the hour: 
+    d = {}
+    for id in site_index:
+        d[id] = TS_norm[id].values[:60]
+
+    #### Create a time series index that starts at the begining of the hour 
+    #### (based on dt) and goes to the end of the hour
+    start_dt = dt - datetime.timedelta(seconds = dt.minute * 60)
+    hour_rng = pd.date_range(start_dt, periods=60, freq='min')
         
-        TS = pd.Series(TS, index = t)
+    #### Convert the clearsky index into a timeseries that starts at the
+    #### beginning of the hour and coninutes to the end of the hour
+    TS_norm = pd.DataFrame(d, index = hour_rng)
 
-        return TS
+    return TS_norm 
+
+
+
+def spectral_amplitude_matrix(kbars, cohere, psd ):
+    """
+    Status:
+
+    Purpose:
+    Calculate the spectral amplitude matrix that accounts for the average clearsky
+     index at each site and the correlation between sites
+ 
+    Input:
+    kbars - a Series object indexed by site id with each sites hourly average 
+             clearsky index for the hour, in the same order as the rows of cohere
+    cohere - an array with shape (F, N, N) from coherence_matrix() 
+              cohere[freq_idx, row, col]
+    psd - a Panel object with the hourly clearsky index as the items, and columns 
+           containing the spectral coefficient for each frequency 
+
+    Output:
+    S - a complex array with shape (F, N, N) with the first axis being the 
+         position of the corresponding frequency in the frequencies list and the
+         rows and columns in the same order as cohere 
+         S[freq_idx, row, col]
+
+    """
+    #### Regularize the coherence the same way as coherence_factor() so that S
+    ####  can be factored at every frequency
+    cohere = regularize_coherence(cohere)
+
+    ##Diagonal = PSD for that site, organized as D[freq_idx, site row]
+    D = psd_table(psd)[kbar_levels(kbars)].T
+
+    ## Off diagonal = use distance and frequency to calculate cohere, 
+    ##  use that and diagonal to calculate S[i!=j] 
+    ## Calculate the amplitude of the cross-spectrum from the coherence and the
+    ## PSD's for every frequency and pair of sites at once
+    S = D[:, :, np.newaxis] * cohere * D[:, np.newaxis, :]
+
+    return S 
+
+def psd_table(psd):
+    """
+    Purpose:
+    Convert the PSD lookup table into an array of the square root of the PSD 
+     (the spectral amplitude) for each hourly clearsky index level and frequency. 
+     Any component with a freq ~< 1 per hour (LOW_FREQ_CUTOFF) is set to the 
+     small value LOW_FREQ_PSD 
+
+    Input:
+    psd - a Panel object with the hourly clearsky index as the items, and columns 
+           containing the spectral coefficient 'psd' for each frequency 'freq'
+
+    Output:
+    sqrt_psd - complex array with shape (K, F) with the first axis being the 
+                kbar level (kbar = level * 0.05) from kbar_levels() 
+    """
+    #### Sort the items by the hourly clearsky index value
+    items = sorted(psd.items, key = float)
+    freqs = np.real(psd[items[0]]['freq'].values.astype(complex))
+
+    table = np.array([psd[kbar]['psd'].values for kbar in items], dtype = complex)
+
+    return spectral_amplitude(freqs, table)
+
+def spectral_amplitude(freqs, table):
+    """
+    Purpose:
+    Array version of psd_table() 
+
+    Input:
+    freqs - array (F,) of the frequencies (Hz)
+    table - complex array (K, F) of the PSD for each kbar level and frequency
+
+    Output:
+    sqrt_psd - complex array with shape (K, F)
+    """
+    table = np.array(table, dtype = complex)
+
+    ###---Make the any component with a freq ~< 1 per hour 0 
+    ###   (include 1/64 min)??
+    table[:, np.asarray(freqs) < LOW_FREQ_CUTOFF] = LOW_FREQ_PSD
+
+    sqrt_psd = table**0.5
+
+    return sqrt_psd
+
+def kbar_levels(kbars, n_levels = 25):
+    """
+    Purpose:
+    Round the hourly average clearsky index of each site to the nearest 0.05 and 
+     return it as the integer level used to index psd_table() (level = kbar*20).
+     Values outside of the lookup tables (0 to 1.20) are clipped to the table. 
+
+    Input:
+    kbars - list, Series or array of hourly clearsky index values
+    n_levels - number of levels in the lookup tables
+
+    Output:
+    levels - integer array with the level of each kbar
+    """
+    kbars = np.asarray(kbars, dtype = float)
+    levels = np.round(kbars*20).astype(int)
+    levels = np.clip(levels, 0, n_levels - 1)
+
+    return levels
+
+def regularize_coherence(cohere, reg = COHERENCE_REG):
+    """
+    Purpose:
+    Add a small value to the diagonal of each coherence matrix and rescale so that
+     the diagonal is still 1.  This keeps every coherence matrix positive definite
+     (at the lowest frequencies the coherence is ~1 between all sites).
+
+    Input:
+    cohere - array (F, N, N) from coherence_matrix() 
+    reg - relative amount added to the diagonal
+
+    Output:
+    cohere - regularized array (F, N, N)
+    """
+    N = cohere.shape[-1]
+    cohere = (cohere + reg * np.eye(N)) / (1. + reg)
+
+    return cohere
+
+def coherence_factor(cohere):
+    """
+    Purpose:
+    The spectral matrix for an hour is S_f = D_f C_f D_f where D_f is a diagonal 
+     matrix of the square root of each site's PSD and C_f is the coherence, which 
+     only depends on the distance between sites.  The lower-triangular factor of S_f 
+     is then D_f * L_f, where L_f is the factor of C_f.  Calculate L_f once for 
+     every frequency so that each hour only needs to scale its rows.
+
+    Input:
+    cohere - array (F, N, N) from coherence_matrix()
+
+    Output:
+    coh_factor - array (F, N, N) of the lower-triangular factor of the regularized
+                  coherence for each frequency
+    """
+    coh_factor = batch_transform(regularize_coherence(cohere))
+
+    return coh_factor
+
+class BlockFactor:
+    """
+    Purpose:
+     Lower-triangular factor of the coherence (or spectral) matrix of each 
+     frequency stored as independent blocks of sites.  Sites in different blocks 
+     are treated as having zero coherence, so only the blocks are factored and 
+     stored.  Sites that are alone in their block are kept together as one 
+     diagonal block.
+
+    Input:
+    n_sites - total number of sites (N)
+    blocks - list with an entry for each frequency, each a list of (idx, L) where
+              idx is an array of site rows and L is the lower-triangular factor 
+              for those sites (or a 1-D array for a diagonal block)
+
+    Data:
+    blocks, shape (F, N, N), nbytes
+
+    Methods:
+    scale_rows(D) - new BlockFactor with the rows of each frequency scaled by 
+                     D[freq_idx, site row]
+    apply(X) - multiply the factor of each frequency with the vectors in X, which
+                has a shape of (..., F, N)
+    astype(dtype) - new BlockFactor with the blocks stored as dtype 
+    """
+    def __init__(self, n_sites, blocks):
+        self.blocks = blocks
+        self.shape = (len(blocks), n_sites, n_sites)
+        self.nbytes = sum([idx.nbytes + L.nbytes for f_blocks in blocks
+                           for idx, L in f_blocks])
+
+    def scale_rows(self, D):
+        blocks = []
+        for freq_idx, f_blocks in enumerate(self.blocks):
+            scaled = []
+            for idx, L in f_blocks:
+                if L.ndim == 1:
+                    scaled.append((idx, D[freq_idx, idx] * L))
+                else:
+                    scaled.append((idx, D[freq_idx, idx][:, np.newaxis] * L))
+            blocks.append(scaled)
+
+        return BlockFactor(self.shape[1], blocks)
+
+    def astype(self, dtype):
+        blocks = [[(idx, L.astype(dtype)) for idx, L in f_blocks]
+                  for f_blocks in self.blocks]
+
+        return BlockFactor(self.shape[1], blocks)
+
+    def apply(self, X):
+        V = np.zeros(X.shape, dtype = np.result_type(X.dtype, np.complex64))
+        for freq_idx, f_blocks in enumerate(self.blocks):
+            X_f = X[..., freq_idx, :]
+            for idx, L in f_blocks:
+                if L.ndim == 1:
+                    V[..., freq_idx, idx] = X_f[..., idx] * L
+                else:
+                    V[..., freq_idx, idx] = np.dot(X_f[..., idx], L.T)
+
+        return V
+
+def block_coherence_factor(dist_mtx, frequencies, tol = COHERENCE_TOL, 
+                           max_km = None, max_sites = BLOCK_MAX_SITES):
+    """
+    Purpose:
+    Block version of coherence_factor() for large numbers of sites.  At high 
+     frequencies the coherence is nearly zero beyond a few km, so for each 
+     frequency the sites are split into clusters where every site is within the
+     distance at which the coherence drops to tol of another site in the cluster
+     (single-linkage clusters, found by cutting the minimum spanning tree of the
+     distance matrix).  Each cluster is factored on its own, and the coherence
+     between clusters is treated as zero.  At the lowest frequencies that would
+     be one cluster of every site, so the clusters are also limited to 
+     max_sites sites (see capped_links()), which keeps the factorization at 
+     O(N * max_sites**2) instead of O(N**3).
+
+    A cluster whose coherence matrix is not positive definite (which can happen 
+     with a sparse distance matrix, where pairs beyond the neighbour cutoff have
+     zero coherence) is factored with the complex recursion of batch_transform()
+     and a warning is given, since its output only approximates the coherence.
+
+    Input:
+    dist_mtx - Dataframe or array with distance between two sites in km for each
+                pair, or a sparse matrix from neighbor_distance_matrix()
+    frequencies - a list of frequncies 
+    tol - coherence below which two sites are treated as independent
+    max_km - optional upper limit on the linking distance, which limits the size 
+              of the clusters at the lowest frequencies (where the coherence is 
+              significant across the full region)
+    max_sites - largest number of sites in a cluster, or None for no limit 
+
+    Output:
+    coh_factor - BlockFactor with the factor of the regularized coherence of each
+                  cluster for each frequency
+    """
+    is_sparse = sparse.issparse(dist_mtx)
+    if is_sparse:
+        dist = dist_mtx.tocsr()
+    else:
+        dist = np.asarray(dist_mtx, dtype = float)
+    N = dist.shape[0]
+    freqs = np.real(np.asarray(frequencies, dtype = complex))
+
+    #### The single-linkage clusters for any distance are the connected parts of 
+    ####  the minimum spanning tree after removing the longer edges 
+    mst = csgraph.minimum_spanning_tree(dist).tocoo()
+    linked = capped_links(mst, max_sites)
+
+    blocks = []
+    indefinite = []
+    for f in freqs:
+        link_km = coherence_distance(f, tol)
+        if max_km is not None:
+            link_km = min(link_km, max_km)
+
+        keep = linked & (mst.data < link_km)
+        graph = sparse.coo_matrix((np.ones(keep.sum()), 
+                                   (mst.row[keep], mst.col[keep])), shape = (N, N))
+        n_clusters, labels = csgraph.connected_components(graph, directed = False)
+
+        #### Group the site rows by cluster 
+        sizes = np.bincount(labels, minlength = n_clusters)
+        order = np.argsort(labels, kind = 'mergesort')
+        clusters = np.split(order, np.cumsum(sizes)[:-1])
+
+        f_blocks = []
+        singles = np.array([c[0] for c in clusters if len(c) == 1], dtype = int)
+        if len(singles) > 0:
+            f_blocks.append((singles, np.ones(len(singles))))
+        for idx in clusters:
+            if len(idx) > 1:
+                if is_sparse:
+                    C = coherence_model(f, dense_distances(dist[idx][:, idx]))
+                else:
+                    C = coherence_model(f, dist[np.ix_(idx, idx)])
+                C = regularize_coherence(C[np.newaxis])[0]
+                try:
+                    L = np.linalg.cholesky(C)
+                except np.linalg.LinAlgError:
+                    indefinite.append(f)
+                    L = batch_transform(C[np.newaxis])[0]
+                f_blocks.append((idx, L))
+        blocks.append(f_blocks)
+
+    if indefinite:
+        METRICS.count('indefinite_blocks', len(indefinite))
+        warnings.warn("%s blocks of sites (at %s frequencies from %.3g Hz) are "
+                      "not positive definite and were factored with the complex "
+                      "recursion, so their coherence is only approximate; use a "
+                      "larger neighbor_km" % (len(indefinite), 
+                                              len(set(indefinite)), 
+                                              min(indefinite)))
+
+    return BlockFactor(N, blocks)
+
+def capped_links(mst, max_sites):
+    """
+    Purpose:
+    Pick the edges of a minimum spanning tree that link the sites into clusters
+     of at most max_sites: going from the shortest edge up, each edge is linked 
+     unless it would join two clusters with more than max_sites sites.  Whether
+     an edge is linked only depends on the shorter edges, so the clusters for 
+     any linking distance are the linked edges shorter than that distance.
+
+    Input:
+    mst - scipy.sparse coo_matrix (N X N) of the minimum spanning tree 
+    max_sites - largest number of sites in a cluster, or None for no limit
+
+    Output:
+    linked - boolean array with an entry for each edge of mst 
+    """
+    N = mst.shape[0]
+    linked = np.ones(len(mst.data), dtype = bool)
+    if max_sites is None or N <= max_sites:
+        return linked
+
+    #### Union-find of the clusters 
+    parent = range(N)
+    size = [1] * N
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    rows, cols = mst.row.tolist(), mst.col.tolist()
+    for e in np.argsort(mst.data, kind = 'mergesort'):
+        a, b = find(rows[e]), find(cols[e])
+        if size[a] + size[b] > max_sites:
+            linked[e] = False
+        else:
+            parent[b] = a
+            size[a] += size[b]
+
+    return linked
+
+def spectral_factor(levels, coh_factor, sqrt_psd):
+    """
+    Purpose:
+    Scale the rows of the coherence factor by the square root of the PSD for each 
+     site's hourly clearsky index level to get the lower-triangular factor of the
+     spectral amplitude matrix for the hour
+
+    Input:
+    levels - integer kbar level for each site from kbar_levels()
+    coh_factor - array (F, N, N) from coherence_factor() or a BlockFactor from 
+                  block_coherence_factor()
+    sqrt_psd - array (K, F) from psd_table()
+
+    Output:
+    H - complex array (F, N, N) with H[f] * H[f].T = S[f] (or a BlockFactor)
+    """
+    D = sqrt_psd[levels].T
+    if isinstance(coh_factor, BlockFactor):
+        H = coh_factor.scale_rows(D)
+    else:
+        H = D[:, :, np.newaxis] * coh_factor
+
+    return H
+
+def batch_transform(S):
+    """
+    Status:
+    TESTS MATCH transform() IN synthysize_norm_TS
+
+    Purpose:
+    Populate the lower-triangular matrix H for every frequency of the spectral
+     matrix at once.  This is the same recursive formula as transform() in
+     synthysize_norm_TS (H[f] * H[f].T = S[f], reading S[f] from the upper
+     triangle), but each step of the recursion is applied to the full stack of
+     frequencies as one array operation.
+
+    Input:
+    S - complex array of spectral matrices with shape (F, N, N) organized as
+         S[freq_idx, row, col]
+
+    Output:
+    H - complex array of lower-triangular matrices with shape (F, N, N)
+    """
+    S = np.asarray(S, dtype = complex)
+    F, N = S.shape[0], S.shape[-1]
+
+    #### The recursion reads S[k, j] for j >= k, so work with the transpose and
+    ####  use its lower triangle
+    S_T = S.swapaxes(-1, -2)
+    H = np.zeros_like(S)
+
+    #### When a matrix is real (up to round off) and positive definite the
+    ####  recursion is the Cholesky factorization, which LAPACK does directly
+    is_real = np.abs(S_T.imag).max(axis = 2).max(axis = 1) <= \
+        1e-12 * np.abs(S_T.real).max(axis = 2).max(axis = 1)
+    use_lapack = np.zeros(F, dtype = bool)
+    if is_real.all():
+        try:
+            H[:] = np.linalg.cholesky(S_T.real)
+            return H
+        except np.linalg.LinAlgError:
+            pass
+    for freq_idx in np.nonzero(is_real)[0]:
+        try:
+            H[freq_idx] = np.linalg.cholesky(S_T[freq_idx].real)
+            use_lapack[freq_idx] = True
+        except np.linalg.LinAlgError:
+            pass
+
+    #### Any frequency that is complex or not positive definite goes through the
+    ####  recursion in transform(), one column at a time for all of these
+    ####  frequencies together
+    rest = np.nonzero(~use_lapack)[0]
+    if len(rest) > 0:
+        S_r = S_T[rest]
+        H_r = np.zeros_like(S_r)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            for k in range(N):
+                H_k = H_r[:, k, :k]
+                H_r[:, k, k] = (S_r[:, k, k] - (H_k**2).sum(axis = 1))**0.5
+                if k < N - 1:
+                    sumH = np.einsum('fjl,fl->fj', H_r[:, k+1:, :k], H_k)
+                    H_r[:, k+1:, k] = (S_r[:, k+1:, k] - sumH) / \
+                        H_r[:, k, k][:, np.newaxis]
+        H[rest] = H_r
+
+    return H
+
+def hour_keys(hour_index):
+    """
+    Purpose:
+    Integer key for each hour (hours since 1970), used to pick the random stream
+     of the hour in random_uniform()
+
+    Input:
+    hour_index - list or DatetimeIndex of the hours 
+
+    Output:
+    keys - uint64 array 
+    """
+    ns = pd.DatetimeIndex(hour_index).asi8
+    keys = (ns // (3600 * 10**9)).astype(np.uint64)
+
+    return keys
+
+def site_hashes(site_index):
+    """
+    Purpose:
+    64-bit key for each site id, used to pick the random stream of the site in 
+     random_uniform().  The key only depends on the site id, not on the position
+     of the site in the list. 
+
+    Input:
+    site_index - list or Index of site ids
+
+    Output:
+    keys - uint64 array 
+    """
+    keys = [int(hashlib.sha1(str(id)).hexdigest()[:16], 16) for id in site_index]
+
+    return np.array(keys, dtype = np.uint64)
+
+def _mix64(z):
+    """
+    SplitMix64 finalizer: scramble an array of uint64 values 
+    """
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    z = z ^ (z >> np.uint64(31))
+
+    return z
+
+def random_uniform(seed, h_keys, s_keys, n_freqs):
+    """
+    Purpose:
+    Uniform random numbers on [0, 1) for the phase of each hour, frequency and 
+     site.  Each (seed, hour, site) has its own counter-based stream (a SplitMix64
+     hash of the keys, indexed by the frequency), so the numbers for an hour and 
+     site are always the same no matter which process draws them, in what order,
+     or which other hours and sites are synthesized with them.
+
+    Input:
+    seed - root seed (integer)
+    h_keys - uint64 array of hour keys from hour_keys()
+    s_keys - uint64 array of site keys from site_hashes()
+    n_freqs - number of frequencies 
+
+    Output:
+    rand - float array with shape (hours, n_freqs, sites)
+    """
+    golden = np.uint64(0x9e3779b97f4a7c15)
+    h_keys = np.asarray(h_keys, dtype = np.uint64)
+    s_keys = np.asarray(s_keys, dtype = np.uint64)
+
+    #### Starting state of the stream for each hour and site 
+    root = _mix64(np.array([seed], dtype = np.uint64))
+    state = _mix64(root ^ _mix64(h_keys)[:, np.newaxis])
+    state = _mix64(state ^ s_keys[np.newaxis, :])
+
+    #### Step each stream once for each frequency 
+    steps = (np.arange(1, n_freqs + 1, dtype = np.uint64) * golden)
+    z = _mix64(state[:, np.newaxis, :] + steps[np.newaxis, :, np.newaxis])
+
+    #### Use the top 53 bits for a float on [0, 1)
+    rand = (z >> np.uint64(11)).astype(float) * 2.**-53
+
+    return rand
+
+def synthysize_norm_TS(S, freqs, site_index, engine = 'batch'):
+    """
+    Status:
+    TESTS OKAY
+
+    Generate N correlated time-series, TS(j in N, output with time),
+    from a spectral matrix \em{S}
+    Where each diagonal of \em{S[fm]} is the power spectral density at average
+    frequency of fm and each off diagonal is the cross-spectral density
+
+    S - complex array (F, N, N) from spectral_amplitude_matrix()
+    freqs - frequencies of the first axis of S
+    site_index - site ids in the order of the rows of S
+    engine - 'batch' to factor every frequency of S at once with
+              batch_transform(), or 'recursive' to factor each frequency with the
+              element-by-element transform() below
+    """
 
     def transform(S):
         """
@@ -660,21 +2290,72 @@ def synthysize_norm_TS(S, freqs):
         return H
     #----End transform
 
-    def whitenoise(ids):
+    #### Calculate the lower-triangular transformation matrix (N X N), H(f_m),
+    ####  based on the spectral matrix for each average frequency, S_fm
+    if engine == 'batch':
+        ## Factor the spectral matrix of every frequency in one step
+        H = batch_transform(S)
+    else:
+        H = np.array([transform(pd.DataFrame(S_fm, columns = site_index,
+                                             index = site_index,
+                                             dtype = complex)).values
+                      for S_fm in S])
+
+    TS = factor_norm_TS(H, freqs, site_index)
+
+    return TS
+
+def factor_norm_TS(H, freqs, site_index, rand = None):
+    """
+    Status:
+    TESTS OKAY
+
+    Purpose:
+    Generate N correlated time-series, TS(j in N, output with time), from the 
+     lower-triangular factor H of the spectral matrix for each frequency, where 
+     H[fm] * H[fm].T = S[fm]
+
+    Input:
+    H - complex array (F, N, N) from batch_transform() or spectral_factor(), or
+         a BlockFactor
+    freqs - frequencies of the first axis of H
+    site_index - site ids in the order of the rows of H
+    rand - optional array (F, N) of uniform random numbers on [0, 1) for the 
+            phase of the white noise, otherwise they are drawn from np.random
+
+    Output:
+    TS - DataFrame of the normalized time series indexed by minute with a column 
+          for each site id
+    """
+
+    def invert(V, t):
         """
-        Create an N X N diagonal matrix, X, of whitenoise with unit-magnitude
+        Do inverse fourier transform of each element of the 
+        N X 1 matrix of complex fourier coefficients (V)
+        (V) musrt be in the format of the output of np.fft.rfft(TS[])
         """
-        #### Initialize the whitenoise matrix
-        X = pd.DataFrame(index = ids, columns = ids, dtype = complex)
-
-        for k in X.columns:
-            for j in X.index:
-                if j == k: # a diagnoal element
-                    # generate uniform random number on [0,2pi]
-                    theta = np.random.rand()*2*np.pi 
-                    X[j][k] = np.exp(1j*theta) 
-                else:
-                    X[j][k] = 0
+        n = (len(V)-1)*2. 
+        
+        #### As described in calcPSD.segPSD, you need to multiply by the number 
+        #### of points, n, to get correct inverse.  It also looks like it needs 
+        #### division by sqrt(2) (emperical - can you find the reason?)
+        TS = np.fft.irfft(V*n/2**0.5, axis = 0) 
+        
+        TS = pd.DataFrame(TS, index = t, columns = site_index)
+
+        return TS
+
+    def whitenoise(F, N):
+        """
+        Create the diagonal of an N X N diagonal matrix, X, of whitenoise with 
+        unit-magnitude for each of the F frequencies
+        """
+        # generate uniform random number on [0,2pi]
+        if rand is None:
+            theta = np.random.rand(F, N)*2*np.pi 
+        else:
+            theta = rand*2*np.pi
+        X = np.exp(1j*theta) 
 
         return X 
     #----End whitenoise
@@ -683,70 +2364,59 @@ def synthysize_norm_TS(S, freqs):
         """
         Estimate the complex fourier coefficients of the simulated wind speeds 
         """
-        #### Create a vector of ones indexed by the site ids 
-        ones = pd.Series(1, index = X.columns)
-        #### Estimate the complex fourier coefficient for each site 
-        V = H.dot(X).dot(ones)
+        #### Estimate the complex fourier coefficient for each site, which is 
+        ####  H * diag(X) * ones for each frequency
+        if isinstance(H, BlockFactor):
+            V = H.apply(X)
+        else:
+            V = np.einsum('fjk,fk->fj', H, X)
         
         return V
 
     #----End four_coeff
 
-    #### Initialize the N X M array of the Fouier coefficients of the simulated 
-    ####  wind speeds for N
-    ####  and time series of lenght M
-    
-    V = pd.DataFrame(index = freqs, columns = S[0].columns, dtype = complex)
-
-    #### Calcualte the Fourier coefficients of the simulated wind speeds,
-    ####  iterate over each average frequency
-
-    for freq_idx, S_fm in S.iteritems():
-        #### Calculate the lower-triangular transformation matrix (N X N) ,
-        #### H(f_m), based on the 
-        #spectral matrix for the average frequency, S_fm
-        H_fm = transform(S_fm)
-
-        #### Create a N X N diagonal matrix of unit-magnitude independent white 
-        #### noise inputs (X)
-        X = whitenoise(S_fm.columns)
-
-        #Calculate the N X 1 matrix of the complex Fouier coefficients of 
-        #the simulated wind speeds, where each N is a different site, j    
-        V.ix[freq_idx] = four_coeff(H_fm,X)
-    
-    #### Initialize a DataFrame of with the time in minutes as the index and the 
-    #### columns corresponding to the site ID 
+    #### Create a N X N diagonal matrix of unit-magnitude independent white 
+    #### noise inputs (X) for each frequency
+    F, N = H.shape[0], H.shape[1]
+    watch = METRICS.stopwatch()
+    X = whitenoise(F, N)
+    watch.lap('whitenoise')
+
+    #### Calcualte the F X N array of the complex Fouier coefficients of the 
+    ####  simulated wind speeds, where each N is a different site, j, for all of 
+    ####  the average frequencies at once
+    V = four_coeff(H, X)
+    watch.lap('transform')
     
     #### Calculate time stamp to go along with time series
     ##    last frequency is sampling frequency (Fs)/2
-    sample_freq = freqs[freqs.index[-1]].real
+    freqs = np.real(np.asarray(freqs, dtype = complex))
+    sample_freq = freqs[-1]
     t = np.arange((len(freqs)-1)*2.)/(sample_freq*2.)/60.
 
     ## Turn it into integer minutes 
     t = np.round(t).astype(int)
 
-    TS = pd.DataFrame(index = t , columns = S[0].columns, dtype = float )
-
     #### Get the time series for each of the N sites: 
-    ####  initialize the time-series of length 2*(M-1) for each site j \in N   
-
-    for id, V_j in V.iteritems():
-        #### Do inverse fourier transform of each element, M, of the 
-        ####  matrix of complex fourier coefficients (V) 
-        TS[id] = invert(V_j, t)    
+    ####  Do inverse fourier transform of each column of the matrix of complex
+    ####  fourier coefficients (V) to a time-series of length 2*(M-1) 
+    TS = invert(V, t)
+    watch.lap('invert')
 
-        #### Check for any Nan, if too many print a warning
+    #### Check for any Nan, if too many print a warning
+    for id in TS.columns:
         if pd.isnull(TS[id]).sum() > 20:
             error = "Warning!!! Too many Nan " +\
                 "on site %s replacing with 0's and continuing..." % \
                 (id)
             print error
-            print V_J
 #            raise Exception(error)
             
-        #### Replace any Nan with zeros
-        TS[id] = TS[id].fillna(0)
+    #### Replace any Nan with zeros
+    n_nan = TS.isnull().values.sum()
+    if n_nan > 0:
+        METRICS.count('nan_repairs', n_nan)
+        TS = TS.fillna(0)
 
     return TS
 
@@ -883,6 +2553,199 @@ def vdist(lat1, lon1, lat2, lon2):
 
     return s/1000.
 
+def vdist_array(lat1, lon1, lat2, lon2, pairs = None):
+    """
+    Purpose:
+    Array version of vdist() that calculates the distance between many pairs of 
+     points at once.  Every pair is iterated together and each pair stops 
+     updating once it converges, so the result for each pair matches vdist() 
+     (to rounding).  Like vdist() the distance between two points at the same 
+     location is NaN. 
+
+    Input:
+    lat1, lon1 - arrays with the GEODETIC latitude and longitude of the first 
+                  point (degrees)
+    lat2, lon2 - arrays with the second point (degrees), broadcast with the first
+    pairs - optional (i, j) arrays, to calculate the distance between point i[k]
+             of the first points and point j[k] of the second points.  The 
+             terms that only depend on the latitude of each point are then 
+             calculated once per point instead of once per pair
+
+    Output:
+    s - array of distances in km 
+    """
+    lat1, lon1, lat2, lon2 = [np.asarray(x, dtype = float) 
+                              for x in (lat1, lon1, lat2, lon2)]
+    if pairs is None:
+        lat1, lon1, lat2, lon2 = np.broadcast_arrays(lat1, lon1, lat2, lon2)
+
+    if (np.abs(lat1) > 90).any() or (np.abs(lat2) > 90).any():
+        raise ValueError("Input latitudes must be between -90 and 90 degrees, "
+                         "inclusive.")
+
+    #Supply WGS84 earth ellipsoid axis lengths in meters:
+    a = 6378137 # definitionally
+    b = 6356752.31424518 # computed from WGS84 earth flattening coeff. definition
+    f = (a-b)/float(a)
+
+    def reduced_latitude(lat, lon):
+        #convert inputs in degrees to radians:
+        lat = lat * 0.0174532925199433
+        lon = lon * 0.0174532925199433
+
+        # Correct for errors at exact poles by adjusting 0.6 millimeters:
+        lat = np.where(np.abs(np.pi/2-np.abs(lat)) < 1e-10, 
+                       np.sign(lat)*(np.pi/2-(1e-10)), lat)
+        U = np.arctan((1-f)*np.tan(lat))
+
+        return np.sin(U).ravel(), np.cos(U).ravel(), np.mod(lon,2*np.pi).ravel()
+
+    sinU1, cosU1, lon1 = reduced_latitude(lat1, lon1)
+    sinU2, cosU2, lon2 = reduced_latitude(lat2, lon2)
+    if pairs is not None:
+        i, j = pairs
+        shape = np.shape(i)
+        i, j = np.ravel(i), np.ravel(j)
+        sinU1, cosU1, lon1 = sinU1[i], cosU1[i], lon1[i]
+        sinU2, cosU2, lon2 = sinU2[j], cosU2[j], lon2[j]
+    else:
+        shape = lat1.shape
+
+    L = np.abs(lon2-lon1)
+    L = np.where(L > np.pi, 2*np.pi - L, L)
+
+    #### Work through the pairs in blocks that fit in the processor cache 
+    s = np.empty(L.size)
+    for k in range(0, L.size, VDIST_BLOCK):
+        blk = slice(k, k + VDIST_BLOCK)
+        s[blk] = _vincenty_block(sinU1[blk], cosU1[blk], sinU2[blk], cosU2[blk], 
+                                 L[blk], a, b)
+
+    return (s/1000.).reshape(shape)
+
+def _vincenty_block(sinU1, cosU1, sinU2, cosU2, L, a, b):
+    """
+    Vincenty iteration of vdist_array() for one block of pairs, returns the 
+    distance in meters
+    """
+    f = (a-b)/float(a)
+
+    #### Products of the reduced latitude terms that do not change between 
+    ####  iterations 
+    s1s2, c1c2 = sinU1*sinU2, cosU1*cosU2
+    c1s2, s1c2 = cosU1*sinU2, sinU1*cosU2
+
+    #### Terms of the last iteration of each pair that are needed for the 
+    ####  distance 
+    n_pairs = L.size
+    sigma, sinsigma, cossigma, cosalpha2, cos2sigmam = \
+        [np.empty(n_pairs) for k in range(5)]
+
+    #### Iterate on the working set of pairs.  A pair that has converged keeps 
+    ####  its last value of lambda, so repeating the iteration for it gives the 
+    ####  same terms again, and the converged pairs are only removed from the 
+    ####  working set once there are enough of them to be worth the copy 
+    work = np.arange(n_pairs)
+    lambd = L.copy()
+    done = np.zeros(n_pairs, dtype = bool)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        for itercount in range(50):
+            sinlambd, coslambd = np.sin(lambd), np.cos(lambd)
+
+            sins = np.sqrt((cosU2 * sinlambd)**2 + (c1s2 - s1c2 * coslambd)**2) 
+            coss = s1s2+c1c2*coslambd
+            sig = np.arctan2(sins,coss)
+            sinalpha = c1c2*sinlambd/sins
+            cosa2 = np.maximum(1 - sinalpha**2, 0)
+            #### For two points on the equator cos(alpha)**2 and sinU1*sinU2 are
+            ####  both 0, and vdist() has cos2sigmam = cos(sigma)
+            c2sm = coss-np.where(cosa2 > 0, 2*s1s2/cosa2, 0)
+            C = f/16*cosa2*(4+f*(4-3*cosa2))
+
+            lambdnew = L+(1-C)*f*sinalpha*\
+                (sig + C*sins*(c2sm +C*coss*(-1+2*c2sm**2)))
+
+            # Correct for convergence failure in the case of essentially 
+            #  antipodal points
+            antipodal = lambdnew > np.pi
+            done |= antipodal | ~(np.abs(lambdnew-lambd) > 1e-12)
+            lambd = np.where(done, lambd, lambdnew)
+
+            n_done = done.sum()
+            if n_done == len(work) or itercount == 49:
+                sigma[work], sinsigma[work], cossigma[work] = sig, sins, coss
+                cosalpha2[work], cos2sigmam[work] = cosa2, c2sm
+                break
+
+            if n_done > len(work) // 4:
+                idx = work[done]
+                sigma[idx], sinsigma[idx], cossigma[idx] = sig[done], \
+                    sins[done], coss[done]
+                cosalpha2[idx], cos2sigmam[idx] = cosa2[done], c2sm[done]
+
+                keep = ~done
+                work, lambd, L = work[keep], lambd[keep], L[keep]
+                s1s2, c1c2, c1s2, s1c2, cosU2 = s1s2[keep], c1c2[keep], \
+                    c1s2[keep], s1c2[keep], cosU2[keep]
+                done = done[keep]
+
+        u2 = cosalpha2*(a**2-b**2)/b**2
+        A = 1+u2/16384*(4096+u2*(-768+u2*(320-175*u2)))
+        B = u2/1024*(256+u2*(-128+u2*(74-47*u2)))
+        deltasigma = B*sinsigma*\
+            (cos2sigmam+B/4*(\
+                cossigma*(-1+2*cos2sigmam**2)-\
+                    B/6*cos2sigmam*(-3+4*sinsigma**2)*(-3+4*cos2sigmam**2)))
+        s = b*A*(sigma-deltasigma)
+
+    return s
+
+def haversine(lat1, lon1, lat2, lon2, pairs = None):
+    """
+    Purpose:
+    Great circle distance on a sphere with the mean radius of the earth, which 
+     is within HAVERSINE_REL_ERR of the WGS-84 distance 
+
+    Input:
+    lat1, lon1, lat2, lon2 - arrays of latitude and longitude (degrees)
+    pairs - optional (i, j) arrays of the points to pair, as in vdist_array()
+
+    Output:
+    s - array of distances in km 
+    """
+    phi1, phi2 = np.radians(lat1), np.radians(lat2)
+    lam1, lam2 = np.radians(lon1), np.radians(lon2)
+    cos1, cos2 = np.cos(phi1), np.cos(phi2)
+    if pairs is not None:
+        i, j = pairs
+        phi1, lam1, cos1 = phi1[i], lam1[i], cos1[i]
+        phi2, lam2, cos2 = phi2[j], lam2[j], cos2[j]
+    h = np.sin((phi2 - phi1) / 2) ** 2 + cos1 * cos2 * np.sin((lam2 - lam1) / 2) ** 2
+
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(h, 0, 1)))
+
+def geodesic_distance(lat1, lon1, lat2, lon2, tol_m = None, pairs = None):
+    """
+    Purpose:
+    Distance between pairs of points, using the haversine distance when it is 
+     accurate enough for tol_m at the distances involved and vdist_array() 
+     otherwise
+
+    Input:
+    lat1, lon1, lat2, lon2 - arrays of latitude and longitude (degrees)
+    tol_m - accuracy needed in meters, None for the full WGS-84 accuracy
+    pairs - optional (i, j) arrays of the points to pair, as in vdist_array()
+
+    Output:
+    s - array of distances in km 
+    """
+    if tol_m is not None:
+        s = haversine(lat1, lon1, lat2, lon2, pairs)
+        if np.size(s) == 0 or s.max() * HAVERSINE_REL_ERR * 1000 <= tol_m:
+            return s
+
+    return vdist_array(lat1, lon1, lat2, lon2, pairs)
+
 ##################################################
 #
 # TEMPORARY SUPPORT FUNCTIONS 
@@ -890,6 +2753,12 @@ def vdist(lat1, lon1, lat2, lon2):
 ##################################################
 
 def opendb(dbName):
+    #### Use the local SQLite copy of the database if there is one (see 
+    ####  SynthesisTables.build_sqlite())
+    db_file = ROOT_DIR % (dbName + '.sqlite')
+    if os.path.exists(db_file):
+        return synth_tables.connect_sqlite(db_file, dict_rows = False)
+
     import MySQLdb
     conn = MySQLdb.connect (host = "localhost",
                             user = "root",                        
@@ -897,6 +2766,10 @@ def opendb(dbName):
     return conn
 
 def opendbDict(dbName):
+    db_file = ROOT_DIR % (dbName + '.sqlite')
+    if os.path.exists(db_file):
+        return synth_tables.connect_sqlite(db_file)
+
     import MySQLdb
     import MySQLdb.cursors
     conn = MySQLdb.connect (host = "localhost",
@@ -923,7 +2796,7 @@ def test_cohere():
     ids = ['01', '02', '03', '04']
     dist_mtx = pd.DataFrame(tmp, index = ids, columns = ids, dtype = float)
     psd = power_spectral_density()
-    cohere = coherence_matrix(dist_mtx, psd['1.00']['freq'])
+    cohere, site_index = coherence_matrix(dist_mtx, psd['1.00']['freq'])
     return cohere 
 
 def test_psd():
@@ -933,7 +2806,7 @@ def test_psd():
 def test_S():
 
     kbars = [1,0.95,0.7,1.05]
-    kbars = pd.Series(kbars, index = dist_mtx.index)    
+    kbars = pd.Series(kbars, index = ['01', '02', '03', '04'])
     psd = test_psd()
     cohere = test_cohere()
     S = spectral_amplitude_matrix(kbars, cohere, psd)
@@ -944,9 +2817,426 @@ def test_TS():
     freqs = psd['1.00']['freq']
     cohere = test_cohere()
     S = test_S()
-    TS = synthysize_norm_TS(S, freqs)
+    TS = synthysize_norm_TS(S, freqs, ['01', '02', '03', '04'])
+    return TS
+
+def random_sites(n_sites, n_hours = 24, seed = 0, lat = 33.45, lon = -112.07, 
+                 spread = 0.3):
+    """
+    Build n_sites SolarSite objects at random locations within spread degrees of
+     (lat, lon), each with a random hourly clearsky index labelled on the 
+     half-hour, for the checks below 
+    """
+    rs = np.random.RandomState(seed)
+    t_rng = pd.date_range('1/1/2004 00:30', periods = n_hours, freq = 'H')
+    lats = lat + rs.uniform(-spread, spread, n_sites)
+    lons = lon + rs.uniform(-spread, spread, n_sites)
+    kbars = rs.uniform(0.05, 1.15, (n_sites, n_hours))
+
+    return [SolarSite('%04d' % j, lats[j], lons[j], 
+                      pd.Series(kbars[j], index = t_rng)) 
+            for j in range(n_sites)]
+
+def test_batch_transform():
+    """
+    Check that batch_transform() gives the same factor as the element-by-element
+     transform() of synthysize_norm_TS(), for a real spectral matrix (Cholesky 
+     factorization) and a complex one (array recursion) 
+    """
+    freqs, sqrt_psd, cdf_arr = lookup_tables()
+    solar_sites = random_sites(6)
+    cohere, site_index = coherence_matrix(distance_matrix(solar_sites), freqs)
+    C = regularize_coherence(cohere)
+    D = sqrt_psd[kbar_levels([0.3, 0.55, 0.8, 0.95, 1.0, 1.1])].T
+    S = D[:, :, np.newaxis] * C * D[:, np.newaxis, :]
+
+    for S_test in [C.astype(complex), S]:
+        #### H[f] * H[f].T = S[f]
+        H = batch_transform(S_test)
+        assert np.allclose(np.einsum('fjl,fkl->fjk', H, H), S_test)
+
+        #### Same time series from both engines with the same random phases 
+        np.random.seed(0)
+        TS_batch = synthysize_norm_TS(S_test, freqs, site_index, 'batch')
+        np.random.seed(0)
+        TS_rec = synthysize_norm_TS(S_test, freqs, site_index, 'recursive')
+        err = np.abs(TS_batch.values - TS_rec.values).max()
+        assert err <= 1e-10 * np.abs(TS_rec.values).max(), err
+
+    return err
+
+def test_factor_cache():
+    """
+    Check the limits and counters of FactorCache, and that an hour synthesized 
+     from a cached spectral factor is the same as one that builds the factor 
+    """
+    cache = FactorCache(max_entries = 2, max_mb = 1)
+    a, b, c = np.zeros(10), np.ones(10), np.arange(10.)
+    cache.put('a', a)
+    cache.put('b', b)
+    assert cache.get('a') is a
+    cache.put('c', c)
+    #### 'b' is the least recently used entry
+    assert cache.get('b') is None and cache.get('c') is c
+    assert cache.info()['hits'] == 2 and cache.info()['misses'] == 1
+    #### An entry bigger than max_mb is not stored 
+    cache.put('big', np.zeros(2**18))
+    assert cache.get('big') is None and cache.info()['entries'] == 2
+
+    solar_sites = random_sites(5, n_hours = 2)
+    synth_hr_args = synthesis_parameters(solar_sites, seed = 1)
+    dt = solar_sites[0].clr_idx_hr.index[0]
+    FACTOR_CACHE.clear()
+    TS_miss = synthesize_hour(dt, synth_hr_args)
+    TS_hit = synthesize_hour(dt, synth_hr_args)
+    info = FACTOR_CACHE.info()
+    assert info['misses'] == 1 and info['hits'] == 1
+    assert np.array_equal(TS_miss.values, TS_hit.values)
+
+    return info
+
+def test_year_engine():
+    """
+    Check that the 'year' engine gives the same 1-min output as synthesizing 
+     each hour with synthesize_hour() for the same seed 
+    """
+    TS = {}
+    for engine in ['hourly', 'year']:
+        solar_sites = main(random_sites(8, n_hours = 30), n_jobs = 1, 
+                           engine = engine, seed = 3)
+        TS[engine] = np.column_stack([s.clr_idx_min.values for s in solar_sites])
+    err = np.abs(TS['year'] - TS['hourly']).max()
+    assert err < 1e-12, err
+
+    return err
+
+def test_seed_splits():
+    """
+    Check that with a seed the output does not depend on how the run is split:
+     n_jobs = 1, n_jobs = 2 and two separate runs over the hours give the same 
+     1-min output with the 'hourly' engine, and one 'year' run gives the same 
+     output as synthesize_stream() in blocks of 7 hours
+    """
+    solar_sites = random_sites(5, n_hours = 30)
+    hour_index = solar_sites[0].clr_idx_hr.index
+
+    def site_matrix(sites):
+        return np.column_stack([s.clr_idx_min.values for s in sites])
+
+    TS = {}
+    for n_jobs in [1, 2]:
+        TS[n_jobs] = site_matrix(main(solar_sites, n_jobs = n_jobs, seed = 11))
+    parts = []
+    for hours in [hour_index[:13], hour_index[13:]]:
+        part_sites = [SolarSite(s.id, s.lat, s.lon, s.clr_idx_hr[hours]) 
+                      for s in solar_sites]
+        parts.append(site_matrix(main(part_sites, n_jobs = 1, seed = 11)))
+    TS['split'] = np.vstack(parts)
+    assert np.array_equal(TS[1], TS[2])
+    assert np.array_equal(TS[1], TS['split'])
+
+    TS['year'] = site_matrix(main(solar_sites, engine = 'year', seed = 11))
+    TS['stream'] = np.vstack([TS_block.values for TS_block in 
+                              synthesize_stream(solar_sites, 7, seed = 11)])
+    assert np.array_equal(TS['year'], TS['stream'])
+
     return TS
 
+def test_shared_tables():
+    """
+    Check that the tables read back by attach_tables() are the published tables,
+     and that release_tables() removes them after the year array is closed
+    """
+    tables = [np.arange(12.).reshape(3, 4), np.ones(5, dtype = np.complex64), 
+              'not an array']
+    tables_name = publish_tables(tables)
+    attached = attach_tables(tables_name)
+    for table, table_attached in zip(tables, attached):
+        assert np.array_equal(table, table_attached)
+    del attached
+
+    TS_year = year_output((120, 2), tables_name)
+    TS_year[:] = 1.
+    TS_year = np.array(TS_year, order = 'F')
+    release_tables(tables_name)
+    assert not os.path.exists(tables_name) and (TS_year == 1).all()
+
+    return tables_name
+
+def test_parallel_main():
+    """
+    Check the parallel version of main() (published tables, one task for each 
+     hour writing into the memory-mapped year array): every hour is 
+     synthesized, the output is the same as with n_jobs = 1 for the same seed,
+     and the published tables are removed
+    """
+    solar_sites = random_sites(4, n_hours = 30)
+    tmp_dir = tempfile.gettempdir()
+    before = set(os.listdir(tmp_dir))
+    TS = {}
+    for n_jobs in [2, 1]:
+        solar_sites = main(solar_sites, n_jobs = n_jobs, seed = 7)
+        if n_jobs == 2:
+            assert METRICS.counters['hours'] == 30
+        TS[n_jobs] = np.column_stack([s.clr_idx_min.values for s in solar_sites])
+    assert not np.isnan(TS[2]).any()
+    assert np.array_equal(TS[2], TS[1])
+    left = [name for name in set(os.listdir(tmp_dir)) - before 
+            if name.startswith('solar_synth_')]
+    assert not left, left
+
+    return TS[2]
+
+def test_block_factor():
+    """
+    Check block_coherence_factor(): with a tolerance that links every site it is 
+     the dense coherence_factor(), the clusters stay within max_sites, each 
+     block reproduces the coherence of its sites, and a block that is not 
+     positive definite gives a warning
+    """
+    freqs = lookup_tables()[0]
+    solar_sites = random_sites(30)
+    dist_mtx = distance_matrix(solar_sites)
+    cohere = coherence_model(freqs[:, np.newaxis, np.newaxis], 
+                             dist_mtx.values[np.newaxis])
+    X = np.exp(2j * np.pi * np.random.RandomState(0).rand(2, len(freqs), 30))
+
+    #### One block of every site 
+    dense = coherence_factor(cohere)
+    block = block_coherence_factor(dist_mtx, freqs, tol = 1e-12, 
+                                   max_sites = None)
+    err = np.abs(block.apply(X) - np.einsum('fjk,hfk->hfj', dense, X)).max()
+    assert err < 1e-12, err
+
+    #### Clusters of at most 8 sites 
+    block = block_coherence_factor(dist_mtx, freqs, max_sites = 8)
+    for freq_idx, f_blocks in enumerate(block.blocks):
+        for idx, L in f_blocks:
+            if L.ndim == 2:
+                assert len(idx) <= 8
+                C = regularize_coherence(cohere[freq_idx][np.ix_(idx, idx)][
+                    np.newaxis])[0]
+                assert np.allclose(np.dot(L, L.T), C)
+
+    #### Sites 1 km apart on a line with only the next site as a neighbour: the
+    ####  coherence of each block is ~1 next to the diagonal and 0 beyond it
+    line = [SolarSite(str(j), 33. + 0.009 * j, -112., solar_sites[0].clr_idx_hr)
+            for j in range(6)]
+    dist, ids = neighbor_distance_matrix(line, 1.5)
+    with warnings.catch_warnings(record = True) as caught:
+        warnings.simplefilter('always')
+        block_coherence_factor(dist, freqs)
+    assert any('not positive definite' in str(w.message) for w in caught)
+
+    return err
+
+def test_neighbor_distances():
+    """
+    Check that neighbor_distance_matrix() finds every pair of sites within the 
+     cutoff with the same distance as distance_matrix(), and no other pairs 
+    """
+    solar_sites = random_sites(80)
+    max_km = 15.
+    dense = distance_matrix(solar_sites).values
+    dist, ids = neighbor_distance_matrix(solar_sites, max_km)
+    assert list(ids) == [s.id for s in solar_sites]
+
+    within = (dense <= max_km) & ~np.eye(len(dense), dtype = bool)
+    dist = dist.toarray()
+    assert ((dist > 0) == within).all()
+    assert np.allclose(dist[within], dense[within], rtol = 1e-12)
+
+    #### The missing pairs are infinitely far apart in the full matrix 
+    full = dense_distances(sparse.csr_matrix(dist))
+    assert np.isinf(full[~within & (dense > 0)]).all()
+
+    return within.sum()
+
+def test_vdist_array():
+    """
+    Check that vdist_array() matches vdist() for each pair of points (near and 
+     far apart, across the date line and near the poles), and that the 
+     haversine distance is within HAVERSINE_REL_ERR of it
+    """
+    rs = np.random.RandomState(0)
+    lat1 = np.concatenate([rs.uniform(-89.9, 89.9, 200), [33.4, 0., 89.99, 10.]])
+    lon1 = np.concatenate([rs.uniform(-180, 180, 200), [-112., 179.9, 0., 20.]])
+    lat2 = np.concatenate([rs.uniform(-89.9, 89.9, 200), [33.41, 0., 89.99, 10.]])
+    lon2 = np.concatenate([rs.uniform(-180, 180, 200), [-112.01, -179.9, 90., 20.2]])
+
+    s_array = vdist_array(lat1, lon1, lat2, lon2)
+    s_scalar = np.array([vdist(*point) for point in zip(lat1, lon1, lat2, lon2)])
+    err = np.abs(s_array - s_scalar).max()
+    assert err < 1e-9, err
+
+    s_hav = haversine(lat1, lon1, lat2, lon2)
+    assert (np.abs(s_hav - s_scalar) <= HAVERSINE_REL_ERR * s_scalar).all()
+
+    #### The pairs form gives the same distances 
+    i, j = np.arange(len(lat1)), np.arange(len(lat1))[::-1]
+    s_pairs = vdist_array(lat1, lon1, lat2, lon2, pairs = (i, j))
+    assert np.allclose(s_pairs, vdist_array(lat1[i], lon1[i], lat2[j], lon2[j]), 
+                       rtol = 1e-14)
+
+    return err
+
+def seam_ratio(TS):
+    """
+    Mean absolute step between the last minute of each hour and the first minute
+     of the next one, relative to the mean absolute step within the hours, of 
+     an array (minutes X sites) of whole hours
+    """
+    steps = np.abs(np.diff(TS, axis = 0))
+    seams = steps[59::60].mean()
+    within = np.delete(steps, np.s_[59::60], axis = 0).mean()
+
+    return seams / within
+
+def test_overlap_seams():
+    """
+    Measure the seams between hours with and without the overlap mode, for a 
+     steady hourly clearsky index (where any seam comes from the synthesis) and
+     for a random hourly clearsky index, check that the overlap mode keeps the
+     mean of each hour at the mean of its level, and that with a seed it gives
+     the same output in blocks of hours (synthesize_stream()) as in one run
+    """
+    freqs, sqrt_psd, cdf_arr = lookup_tables()
+    level_mean = np.nanmean(cdf_arr, axis = 1)
+    ratios = {}
+    for steady in [True, False]:
+        for overlap in [False, True]:
+            solar_sites = random_sites(8, n_hours = 24 * 30)
+            if steady:
+                for s in solar_sites:
+                    s.clr_idx_hr[:] = 0.7
+            solar_sites = main(solar_sites, engine = 'year', seed = 5, 
+                               overlap = overlap)
+            TS = np.column_stack([s.clr_idx_min.values for s in solar_sites])
+            ratios[(steady, overlap)] = seam_ratio(TS)
+
+            if overlap and not steady:
+                levels = kbar_levels(kbar_matrix(solar_sites, 
+                                                 solar_sites[0].clr_idx_hr.index))
+                hour_mean = TS.reshape(-1, 60, TS.shape[1]).mean(axis = 1)
+                err = np.abs(hour_mean - level_mean[levels])
+                #### Only where the values are kept at 0 or above
+                assert np.median(err) < 1e-6 and err.mean() < 0.005, err.mean()
+
+    #### Steady hours: ~2x larger steps at the seams when each hour is cut to 
+    ####  60 minutes, and the same as within the hours with the overlap 
+    assert ratios[(True, False)] > 1.5
+    assert ratios[(True, True)] < 1.05
+    #### Random hours: ~6x larger steps at the seams without the overlap, only
+    ####  the change of the shape of the within-hour distribution with it 
+    assert ratios[(False, False)] > 4
+    assert ratios[(False, True)] < 1.5
+
+    solar_sites = random_sites(5, n_hours = 50)
+    TS_year = np.column_stack([s.clr_idx_min.values for s in 
+                               main(solar_sites, seed = 3, overlap = True)])
+    TS_stream = np.vstack([TS_block.values for TS_block in 
+                           synthesize_stream(solar_sites, 7, seed = 3, 
+                                             overlap = True)])
+    assert np.array_equal(TS_year, TS_stream)
+
+    return ratios
+
+def test_coherence_matrix():
+    """
+    Check that coherence_matrix() matches coherence_model() for the stored 
+     (rounded) frequencies and for exact FFT harmonics, and the geometry cache
+    """
+    freqs = lookup_tables()[0]
+    solar_sites = random_sites(12)
+    dist_mtx = distance_matrix(solar_sites)
+    for f in [freqs, np.fft.rfftfreq(64, 60.)]:
+        cohere, site_index = coherence_matrix(dist_mtx, f)
+        model = coherence_model(f[:, np.newaxis, np.newaxis], 
+                                dist_mtx.values[np.newaxis])
+        err = np.abs(cohere - model).max()
+        assert err < 1e-14, err
+
+    #### The second call reads the cache 
+    cache_dir = tempfile.mkdtemp(prefix = 'geometry_cache_')
+    METRICS.clear()
+    site_index, coh_factor = site_geometry(solar_sites, freqs, 
+                                           cache_dir = cache_dir)
+    site_index_c, coh_factor_c = site_geometry(solar_sites, freqs, 
+                                               cache_dir = cache_dir)
+    assert METRICS.counters == {'geometry_cache_misses': 1, 
+                                'geometry_cache_hits': 1}
+    assert np.array_equal(coh_factor, coh_factor_c)
+    assert list(site_index) == list(site_index_c)
+
+    #### Only the most recent file is kept within the size limit 
+    site_geometry(solar_sites[1:], freqs, cache_dir = cache_dir)
+    prune_cache(cache_dir, os.path.getsize(os.path.join(
+        cache_dir, os.listdir(cache_dir)[0])) / 2.**20 * 1.5)
+    assert len(os.listdir(cache_dir)) == 1
+    shutil.rmtree(cache_dir)
+
+    return err
+
+def test_precision():
+    """
+    Check that single precision gives the same 1-min output as double precision
+     to float32 rounding: minute by minute when the CDF is interpolated, and in
+     the distribution of the values and ramps when the probabilities are 
+     rounded to the CDF levels (where rounding can move a minute to the next 
+     level)
+    """
+    solar_sites = random_sites(8, n_hours = 48)
+    report = precision_report(solar_sites, seed = 2, cdf_interp = True)
+    assert report.loc['max abs error', 'single'] < 1e-5
+
+    report = precision_report(solar_sites, seed = 2)
+    stats = report.drop('max abs error')
+    assert (stats['difference'].abs() < 1e-4).all()
+
+    return report
+
+def test_lookup_tables():
+    """
+    Check that the binary store gives the same tables as the pickles, and that
+     a corrupt or truncated store raises TableFormatError and lookup_tables() 
+     falls back to the pickles with a warning
+    """
+    tables_bin = lookup_tables()
+    tables_pkl = lookup_tables(os.path.join(tempfile.gettempdir(), 
+                                            'no_such_tables.bin'))
+    for table_bin, table_pkl in zip(tables_bin, tables_pkl):
+        assert np.allclose(table_bin, table_pkl, equal_nan = True)
+
+    tmp_dir = tempfile.mkdtemp(prefix = 'synth_tables_')
+    try:
+        data = open(TABLES_FILE, 'rb').read()
+        corrupt_file = os.path.join(tmp_dir, 'corrupt.bin')
+        #### Flip a byte of the last table 
+        corrupt = open(corrupt_file, 'wb')
+        corrupt.write(data[:-8] + chr(ord(data[-8]) ^ 0xff) + data[-7:])
+        corrupt.close()
+        truncated_file = os.path.join(tmp_dir, 'truncated.bin')
+        truncated = open(truncated_file, 'wb')
+        truncated.write(data[:len(data) // 2])
+        truncated.close()
+
+        for bad_file in [corrupt_file, truncated_file]:
+            try:
+                synth_tables.read_tables(bad_file)
+                assert False, "%s was read" % bad_file
+            except synth_tables.TableFormatError:
+                pass
+            with warnings.catch_warnings(record = True) as caught:
+                warnings.simplefilter('always')
+                tables_bad = lookup_tables(bad_file)
+            assert len(caught) == 1
+            for table_bad, table_pkl in zip(tables_bad, tables_pkl):
+                assert np.array_equal(table_bad, table_pkl)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    return tables_bin
+
 def test_examine_spectrum(ss):
     """Examine the spectrum of each site to determine if there are abnormalities
     
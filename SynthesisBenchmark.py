@@ -0,0 +1,408 @@
+"""
+Purpose:
+Scaling benchmark of SolarSynthesis.py that runs without the MySQL database.
+Synthetic site layouts and hourly clearsky index series are generated for a
+grid of numbers of sites and numbers of hours, and each configuration is
+synthesized with the bundled PSD and CDF tables while timing each stage and
+recording the peak memory.  Each configuration runs in its own process so that
+the peak memory of one does not carry over to the next.
+
+Input:
+- bundled PSD and CDF tables (see SolarSynthesis.lookup_tables())
+- numbers of sites and numbers of hours to benchmark
+
+Output:
+- JSON file with the seconds spent in each stage (distance, coherence,
+   factorization, S build, noise, irfft, CDF map, stitch) and the peak memory of
+   each configuration, to compare between versions of the model.  Every result
+   row records the factorization it used: up to DENSE_MAX_SITES sites the dense
+   coherence matrices, above it the block factorization of the sites within 
+   NEIGHBOR_KM of each other, so rows on either side of DENSE_MAX_SITES are not
+   the same model and should not be read as one scaling curve
+
+Usage:
+ python SynthesisBenchmark.py [out_file] [n_sites,...] [n_hours,...]
+ e.g. python SynthesisBenchmark.py bench.json 4,50 24,168
+"""
+import SolarSynthesis as synth
+from SynthesisMetrics import METRICS
+import numpy as np
+import pandas as pd
+import scipy
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import time
+try:
+    import resource
+except ImportError:
+    #### Not available on Windows, the peak memory is not recorded
+    resource = None
+
+#### Default grid: numbers of sites and numbers of hours (1 day, 1 week, 1 year)
+N_SITES = [4, 50, 500, 5000]
+N_HOURS = [24, 24*7, 8784]
+
+#### Larger site sets only calculate the distances between neighbouring sites
+####  and use the block factorization (see SolarSynthesis.main())
+DENSE_MAX_SITES = 1000
+NEIGHBOR_KM = 5.
+
+#### Memory (MB) of the interpreter with numpy, scipy and pandas loaded, before
+####  any configuration is built
+BASE_MB = 64.
+
+#### Box of the synthetic site layouts in degrees (about the size of Arizona)
+LAT_RANGE = (31.5, 36.5); LON_RANGE = (-114.5, -109.5)
+
+#### Stages in the order of the synthesis
+STAGES = ['distance', 'coherence', 'factorization', 'S build', 'noise', 'irfft',
+          'CDF map', 'stitch']
+
+#### Timers of SynthesisMetrics.py that make up the synthesis stages
+STAGE_TIMERS = {'S build': ['s_construction', 'transform'],
+                'noise': ['whitenoise'],
+                'irfft': ['invert'],
+                'CDF map': ['norm_cdf', 'cdf_lookup'],
+                'stitch': ['stitch']}
+
+##################################################
+#
+# MAIN FUNCTIONS
+#
+##################################################
+
+def main(out_file = None, n_sites = N_SITES, n_hours = N_HOURS,
+         layout = 'uniform', seed = 0, memory_budget_mb = None, **kwargs):
+    """
+    Purpose:
+    Benchmark every combination of the numbers of sites and hours, each in a
+     separate process, and write the results to a JSON file
+
+    Input:
+    out_file - name of the JSON file, or None to only return the results
+    n_sites - list of the numbers of sites
+    n_hours - list of the numbers of hours (starting on 1/1/2004)
+    layout - 'uniform' or 'clustered', see synthetic_sites()
+    seed - seed of the site layouts, the clearsky index and the synthesis
+    memory_budget_mb - configurations with a larger estimated memory (see
+                        estimate_mb()) are skipped, by default half of the
+                        physical memory of the machine
+    kwargs - block_hours, overlap, precision, see benchmark_case()
+
+    Output:
+    bench - dictionary with the description of the machine and the 'results',
+             a list with a dictionary for each configuration
+    """
+    if memory_budget_mb is None:
+        memory_budget_mb = physical_memory_mb() / 2.
+
+    results = []
+    for N in n_sites:
+        for n_hrs in n_hours:
+            est_mb = estimate_mb(N, n_hrs, kwargs.get('block_hours', 168))
+            if est_mb > memory_budget_mb:
+                result = {'n_sites': N, 'n_hours': n_hrs, 'status': 'skipped',
+                          'error': 'estimated %.0f MB is over the budget of '
+                                   '%.0f MB' % (est_mb, memory_budget_mb)}
+            else:
+                result = run_isolated(N, n_hrs, layout, seed, kwargs)
+            result.update(factorization_settings(N))
+            result['estimated_mb'] = est_mb
+            results.append(result)
+            print "%5s sites %5s hours: %s" % (N, n_hrs, summary(result))
+
+    bench = {'created': datetime.datetime.now().isoformat(),
+             'host': platform.node(),
+             'platform': platform.platform(),
+             'cpu_count': multiprocessing.cpu_count(),
+             'versions': {'python': platform.python_version(),
+                          'numpy': np.__version__, 'scipy': scipy.__version__,
+                          'pandas': pd.__version__},
+             'settings': {'layout': layout, 'seed': seed,
+                          'memory_budget_mb': memory_budget_mb,
+                          'dense_max_sites': DENSE_MAX_SITES,
+                          'neighbor_km': NEIGHBOR_KM, 'options': kwargs},
+             'stages': STAGES,
+             'results': results}
+
+    if out_file is not None:
+        save_file = open(out_file, 'w')
+        json.dump(bench, save_file, indent = 1, sort_keys = True)
+        save_file.close()
+
+    return bench
+
+def benchmark_case(n_sites, n_hours, layout = 'uniform', seed = 0,
+                   block_hours = 168, overlap = False, precision = None):
+    """
+    Purpose:
+    Synthesize one configuration the same way as SolarSynthesis.main() with the
+     'year' engine, timing each stage
+
+    Input:
+    n_sites - number of sites
+    n_hours - number of hours
+    layout, seed - see synthetic_sites()
+    block_hours, overlap - see SolarSynthesis.synthesize_year()
+    precision - see SolarSynthesis.main()
+
+    Output:
+    result - dictionary with the 'seconds' of each stage, the 'total_seconds',
+              the 'peak_rss_mb' of the process (None where not available), the
+              timers and counters of the synthesis in 'metrics' and the 
+              settings of the factorization (see factorization_settings())
+    """
+    solar_sites = synthetic_sites(n_sites, n_hours, layout, seed)
+    hour_index = solar_sites[0].clr_idx_hr.index
+
+    #### Bundled tables (not part of the timed stages)
+    freqs, sqrt_psd, cdf_arr = synth.lookup_tables()
+
+    base_mb = peak_rss_mb()
+    seconds = dict((stage, 0.) for stage in STAGES)
+    start = time.time()
+
+    #### Distance, coherence and factorization, the same as
+    ####  SolarSynthesis.site_geometry() without the cache
+    settings = factorization_settings(n_sites)
+    factorization = settings['factorization']
+    clock = time.time()
+    if factorization == 'dense':
+        dist_mtx = synth.distance_matrix(solar_sites)
+        seconds['distance'] = time.time() - clock
+
+        clock = time.time()
+        cohere, site_index = synth.coherence_matrix(dist_mtx, freqs)
+        seconds['coherence'] = time.time() - clock
+
+        clock = time.time()
+        coh_factor = synth.coherence_factor(cohere)
+        del cohere
+    else:
+        #### The coherence of each cluster is calculated as it is factored
+        dist, site_index = synth.neighbor_distance_matrix(solar_sites,
+                                                          NEIGHBOR_KM)
+        seconds['distance'] = time.time() - clock
+
+        clock = time.time()
+        coh_factor = synth.block_coherence_factor(
+            dist, freqs, synth.COHERENCE_TOL, NEIGHBOR_KM, 
+            max_sites = settings['max_block_sites'])
+    seconds['factorization'] = time.time() - clock
+
+    if (precision or synth.PRECISION) == 'single':
+        coh_factor = coh_factor.astype(np.complex64)
+        sqrt_psd = sqrt_psd.astype(np.complex64)
+        cdf_arr = cdf_arr.astype(np.float32)
+
+    parameters = [solar_sites, site_index, coh_factor, cdf_arr, sqrt_psd, freqs,
+                  (synth.site_key(solar_sites), factorization), seed,
+                  synth.site_hashes(site_index), False]
+
+    #### Synthesis stages
+    METRICS.clear()
+    TS_year = synth.synthesize_year(hour_index, parameters, block_hours, overlap)
+    for stage, timers in STAGE_TIMERS.items():
+        seconds[stage] += sum(METRICS.timers.get(name, [0, 0.])[1] 
+                              for name in timers)
+
+    #### Attach the 1-min clearsky index to each site, the same as main()
+    clock = time.time()
+    year_rng = synth.minute_index(hour_index)
+    for j, site in enumerate(solar_sites):
+        site.clr_idx_min = pd.Series(TS_year[:, j], index = year_rng,
+                                     name = site.id)
+    seconds['stitch'] += time.time() - clock
+
+    result = {'n_sites': n_sites, 'n_hours': n_hours, 'status': 'ok',
+              'seconds': seconds, 'total_seconds': time.time() - start,
+              'base_rss_mb': base_mb, 'peak_rss_mb': peak_rss_mb(),
+              'metrics': METRICS.snapshot()}
+    result.update(settings)
+
+    return result
+
+##################################################
+#
+# SUPPORT FUNCTIONS
+#
+##################################################
+
+def factorization_settings(n_sites):
+    """
+    Purpose:
+    Settings of the coherence factorization used for a number of sites
+
+    Output:
+    settings - dictionary with the 'factorization' ('dense' or 'block'), the 
+                'neighbor_km' within which site distances are calculated and the
+                'max_block_sites' of a cluster (both None for 'dense')
+    """
+    if n_sites <= DENSE_MAX_SITES:
+        return {'factorization': 'dense', 'neighbor_km': None, 
+                'max_block_sites': None}
+
+    return {'factorization': 'block', 'neighbor_km': NEIGHBOR_KM,
+            'max_block_sites': synth.BLOCK_MAX_SITES}
+
+def synthetic_sites(n_sites, n_hours, layout = 'uniform', seed = 0):
+    """
+    Purpose:
+    Generate a site layout and an hourly clearsky index series for each site
+
+    Input:
+    n_sites - number of sites
+    n_hours - number of hours, starting on 1/1/2004
+    layout - 'uniform' to spread the sites evenly over LAT_RANGE X LON_RANGE, or
+              'clustered' to place them around a few towns (about 10 km across)
+    seed - seed of the random layout and clearsky index
+
+    Output:
+    solar_sites - list of SolarSite objects.  The hourly clearsky index follows a
+                   weather pattern shared by every site (an AR(1) series) plus
+                   local variation, limited to 0 to 1.2
+    """
+    rs = np.random.RandomState(seed)
+
+    if layout == 'clustered':
+        n_towns = max(1, n_sites // 100)
+        town_lat = rs.uniform(LAT_RANGE[0], LAT_RANGE[1], n_towns)
+        town_lon = rs.uniform(LON_RANGE[0], LON_RANGE[1], n_towns)
+        town = rs.randint(n_towns, size = n_sites)
+        lat = town_lat[town] + rs.normal(0, 0.05, n_sites)
+        lon = town_lon[town] + rs.normal(0, 0.05, n_sites)
+    else:
+        lat = rs.uniform(LAT_RANGE[0], LAT_RANGE[1], n_sites)
+        lon = rs.uniform(LON_RANGE[0], LON_RANGE[1], n_sites)
+
+    #### Shared weather pattern
+    weather = np.empty(n_hours)
+    weather[0] = 0
+    shocks = rs.normal(0, 0.12, n_hours)
+    for h in range(1, n_hours):
+        weather[h] = 0.9 * weather[h-1] + shocks[h]
+    kbar = 0.8 + weather[:, np.newaxis] + rs.normal(0, 0.1, (n_hours, n_sites))
+    kbar = np.clip(kbar, 0, 1.2)
+
+    t_rng = pd.date_range('1/1/2004 00:30', periods = n_hours, freq = 'H')
+    solar_sites = [synth.SolarSite(str(j), lat[j], lon[j],
+                                   pd.Series(kbar[:, j], index = t_rng))
+                   for j in range(n_sites)]
+
+    return solar_sites
+
+def run_isolated(n_sites, n_hours, layout, seed, options):
+    """
+    Purpose:
+    Run benchmark_case() in a new process, so the peak memory is only that of
+     the configuration
+
+    Output:
+    result - dictionary from benchmark_case(), or with status 'failed' and the
+              error if the process raised an exception or was killed (e.g. out
+              of memory)
+    """
+    queue = multiprocessing.Queue()
+    p = multiprocessing.Process(target = _run_case,
+                                args = (queue, n_sites, n_hours, layout, seed,
+                                        options))
+    p.start()
+    result = None
+    while result is None and (p.is_alive() or not queue.empty()):
+        try:
+            result = queue.get(timeout = 1)
+        except Exception:
+            pass
+    p.join()
+
+    if result is None:
+        result = {'n_sites': n_sites, 'n_hours': n_hours, 'status': 'failed',
+                  'error': 'process exited with code %s' % p.exitcode}
+
+    return result
+
+def _run_case(queue, n_sites, n_hours, layout, seed, options):
+    try:
+        result = benchmark_case(n_sites, n_hours, layout, seed, **options)
+    except Exception as e:
+        result = {'n_sites': n_sites, 'n_hours': n_hours, 'status': 'failed',
+                  'error': '%s: %s' % (type(e).__name__, e)}
+    queue.put(result)
+
+def estimate_mb(n_sites, n_hours, block_hours = 168):
+    """
+    Purpose:
+    Rough estimate of the peak memory (MB) of a configuration, the larger of 
+     building the coherence factor and synthesizing with it:
+    - build: the dense coherence matrix, its factor and the temporary arrays of
+       the factorization, or for the block factorization the sparse distances 
+       and the factor blocks (at most max_block_sites sites in each)
+    - synthesis: the kept factor (with its real copy for the dense one), the 
+       year array (the site Series are views of it), the hourly levels and 
+       series, and the (hours, freqs, sites) arrays of a block that are alive 
+       at the same time (PSD, random phases, noise, Fourier coefficients and 
+       the copies made by the inverse FFT and the CDF mapping)
+    Estimated for double precision.  Checked against the measured peaks on 
+     Linux: e.g. 1500 sites X 168 hours estimates about 1680 MB for a measured
+     1615 MB
+    """
+    F, n = 33, 64
+    out = n_hours * n_sites * (60. * 8 + 80.)
+    block = min(block_hours, n_hours) * n_sites * (F * 96. + n * 40.)
+    if n_sites <= DENSE_MAX_SITES:
+        build = F * n_sites**2 * 56.
+        factor = F * n_sites**2 * 24.
+    else:
+        #### Upper bound: each site's row of a lower-triangular complex block
+        ####  has at most max_block_sites entries (about half of them on 
+        ####  average), tight for clustered layouts
+        build = n_sites * (F * synth.BLOCK_MAX_SITES * 8. + 1000. * 8)
+        factor = build
+
+    return BASE_MB + max(build, factor + out + block) / 2**20
+
+def physical_memory_mb():
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') / 2.**20
+    except (ValueError, OSError, AttributeError):
+        return 4096.
+
+def peak_rss_mb():
+    """
+    Purpose:
+    Peak resident memory (MB) of this process, or None where it is not available
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #### kB on Linux, bytes on Mac OS
+    if sys.platform == 'darwin':
+        return peak / 2.**20
+    return peak / 2.**10
+
+def summary(result):
+    if result['status'] != 'ok':
+        return '%s, %s (%s)' % (result['factorization'], result['status'], 
+                                result['error'])
+    return '%s, %.2f s, peak %s MB' % (result['factorization'],
+                                       result['total_seconds'],
+                                       '%.0f' % result['peak_rss_mb']
+                                       if result['peak_rss_mb'] is not None 
+                                       else '?')
+
+if __name__ == '__main__':
+    """
+    python SynthesisBenchmark.py [out_file] [n_sites,...] [n_hours,...]
+    """
+    out_file = sys.argv[1] if len(sys.argv) > 1 else 'synthesis_benchmark.json'
+    n_sites = N_SITES
+    n_hours = N_HOURS
+    if len(sys.argv) > 2:
+        n_sites = [int(x) for x in sys.argv[2].split(',')]
+    if len(sys.argv) > 3:
+        n_hours = [int(x) for x in sys.argv[3].split(',')]
+    main(out_file, n_sites, n_hours)
@@ -0,0 +1,174 @@
+"""
+Purpose:
+Lightweight timers and counters for SolarSynthesis.py runs.  Each process keeps
+its own Metrics object (METRICS) that the synthesis adds the time of each stage
+and its counts (e.g. NaN repairs, factor cache hits) to.  Recording a time or a
+count is a dictionary update, so the metrics are always on.  The metrics of
+worker processes are sent back as snapshots and merged into the metrics of the
+run, which are exported at the end as JSON or in the Prometheus text format.
+
+Timers:
+s_construction - PSD lookup and scaling of the coherence factor (spectral factor)
+transform - applying the factor to the white noise (Fourier coefficients)
+whitenoise - random phases of the white noise
+invert - inverse FFT
+norm_cdf - transform of the normalized series to probabilities
+cdf_lookup - lookup of the clearsky index in the within-hour CDF
+stitch - copy of the 1-min output into the year array
+geometry - distance matrix and coherence factor of the site set
+
+Counters:
+hours - hours synthesized
+nan_repairs - NaN values replaced in the normalized series or probabilities
+factor_cache_hits, factor_cache_misses - lookups in the spectral factor cache
+geometry_cache_hits, geometry_cache_misses - lookups in the geometry cache
+indefinite_blocks - blocks of the block factorization that are not positive
+                     definite (see SolarSynthesis.block_coherence_factor())
+"""
+import json
+import re
+import time
+
+##################################################
+#
+# MAIN FUNCTIONS
+#
+##################################################
+
+class Metrics:
+    """
+    Purpose:
+     Named timers (number of calls and total seconds) and counters
+
+    Data:
+    timers - dictionary of name: [calls, seconds]
+    counters - dictionary of name: count
+
+    Methods:
+    add_time(name, seconds) - add a timed call to a timer
+    count(name, n) - add n to a counter
+    timer(name) - context manager that times its block
+    stopwatch() - Stopwatch that times consecutive stages
+    snapshot(reset) - plain dictionary of the timers and counters, e.g. to send
+                       from a worker process, optionally clearing them
+    merge(snapshot) - add a snapshot from another process
+    to_json(), to_prometheus(prefix) - export as text
+    save(file_name) - export to a file, as Prometheus text for .prom or .txt
+                       files and as JSON otherwise
+    clear() - remove all timers and counters
+    """
+    def __init__(self):
+        self.clear()
+
+    def add_time(self, name, seconds, calls = 1):
+        t = self.timers.get(name)
+        if t is None:
+            self.timers[name] = [calls, seconds]
+        else:
+            t[0] += calls
+            t[1] += seconds
+
+    def count(self, name, n = 1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def timer(self, name):
+        return _Timer(self, name)
+
+    def stopwatch(self):
+        return Stopwatch(self)
+
+    def snapshot(self, reset = False):
+        snap = {'timers': dict((name, {'calls': t[0], 'seconds': t[1]})
+                               for name, t in self.timers.items()),
+                'counters': dict(self.counters)}
+        if reset:
+            self.clear()
+        return snap
+
+    def merge(self, snapshot):
+        if snapshot is None:
+            return
+        for name, t in snapshot['timers'].items():
+            self.add_time(name, t['seconds'], t['calls'])
+        for name, n in snapshot['counters'].items():
+            self.count(name, n)
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent = 1, sort_keys = True)
+
+    def to_prometheus(self, prefix = 'solar_synthesis'):
+        lines = []
+        if self.timers:
+            for metric, i, desc in [('stage_seconds_total', 1, 'Seconds spent'),
+                                    ('stage_calls_total', 0, 'Timed calls')]:
+                name = '%s_%s' % (prefix, metric)
+                lines.append('# HELP %s %s in each stage of the synthesis' %
+                             (name, desc))
+                lines.append('# TYPE %s counter' % name)
+                for stage in sorted(self.timers):
+                    lines.append('%s{stage="%s"} %r' %
+                                 (name, stage, self.timers[stage][i]))
+        for counter in sorted(self.counters):
+            name = '%s_%s_total' % (prefix, metric_name(counter))
+            lines.append('# TYPE %s counter' % name)
+            lines.append('%s %r' % (name, self.counters[counter]))
+
+        return '\n'.join(lines) + '\n'
+
+    def save(self, file_name):
+        if file_name.endswith('.prom') or file_name.endswith('.txt'):
+            text = self.to_prometheus()
+        else:
+            text = self.to_json()
+        save_file = open(file_name, 'w')
+        save_file.write(text)
+        save_file.close()
+
+    def clear(self):
+        self.timers = {}
+        self.counters = {}
+
+
+class Stopwatch:
+    """
+    Purpose:
+     Time consecutive stages: each lap(name) adds the time since the last lap
+     (or since the stopwatch was started) to the timer name
+    """
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.start = time.time()
+
+    def lap(self, name):
+        now = time.time()
+        self.metrics.add_time(name, now - self.start)
+        self.start = now
+
+#### Each process keeps its own metrics
+METRICS = Metrics()
+
+##################################################
+#
+# SUPPORT FUNCTIONS
+#
+##################################################
+
+class _Timer:
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.add_time(self.name, time.time() - self.start)
+        return False
+
+def metric_name(name):
+    """
+    Purpose:
+    Convert a timer or counter name to a valid Prometheus metric name
+    """
+    return re.sub('[^a-zA-Z0-9_]', '_', name)
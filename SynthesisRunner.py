@@ -0,0 +1,475 @@
+"""
+Purpose:
+Run the synthesis of SolarSynthesis.py for a large number of sites as chunks of
+hours that are independent of each other, using a work queue on the file system
+that any number of worker processes (on this machine or on other machines that
+share the run directory) take chunks from.  Each finished chunk is written to
+disk, so a run that is interrupted resumes with only the chunks that are not
+finished.
+
+Input:
+- list of SolarSite objects (see SolarSynthesis.SolarSite)
+- run directory
+
+Output:
+- run directory with:
+   run.pkl - the hours, sites and chunk size of the run
+   tables/ - the shared synthesis tables (see SolarSynthesis.publish_tables())
+   todo/ - one file for each chunk waiting for a worker
+   claimed/ - one file for each chunk a worker is synthesizing
+   chunks/ - the 1-min clearsky index (minutes X sites) of each finished chunk
+   metrics/ - the timers and counters of each worker (see SynthesisMetrics.py)
+- the 1-min clearsky index attached to each SolarSite by collect()
+
+Usage:
+ prepare(run_dir, solar_sites, ...) once, then run(run_dir, n_workers) on this
+ machine and/or "python SynthesisRunner.py worker <run_dir>" on other machines,
+ and collect(run_dir, solar_sites) when every chunk is finished.  After a crash
+ run(run_dir) (or resume(run_dir)) puts the unfinished chunks back in the queue,
+ once the claims of the stopped workers are older than STALE_SECONDS; when no 
+ worker is running anywhere resume(run_dir, 0) puts them back right away.
+"""
+import SolarSynthesis as synth
+from SynthesisMetrics import METRICS, Metrics
+import numpy as np
+import pandas as pd
+import cPickle
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+
+#### Number of hours in each chunk of the run
+CHUNK_HOURS = 24 * 7
+
+#### Seconds between the updates of the time of a worker's claim while it 
+####  synthesizes a chunk, and the age of a claim before resume() treats it as
+####  abandoned by a worker that stopped
+HEARTBEAT_SECONDS = 60
+STALE_SECONDS = 10 * HEARTBEAT_SECONDS
+
+##################################################
+#
+# MAIN FUNCTIONS
+#
+##################################################
+
+def prepare(run_dir, solar_sites, chunk_hours = CHUNK_HOURS, seed = None,
+            overlap = False, **kwargs):
+    """
+    Purpose:
+    Set up a run: build the shared synthesis tables, write them to the run
+     directory and put every chunk of hours in the queue.  If the run directory
+     is already set up it is left as it is.
+
+    Input:
+    run_dir - directory for the run (shared by every worker)
+    solar_sites - a list of SolarSite objects
+    chunk_hours - number of hours in each chunk
+    seed - root seed of the random phases.  Every chunk is synthesized from the
+            seed, so a resumed run gives the same result as an uninterrupted
+            one.  If None a seed is drawn and kept with the run.
+    overlap - synthesize the hours as one continuous series, also across the
+               chunks, see SolarSynthesis.synthesize_overlap()
+    kwargs - cdf_interp, factorization, coherence_tol, cluster_km, neighbor_km,
+              precision, see SolarSynthesis.main()
+
+    Output:
+    run - dictionary with the hours, sites, chunk size and seed of the run
+    """
+    if os.path.exists(os.path.join(run_dir, 'run.pkl')):
+        return load_run(run_dir)
+
+    for sub_dir in ['todo', 'claimed', 'chunks', 'metrics']:
+        if not os.path.isdir(os.path.join(run_dir, sub_dir)):
+            os.makedirs(os.path.join(run_dir, sub_dir))
+
+    if seed is None:
+        seed = np.random.randint(2**31)
+
+    synth_hr_args = synth.synthesis_parameters(solar_sites, seed, **kwargs)
+    synth.publish_tables(synth_hr_args, os.path.join(run_dir, 'tables'))
+
+    hour_index = solar_sites[0].clr_idx_hr.index
+    run = {'hour_index': hour_index,
+           'site_index': synth_hr_args[1],
+           'chunk_hours': chunk_hours,
+           'n_chunks': (len(hour_index) + chunk_hours - 1) // chunk_hours,
+           'seed': seed,
+           'overlap': overlap,
+           'dtype': synth_hr_args[3].dtype}
+
+    for chunk in range(run['n_chunks']):
+        open(os.path.join(run_dir, 'todo', chunk_name(chunk)), 'w').close()
+
+    #### The run file is written last, so a run directory with a run file is
+    ####  complete
+    save_file = open(os.path.join(run_dir, 'run.pkl.tmp'), 'wb')
+    cPickle.dump(run, save_file, cPickle.HIGHEST_PROTOCOL)
+    save_file.close()
+    os.rename(os.path.join(run_dir, 'run.pkl.tmp'),
+              os.path.join(run_dir, 'run.pkl'))
+
+    return run
+
+def run(run_dir, n_workers = None, stale_seconds = STALE_SECONDS):
+    """
+    Purpose:
+    Resume the run and synthesize the chunks in the queue with worker processes
+     on this machine
+
+    Input:
+    run_dir - directory set up by prepare()
+    n_workers - number of worker processes (default the number of cpus)
+    stale_seconds - see resume()
+
+    Output:
+    missing - list of the chunks that are not finished (empty when the run is
+               complete)
+    """
+    resume(run_dir, stale_seconds)
+
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count()
+
+    workers = [multiprocessing.Process(target = worker, args = (run_dir,))
+               for i in range(n_workers)]
+    for p in workers:
+        p.start()
+    for p in workers:
+        p.join()
+
+    return missing_chunks(run_dir)
+
+def worker(run_dir, worker_id = None):
+    """
+    Purpose:
+    Take chunks from the queue of the run and synthesize them until the queue is
+     empty.  Any number of workers can run at once, on this machine or on other
+     machines that share the run directory.
+
+    Input:
+    run_dir - directory set up by prepare()
+    worker_id - name of the worker in the claim files (default host and pid)
+
+    Output:
+    n_chunks - number of chunks synthesized by this worker
+    """
+    if worker_id is None:
+        worker_id = '%s-%s' % (socket.gethostname(), os.getpid())
+
+    run = load_run(run_dir)
+    synth_hr_args = synth.attach_tables(os.path.join(run_dir, 'tables'))
+    chunk_hours = run['chunk_hours']
+    METRICS.clear()
+
+    n_chunks = 0
+    while True:
+        claim = claim_chunk(run_dir, worker_id)
+        if claim is None:
+            break
+        chunk, claim_file = claim
+
+        hours = run['hour_index'][chunk*chunk_hours:(chunk + 1)*chunk_hours]
+        with Heartbeat(claim_file):
+            TS = synth.synthesize_year(hours, synth_hr_args, chunk_hours,
+                                       run['overlap'])
+        save_chunk(run_dir, chunk, TS)
+
+        #### The claim may have been put back by resume() if this worker was 
+        ####  stopped for longer than the stale time; the chunk is saved anyway
+        remove_claim(claim_file)
+        n_chunks += 1
+
+        #### Keep the worker's metrics up to date after every chunk 
+        METRICS.count('chunks')
+        save_metrics(run_dir, worker_id)
+
+    return n_chunks
+
+def collect(run_dir, solar_sites, metrics_file = None):
+    """
+    Purpose:
+    Put the finished chunks together and attach the 1-min clearsky index to each
+     site, the same as SolarSynthesis.main()
+
+    Input:
+    run_dir - directory of a finished run
+    solar_sites - the list of SolarSite objects of the run, in the same order
+    metrics_file - optional file for the metrics of every worker of the run, see
+                    run_metrics() and SynthesisMetrics.Metrics.save()
+
+    Output:
+    solar_sites - the same list of SolarSite objects with clr_idx_min attached
+    """
+    run = load_run(run_dir)
+    missing = missing_chunks(run_dir)
+    if missing:
+        raise RuntimeError("Run %s has %s unfinished chunks: %s" %
+                           (run_dir, len(missing), missing))
+
+    year_rng = synth.minute_index(run['hour_index'])
+    TS_year = synth.year_output((len(year_rng), len(run['site_index'])),
+                                dtype = run['dtype'])
+    rows = run['chunk_hours'] * 60
+    for chunk in range(run['n_chunks']):
+        TS_year[chunk*rows:(chunk + 1)*rows] = \
+            np.load(os.path.join(run_dir, 'chunks', chunk_name(chunk) + '.npy'))
+
+    for j, site in enumerate(solar_sites):
+        site.clr_idx_min = pd.Series(TS_year[:, j], index = year_rng,
+                                     name = site.id)
+
+    if metrics_file is not None:
+        run_metrics(run_dir).save(metrics_file)
+
+    return solar_sites
+
+def run_metrics(run_dir):
+    """
+    Purpose:
+    Add up the metrics of every worker of the run (including workers on other 
+     machines and workers that were stopped)
+
+    Output:
+    metrics - SynthesisMetrics.Metrics object
+    """
+    metrics = Metrics()
+    metrics_dir = os.path.join(run_dir, 'metrics')
+    if os.path.isdir(metrics_dir):
+        for name in sorted(os.listdir(metrics_dir)):
+            if name.endswith('.json'):
+                metrics.merge(json.load(open(os.path.join(metrics_dir, name))))
+
+    return metrics
+
+##################################################
+#
+# SUPPORT FUNCTIONS
+#
+##################################################
+
+def resume(run_dir, stale_seconds = STALE_SECONDS):
+    """
+    Purpose:
+    Put every chunk that is not finished back in the queue, after a crash or
+     after workers were stopped.  Chunks claimed by a worker are only put back
+     once the claim is older than stale_seconds.
+
+    Input:
+    run_dir - directory set up by prepare()
+    stale_seconds - age (s) of a claim before it is treated as abandoned.  A 
+                     running worker updates the time of its claim every 
+                     HEARTBEAT_SECONDS, so the default STALE_SECONDS only puts 
+                     back the claims of workers that stopped.  0 puts back every
+                     claim, which is only right when no workers are running.
+
+    Output:
+    missing - list of the chunks that are not finished
+    """
+    now = time.time()
+    claimed = {}
+    for claim in os.listdir(os.path.join(run_dir, 'claimed')):
+        claimed.setdefault(claim.split('.')[0], []).append(claim)
+
+    missing = missing_chunks(run_dir)
+    for chunk in missing:
+        name = chunk_name(chunk)
+        todo_file = os.path.join(run_dir, 'todo', name)
+        live = False
+        for claim in claimed.get(name, []):
+            claim_file = os.path.join(run_dir, 'claimed', claim)
+            try:
+                if now - os.path.getmtime(claim_file) >= stale_seconds:
+                    os.remove(claim_file)
+                else:
+                    live = True
+            except OSError:
+                pass
+        if not live and not os.path.exists(todo_file):
+            open(todo_file, 'w').close()
+
+    return missing
+
+def claim_chunk(run_dir, worker_id):
+    """
+    Purpose:
+    Claim the next chunk in the queue by moving its file from todo/ to claimed/,
+     which only one worker can do for each chunk
+
+    Output:
+    (chunk, claim_file), or None when the queue is empty
+    """
+    for name in sorted(os.listdir(os.path.join(run_dir, 'todo'))):
+        claim_file = os.path.join(run_dir, 'claimed', name + '.' + worker_id)
+        try:
+            os.rename(os.path.join(run_dir, 'todo', name), claim_file)
+        except OSError:
+            #### Claimed by another worker
+            continue
+
+        #### Mark the time of the claim for resume()
+        try:
+            os.utime(claim_file, None)
+        except OSError:
+            #### Put back by resume() in the meantime 
+            continue
+
+        chunk = int(name.split('_')[1])
+        if chunk_done(run_dir, chunk):
+            remove_claim(claim_file)
+            continue
+
+        return chunk, claim_file
+
+    return None
+
+def remove_claim(claim_file):
+    """
+    Purpose:
+    Remove a claim file, which resume() may already have removed
+    """
+    try:
+        os.remove(claim_file)
+    except OSError:
+        pass
+
+class Heartbeat:
+    """
+    Purpose:
+     Context manager that updates the time of a claim file every interval 
+     seconds from a background thread while a worker synthesizes the chunk, so
+     that resume() on another machine does not treat the claim as abandoned 
+    """
+    def __init__(self, claim_file, interval = HEARTBEAT_SECONDS):
+        self.claim_file = claim_file
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target = self.beat)
+        self.thread.daemon = True
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stopped.set()
+        self.thread.join()
+        return False
+
+    def beat(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                os.utime(self.claim_file, None)
+            except OSError:
+                #### The claim was put back by resume() 
+                return
+
+def save_chunk(run_dir, chunk, TS):
+    """
+    Purpose:
+    Write the 1-min clearsky index of a chunk, to a temporary file that is then
+     renamed so that a chunk file is always complete
+    """
+    chunk_file = os.path.join(run_dir, 'chunks', chunk_name(chunk) + '.npy')
+    tmp_file = chunk_file + '.%s.tmp' % os.getpid()
+    save_file = open(tmp_file, 'wb')
+    np.save(save_file, np.ascontiguousarray(TS))
+    save_file.close()
+    os.rename(tmp_file, chunk_file)
+
+def save_metrics(run_dir, worker_id):
+    """
+    Purpose:
+    Write the metrics of this worker, to a temporary file that is then renamed
+    """
+    metrics_dir = os.path.join(run_dir, 'metrics')
+    if not os.path.isdir(metrics_dir):
+        os.makedirs(metrics_dir)
+    metrics_file = os.path.join(metrics_dir, worker_id + '.json')
+    tmp_file = metrics_file + '.tmp'
+    METRICS.save(tmp_file)
+    os.rename(tmp_file, metrics_file)
+
+def chunk_done(run_dir, chunk):
+    return os.path.exists(os.path.join(run_dir, 'chunks',
+                                       chunk_name(chunk) + '.npy'))
+
+def missing_chunks(run_dir):
+    """
+    Purpose:
+    List of the chunks of the run that are not finished
+    """
+    run = load_run(run_dir)
+    return [chunk for chunk in range(run['n_chunks'])
+            if not chunk_done(run_dir, chunk)]
+
+def chunk_name(chunk):
+    return 'chunk_%05d' % chunk
+
+def load_run(run_dir):
+    return cPickle.load(open(os.path.join(run_dir, 'run.pkl'), 'rb'))
+
+##################################################
+#
+# SECONDARY TEST FUNCTIONS
+#
+##################################################
+
+def test_resume():
+    """
+    Check that an interrupted and resumed run gives the same 1-min output as 
+     SolarSynthesis.main() with the same seed, that resume() leaves the claim of
+     a running worker alone, and that the heartbeat keeps a claim fresh
+    """
+    import shutil
+    import tempfile
+    test_dir = tempfile.mkdtemp(prefix = 'solar_run_')
+    run_dir = os.path.join(test_dir, 'run')
+    prepare(run_dir, synth.random_sites(5, n_hours = 60), chunk_hours = 24, 
+            seed = 4)
+
+    #### A worker on another machine holds the first chunk 
+    chunk, claim_file = claim_chunk(run_dir, 'other-1')
+    assert worker(run_dir) == 2
+    assert resume(run_dir) == [chunk] and os.path.exists(claim_file)
+
+    #### The heartbeat updates the claim, and stops once the claim is gone
+    os.utime(claim_file, (0, 0))
+    with Heartbeat(claim_file, interval = 0.01):
+        time.sleep(0.1)
+        assert os.path.getmtime(claim_file) > 0
+        os.remove(claim_file)
+        time.sleep(0.05)
+    open(claim_file, 'w').close()
+
+    #### The other worker stopped 
+    assert resume(run_dir, stale_seconds = 0) == [chunk]
+    assert not os.path.exists(claim_file)
+    assert worker(run_dir) == 1 and missing_chunks(run_dir) == []
+
+    sites_run = collect(run_dir, synth.random_sites(5, n_hours = 60))
+    sites_main = synth.main(synth.random_sites(5, n_hours = 60), engine = 'year',
+                            seed = 4)
+    for site_run, site_main in zip(sites_run, sites_main):
+        assert np.array_equal(site_run.clr_idx_min.values, 
+                              site_main.clr_idx_min.values)
+
+    synth.release_tables(os.path.join(run_dir, 'tables'))
+    shutil.rmtree(test_dir)
+
+if __name__ == '__main__':
+    """
+    python SynthesisRunner.py worker <run_dir>
+    python SynthesisRunner.py resume <run_dir> [stale_seconds]
+    """
+    command, run_dir = sys.argv[1], sys.argv[2]
+    if command == 'worker':
+        print "Synthesized %s chunks" % worker(run_dir)
+    elif command == 'resume':
+        stale_seconds = float(sys.argv[3]) if len(sys.argv) > 3 else \
+            STALE_SECONDS
+        print "%s chunks not finished" % len(resume(run_dir, stale_seconds))
@@ -0,0 +1,286 @@
+"""
+Purpose:
+Binary store for the PSD and CDF lookup tables of SolarSynthesis.py.  The tables
+are kept as fixed-layout arrays after a small header, so they are loaded by
+memory mapping the file (read-only, and shared by every process on the machine
+through the page cache) instead of unpickling a pandas Panel in each process.
+
+File layout (little-endian):
+ 8 bytes  - MAGIC
+ uint32   - FORMAT_VERSION
+ uint32   - length of the header in bytes
+ uint32   - crc32 of the header
+ header   - JSON with the name, dtype, shape, offset and crc32 of each array
+ arrays   - each array in C order, starting at a multiple of ALIGN bytes
+
+Arrays:
+ kbar - (K,) hourly clearsky index of each table level
+ freq - (F,) frequency (Hz) of each PSD coefficient
+ psd - (K, F) complex spectral coefficient for each level and frequency
+ cdf_prob - (P,) cumulative probabilities of the stored CDF
+ cdf - (K, P) clearsky index at each probability for each level (NaN where
+        the level has no value)
+
+It also builds a local SQLite copy of the MySQL 'synth' database (the psd and
+ cdf tables), which SolarSynthesis.opendbDict() uses when it is present, so the
+ tables can be rebuilt without a database server.
+
+Usage:
+ python SynthesisTables.py convert - write TABLES_FILE from the pickled tables
+ python SynthesisTables.py sqlite - write SQLITE_FILE from the pickled tables
+"""
+import numpy as np
+import pandas as pd
+import datetime
+import json
+import os
+import sqlite3
+import struct
+import sys
+import zlib
+
+ROOT_DIR = os.path.join(os.curdir, '%s')
+
+#### Default files of the binary tables and of the SQLite copy of the database
+TABLES_FILE = ROOT_DIR % 'clearsky_index_tables.bin'
+SQLITE_FILE = ROOT_DIR % 'synth.sqlite'
+
+MAGIC = 'SSYNTAB\0'
+FORMAT_VERSION = 1
+ALIGN = 64
+
+#### Order of the arrays in the file
+ARRAYS = ['kbar', 'freq', 'psd', 'cdf_prob', 'cdf']
+
+#### Selection of the stored PSDs in the psd table of the database
+PSD_N = 64; PSD_COS_MIN = 0.15
+
+class TableFormatError(ValueError):
+    """
+    Purpose:
+    Raised by read_tables() for a file that is not a lookup table file of this
+     FORMAT_VERSION, is truncated, or fails its checksums
+    """
+    pass
+
+##################################################
+#
+# MAIN FUNCTIONS
+#
+##################################################
+
+def write_tables(arrays, file_name = TABLES_FILE, **info):
+    """
+    Purpose:
+    Write the lookup tables to the binary store, to a temporary file that is
+     then renamed so that the file is always complete
+
+    Input:
+    arrays - dictionary with each of the ARRAYS, e.g. from panel_arrays()
+    file_name - name of the file
+    info - other items to keep in the header (e.g. the source of the tables)
+    """
+    header = {'arrays': {}, 'created': datetime.datetime.now().isoformat()}
+    header.update(info)
+
+    data = [np.ascontiguousarray(arrays[name]) for name in ARRAYS]
+
+    #### The offsets depend on the length of the header, so lay out the arrays
+    ####  until the header fits before the first one
+    start = ALIGN
+    while True:
+        offset = start
+        for name, arr in zip(ARRAYS, data):
+            header['arrays'][name] = {'dtype': arr.dtype.newbyteorder('<').str,
+                                      'shape': list(arr.shape),
+                                      'offset': offset,
+                                      'crc32': crc32(arr)}
+            offset = aligned(offset + arr.nbytes)
+        header_str = json.dumps(header, sort_keys = True)
+        if len(MAGIC) + 12 + len(header_str) <= start:
+            break
+        start = aligned(len(MAGIC) + 12 + len(header_str))
+
+    tmp_file = file_name + '.%s.tmp' % os.getpid()
+    save_file = open(tmp_file, 'wb')
+    save_file.write(MAGIC)
+    save_file.write(struct.pack('<III', FORMAT_VERSION, len(header_str),
+                                zlib.crc32(header_str) & 0xffffffff))
+    save_file.write(header_str)
+    for name, arr in zip(ARRAYS, data):
+        save_file.seek(header['arrays'][name]['offset'])
+        save_file.write(arr.astype(arr.dtype.newbyteorder('<')).tostring())
+    save_file.close()
+    os.rename(tmp_file, file_name)
+
+def read_tables(file_name = TABLES_FILE, verify = True):
+    """
+    Purpose:
+    Memory map the lookup tables of the binary store
+
+    Input:
+    file_name - name of the file
+    verify - if True check the crc32 of each array
+
+    Output:
+    tables - dictionary of the read-only memory-mapped arrays by name, and the
+              header under 'header'
+
+    Raises IOError if the file cannot be read and TableFormatError (a 
+     ValueError) if it is not a table file of this version, is truncated or 
+     fails its checksums
+    """
+    load_file = open(file_name, 'rb')
+    try:
+        magic = load_file.read(len(MAGIC))
+        if magic != MAGIC:
+            raise TableFormatError("%s is not a lookup table file" % file_name)
+        try:
+            version, header_len, header_crc = struct.unpack('<III',
+                                                            load_file.read(12))
+        except struct.error:
+            raise TableFormatError("%s has a truncated header" % file_name)
+        if version != FORMAT_VERSION:
+            raise TableFormatError("%s has version %s of the table format, "
+                                   "not %s" % (file_name, version, 
+                                               FORMAT_VERSION))
+        header_str = load_file.read(header_len)
+    finally:
+        load_file.close()
+
+    if zlib.crc32(header_str) & 0xffffffff != header_crc:
+        raise TableFormatError("%s has a corrupt header" % file_name)
+    header = json.loads(header_str)
+
+    tables = {'header': header}
+    for name in ARRAYS:
+        desc = header['arrays'][name]
+        try:
+            arr = np.memmap(file_name, dtype = np.dtype(str(desc['dtype'])),
+                            mode = 'r', offset = desc['offset'],
+                            shape = tuple(desc['shape']))
+        except ValueError:
+            #### The array runs past the end of the file
+            raise TableFormatError("%s: table %s is truncated" % 
+                                   (file_name, name))
+        if verify and crc32(arr) != desc['crc32']:
+            raise TableFormatError("%s: checksum of table %s does not match" %
+                                   (file_name, name))
+        tables[name] = arr
+
+    return tables
+
+def convert_pickles(psd_file = ROOT_DIR % 'clearsky_index_psd.pkl',
+                    cdf_file = ROOT_DIR % 'clearsky_index_cdf.pkl',
+                    file_name = TABLES_FILE):
+    """
+    Purpose:
+    Convert the pickled PSD Panel and CDF DataFrame into the binary store
+    """
+    #### pd.read_pickle() reads pickles written by older versions of pandas, 
+    ####  which cPickle.load() cannot rebuild
+    psd = pd.read_pickle(psd_file)
+    cdf = pd.read_pickle(cdf_file)
+    write_tables(panel_arrays(psd, cdf), file_name,
+                 source = [os.path.basename(psd_file),
+                           os.path.basename(cdf_file)])
+
+def build_sqlite(psd, cdf, db_file = SQLITE_FILE):
+    """
+    Purpose:
+    Build a SQLite copy of the psd and cdf tables of the MySQL 'synth' database
+     from the stored tables, with the columns used by
+     SolarSynthesis.power_spectral_density() and
+     SolarSynthesis.clearsky_index_distribution()
+
+    Input:
+    psd - Panel from SolarSynthesis.power_spectral_density()
+    cdf - DataFrame from SolarSynthesis.clearsky_index_distribution()
+    db_file - name of the SQLite file (replaced if it exists)
+    """
+    arrays = panel_arrays(psd, cdf)
+
+    tmp_file = db_file + '.%s.tmp' % os.getpid()
+    if os.path.exists(tmp_file):
+        os.remove(tmp_file)
+    conn = sqlite3.connect(tmp_file)
+    cursor = conn.cursor()
+    cursor.execute("""
+      CREATE TABLE psd (kbar REAL, N INTEGER, cos_min REAL, frequency REAL,
+                        power_real REAL, power_imag REAL)""")
+    cursor.execute("CREATE INDEX psd_kbar ON psd (kbar, N, cos_min)")
+    cursor.execute("CREATE TABLE cdf (kbar REAL, F REAL, k REAL)")
+    cursor.execute("CREATE INDEX cdf_kbar ON cdf (kbar)")
+
+    #### The kbar values are stored as the floats of their labels, so that the
+    ####  queries with the labels (e.g. kbar = 0.05) match
+    for level, kbar in enumerate(arrays['kbar']):
+        kbar = float('%3.2f' % kbar)
+        cursor.executemany("INSERT INTO psd VALUES (?, ?, ?, ?, ?, ?)",
+            [(kbar, PSD_N, PSD_COS_MIN, float(f), float(p.real), float(p.imag))
+             for f, p in zip(arrays['freq'], arrays['psd'][level])])
+        cursor.executemany("INSERT INTO cdf VALUES (?, ?, ?)",
+            [(kbar, float(F), float(k))
+             for F, k in zip(arrays['cdf_prob'], arrays['cdf'][level])
+             if not np.isnan(k)])
+    conn.commit()
+    cursor.close()
+    conn.close()
+    os.rename(tmp_file, db_file)
+
+##################################################
+#
+# SUPPORT FUNCTIONS
+#
+##################################################
+
+def panel_arrays(psd, cdf):
+    """
+    Purpose:
+    Arrays of the binary store from the PSD Panel and the CDF DataFrame, with
+     the levels sorted by the hourly clearsky index
+    """
+    psd_items = sorted(psd.items, key = float)
+    cdf_items = sorted(cdf.columns, key = float)
+
+    arrays = {'kbar': np.array(psd_items, dtype = float),
+              'freq': np.real(psd[psd_items[0]]['freq'].values.astype(complex)),
+              'psd': np.array([psd[kbar]['psd'].values for kbar in psd_items],
+                              dtype = complex),
+              'cdf_prob': np.asarray(cdf.index, dtype = float),
+              'cdf': np.array([cdf[kbar].values for kbar in cdf_items],
+                              dtype = float)}
+
+    if not np.array_equal(arrays['kbar'], np.array(cdf_items, dtype = float)):
+        raise ValueError("The PSD and CDF tables have different levels")
+
+    return arrays
+
+def connect_sqlite(db_file = SQLITE_FILE, dict_rows = True):
+    """
+    Purpose:
+    Connection to the SQLite copy of the database, with each row returned as a
+     dictionary by column name like the MySQLdb DictCursor
+    """
+    conn = sqlite3.connect(db_file)
+    if dict_rows:
+        conn.row_factory = lambda cursor, row: dict(
+            (desc[0], value) for desc, value in zip(cursor.description, row))
+    return conn
+
+def crc32(arr):
+    return zlib.crc32(np.ascontiguousarray(arr).view(np.uint8)) & 0xffffffff
+
+def aligned(offset):
+    return (offset + ALIGN - 1) // ALIGN * ALIGN
+
+if __name__ == '__main__':
+    """
+    python SynthesisTables.py convert
+    python SynthesisTables.py sqlite
+    """
+    if sys.argv[1] == 'convert':
+        convert_pickles()
+    elif sys.argv[1] == 'sqlite':
+        build_sqlite(pd.read_pickle(ROOT_DIR % 'clearsky_index_psd.pkl'),
+                     pd.read_pickle(ROOT_DIR % 'clearsky_index_cdf.pkl'))